@@ -12,6 +12,14 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Panels read the conversation_rollups / feedback_rollups tables (see src/migrations.py), using the
+# coarsest granularity that still resolves the panel's interval
+ROLLUP_GRANULARITY = """
+    CASE WHEN $__interval_ms >= 86400000 THEN 'day'
+         WHEN $__interval_ms >= 3600000 THEN 'hour'
+         ELSE 'minute' END
+"""
+
 class GrafanaInitializer:
     def __init__(self):
         self.grafana_url = os.getenv('GRAFANA_URL', 'http://localhost:3000')
@@ -91,14 +99,14 @@ class GrafanaInitializer:
                         "type": "graph",
                         "gridPos": {"h": 8, "w": 12, "x": 0, "y": 0},
                         "targets": [{
-                            "rawSql": """
+                            "rawSql": f"""
                             SELECT
-                                timestamp as time,
-                                avg(response_time) as "Response Time"
-                            FROM conversations
-                            WHERE $__timeFilter(timestamp)
-                            GROUP BY timestamp
-                            ORDER BY timestamp
+                                bucket as time,
+                                sum(response_time_sum) / NULLIF(sum(conversations), 0) as "Response Time"
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
+                            GROUP BY bucket
+                            ORDER BY bucket
                             """,
                             "format": "time_series"
                         }]
@@ -109,12 +117,12 @@ class GrafanaInitializer:
                         "type": "piechart",
                         "gridPos": {"h": 8, "w": 12, "x": 12, "y": 0},
                         "targets": [{
-                            "rawSql": """
+                            "rawSql": f"""
                             SELECT
                                 model_used as metric,
-                                count(*) as value
-                            FROM conversations
-                            WHERE $__timeFilter(timestamp)
+                                sum(conversations) as value
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
                             GROUP BY model_used
                             """
                         }]
@@ -125,19 +133,81 @@ class GrafanaInitializer:
                         "type": "graph",
                         "gridPos": {"h": 8, "w": 12, "x": 0, "y": 8},
                         "targets": [{
-                            "rawSql": """
+                            "rawSql": f"""
+                            SELECT
+                                bucket as time,
+                                sum(total_tokens)::float / NULLIF(sum(conversations), 0) as "Total Tokens",
+                                sum(prompt_tokens)::float / NULLIF(sum(conversations), 0) as "Prompt Tokens",
+                                sum(completion_tokens)::float / NULLIF(sum(conversations), 0) as "Completion Tokens"
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
+                            GROUP BY bucket
+                            ORDER BY bucket
+                            """,
+                            "format": "time_series"
+                        }]
+                    },
+                    # Answer Cache Panel
+                    {
+                        "title": "Cached vs Fresh Answers",
+                        "type": "graph",
+                        "gridPos": {"h": 8, "w": 12, "x": 12, "y": 8},
+                        "targets": [{
+                            "rawSql": f"""
+                            SELECT
+                                bucket as time,
+                                COALESCE(sum(conversations) FILTER (WHERE cached), 0) as "Cached",
+                                COALESCE(sum(conversations) FILTER (WHERE NOT cached), 0) as "Fresh"
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
+                            GROUP BY bucket
+                            ORDER BY time
+                            """,
+                            "format": "time_series"
+                        }]
+                    },
+                    # Streaming Latency Panel
+                    {
+                        "title": "Time to First Token and Throughput",
+                        "type": "graph",
+                        "gridPos": {"h": 8, "w": 24, "x": 0, "y": 16},
+                        "targets": [{
+                            "rawSql": f"""
                             SELECT
-                                timestamp as time,
-                                avg(total_tokens) as "Total Tokens",
-                                avg(prompt_tokens) as "Prompt Tokens",
-                                avg(completion_tokens) as "Completion Tokens"
-                            FROM conversations
-                            WHERE $__timeFilter(timestamp)
-                            GROUP BY timestamp
-                            ORDER BY timestamp
+                                bucket as time,
+                                sum(time_to_first_token_sum) / NULLIF(sum(time_to_first_token_count), 0) as "Time to First Token",
+                                sum(response_time_sum) / NULLIF(sum(conversations), 0) as "Response Time",
+                                sum(tokens_per_second_sum) / NULLIF(sum(tokens_per_second_count), 0) as "Tokens per Second"
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket) AND NOT cached
+                            GROUP BY bucket
+                            ORDER BY time
                             """,
                             "format": "time_series"
                         }]
+                    },
+                    # Response Time Histogram Panel
+                    {
+                        "title": "Response Time Distribution",
+                        "type": "barchart",
+                        "gridPos": {"h": 8, "w": 24, "x": 0, "y": 24},
+                        "targets": [{
+                            # Slots follow RESPONSE_TIME_BOUNDS in src/migrations.py
+                            "rawSql": f"""
+                            SELECT
+                                h.label as metric,
+                                sum(r.response_time_histogram[h.slot]) as value
+                            FROM conversation_rollups r
+                            CROSS JOIN (VALUES
+                                (1, '< 0.5s'), (2, '0.5-1s'), (3, '1-2s'), (4, '2-4s'),
+                                (5, '4-8s'), (6, '8-16s'), (7, '16-32s'), (8, '>= 32s')
+                            ) AS h (slot, label)
+                            WHERE r.granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(r.bucket)
+                            GROUP BY h.slot, h.label
+                            ORDER BY h.slot
+                            """,
+                            "format": "table"
+                        }]
                     }
                 ],
                 "refresh": "5s"
@@ -156,12 +226,12 @@ class GrafanaInitializer:
                         "type": "stat",
                         "gridPos": {"h": 8, "w": 12, "x": 0, "y": 0},
                         "targets": [{
-                            "rawSql": """
+                            "rawSql": f"""
                             SELECT
-                                sum(case when feedback > 0 then 1 else 0 end) as "Positive",
-                                sum(case when feedback < 0 then 1 else 0 end) as "Negative"
-                            FROM feedback
-                            WHERE $__timeFilter(timestamp)
+                                COALESCE(sum(positive), 0) as "Positive",
+                                COALESCE(sum(negative), 0) as "Negative"
+                            FROM feedback_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
                             """
                         }]
                     },
@@ -171,12 +241,12 @@ class GrafanaInitializer:
                         "type": "piechart",
                         "gridPos": {"h": 8, "w": 12, "x": 12, "y": 0},
                         "targets": [{
-                            "rawSql": """
+                            "rawSql": f"""
                             SELECT
                                 relevance as metric,
-                                count(*) as value
-                            FROM conversations
-                            WHERE $__timeFilter(timestamp)
+                                sum(conversations) as value
+                            FROM conversation_rollups
+                            WHERE granularity = {ROLLUP_GRANULARITY} AND $__timeFilter(bucket)
                             GROUP BY relevance
                             """
                         }]
@@ -189,12 +259,12 @@ class GrafanaInitializer:
                         "targets": [{
                             "rawSql": """
                             SELECT
-                                date_trunc('hour', timestamp) as time,
-                                count(*) FILTER (WHERE feedback > 0) as "Positive",
-                                count(*) FILTER (WHERE feedback < 0) as "Negative"
-                            FROM feedback
-                            WHERE $__timeFilter(timestamp)
-                            GROUP BY date_trunc('hour', timestamp)
+                                bucket as time,
+                                sum(positive) as "Positive",
+                                sum(negative) as "Negative"
+                            FROM feedback_rollups
+                            WHERE granularity = 'hour' AND $__timeFilter(bucket)
+                            GROUP BY bucket
                             ORDER BY time
                             """,
                             "format": "time_series"
@@ -1,17 +1,16 @@
 import streamlit as st
+import os
 import time
 import uuid
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
 import rag
+from writer import save_conversation, save_feedback, recover_spool
 from db import (
-    save_conversation,
-    save_feedback,
     get_recent_conversations,
     get_feedback_stats,
-    init_db,
-    verify_conversation_saved
+    ensure_schema,
 )
 import logging
 
@@ -21,15 +20,60 @@ logger = logging.getLogger(__name__)
 
 tz = ZoneInfo("Europe/Berlin")
 
+# The read-only panels are served from a cache shared by all sessions for PANEL_CACHE_TTL seconds and
+# re-render on their own every PANEL_REFRESH_SECONDS, without rerunning the rest of the page
+PANEL_CACHE_TTL = int(os.getenv("PANEL_CACHE_TTL", "10"))
+PANEL_REFRESH_SECONDS = int(os.getenv("PANEL_REFRESH_SECONDS", "30"))
+
 def print_log(message):
     print(message, flush=True)
 
+
+@st.cache_data(ttl=PANEL_CACHE_TTL, show_spinner=False)
+def load_recent_conversations(limit, relevance):
+    return [dict(conv) for conv in get_recent_conversations(limit=limit, relevance=relevance)]
+
+
+@st.cache_data(ttl=PANEL_CACHE_TTL, show_spinner=False)
+def load_feedback_stats():
+    return dict(get_feedback_stats())
+
+
+@st.fragment(run_every=PANEL_REFRESH_SECONDS)
+def recent_conversations_panel():
+    st.subheader("Recent Conversations")
+    relevance_filter = st.selectbox(
+        "Filter by relevance:",
+        ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"]
+    )
+    recent_conversations = load_recent_conversations(
+        limit=3,
+        relevance=relevance_filter if relevance_filter != "All" else None
+    )
+    for conv in recent_conversations:
+        st.write(f"Q: {conv['question']}")
+        st.write(f"A: {conv['answer']}")
+        st.write(f"Relevance: {conv['relevance']}")
+        st.write(f"Model: {conv['model_used']}")
+        st.write("---")
+
+
+@st.fragment(run_every=PANEL_REFRESH_SECONDS)
+def feedback_stats_panel():
+    feedback_stats = load_feedback_stats()
+    st.subheader("Feedback Statistics")
+    st.write(f"Thumbs up: {feedback_stats['thumbs_up']}")
+    st.write(f"Thumbs down: {feedback_stats['thumbs_down']}")
+
+
 def main():
     print_log("Starting the Mental Health Assistant application")
     st.title("Mental Health Assistant")
 
-    # Initialize the database
-    init_db()
+    # Initialize the database once per process rather than on every rerun
+    ensure_schema()
+    # Rows a previous buffered-mode process spooled but never committed
+    recover_spool()
 
     # Session state initialization
     if "conversation_id" not in st.session_state:
@@ -80,14 +124,19 @@ def main():
         else:
             # Proceed with getting an answer from the assistant
             print_log(f"User asked: '{user_input}'")
-            with st.spinner("Processing..."):
-                print_log(f"Getting answer from assistant using {model_choice} model")
-                start_time = time.time()
-                answer_data = rag.rag(user_input, model=model_choice)
+            print_log(f"Getting answer from assistant using {model_choice} model")
+            start_time = time.time()
+            with st.spinner("Searching..."):
+                answer_stream = rag.rag_stream(
+                    user_input, model=model_choice, conversation_id=st.session_state.conversation_id
+                )
+            # Render the answer incrementally as tokens arrive
+            st.write_stream(answer_stream)
+            with st.spinner("Evaluating relevance..."):
+                answer_data = answer_stream.finish()
                 end_time = time.time()
                 print_log(f"Answer received in {end_time - start_time:.2f} seconds")
                 st.success("Completed!")
-                st.write(answer_data["answer"])
 
                 # Store the conversation in chat history
                 st.session_state.chat_history.append({
@@ -98,15 +147,21 @@ def main():
 
                 # Display monitoring information
                 st.write(f"Response time: {answer_data['response_time']:.2f} seconds")
+                if answer_data.get("time_to_first_token") is not None:
+                    st.write(f"Time to first token: {answer_data['time_to_first_token']:.2f} seconds")
+                if answer_data.get("tokens_per_second") is not None:
+                    st.write(f"Tokens per second: {answer_data['tokens_per_second']:.1f}")
                 st.write(f"Relevance: {answer_data['relevance']}")
                 st.write(f"Model used: {answer_data['model_used']}")
                 st.write(f"Total tokens: {answer_data['total_tokens']}")
 
                 # Save conversation to database
                 logger.debug(f"Attempting to save conversation: {st.session_state.conversation_id}")
-                save_conversation(st.session_state.conversation_id, user_input, answer_data)
-                logger.debug(f"Conversation saved. Verifying...")
-                verify_conversation_saved(st.session_state.conversation_id)
+                if save_conversation(st.session_state.conversation_id, user_input, answer_data):
+                    logger.debug(f"Conversation saved: {st.session_state.conversation_id}")
+                    load_recent_conversations.clear()
+                else:
+                    logger.error(f"Failed to save conversation: {st.session_state.conversation_id}")
 
 
 
@@ -125,6 +180,8 @@ def main():
         if st.button("+1"):
             if st.session_state.last_conversation_id and not st.session_state.feedback_given:
                 save_feedback(st.session_state.last_conversation_id, 1)
+                load_feedback_stats.clear()
+                load_recent_conversations.clear()
                 st.success("Positive feedback saved!")
                 st.session_state.feedback_given = True  # Mark feedback as given
                 st.session_state.last_conversation_id = None  # Clear last conversation
@@ -138,6 +195,8 @@ def main():
         if st.button("-1"):
             if st.session_state.last_conversation_id and not st.session_state.feedback_given:
                 save_feedback(st.session_state.last_conversation_id, -1)
+                load_feedback_stats.clear()
+                load_recent_conversations.clear()
                 st.success("Negative feedback saved!")
                 st.session_state.feedback_given = True  # Mark feedback as given
                 st.session_state.last_conversation_id = None  # Clear last conversation
@@ -164,27 +223,10 @@ def main():
             st.write("---")
 
     # Display recent conversations
-    st.subheader("Recent Conversations")
-    relevance_filter = st.selectbox(
-        "Filter by relevance:",
-        ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT"]
-    )
-    recent_conversations = get_recent_conversations(
-        limit=3,
-        relevance=relevance_filter if relevance_filter != "All" else None
-    )
-    for conv in recent_conversations:
-        st.write(f"Q: {conv['question']}")
-        st.write(f"A: {conv['answer']}")
-        st.write(f"Relevance: {conv['relevance']}")
-        st.write(f"Model: {conv['model_used']}")
-        st.write("---")
+    recent_conversations_panel()
 
     # Display feedback stats
-    feedback_stats = get_feedback_stats()
-    st.subheader("Feedback Statistics")
-    st.write(f"Thumbs up: {feedback_stats['thumbs_up']}")
-    st.write(f"Thumbs down: {feedback_stats['thumbs_down']}")
+    feedback_stats_panel()
 
     # Generate a new conversation ID for the next question
     st.session_state.conversation_id = str(uuid.uuid4())
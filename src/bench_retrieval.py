@@ -0,0 +1,380 @@
+"""
+Retrieval benchmark: indexes dataset/data.csv, runs every question of dataset/ground_truth_data.csv
+through one search configuration and reports quality (hit rate, MRR), the size of the prompt context
+the results would make, latency percentiles, throughput, fit time and memory as JSON.
+
+Each scale runs in a fresh interpreter so that memory figures are not polluted by earlier runs.
+Scales above 1 add synthetic distractor documents, drawn from the corpus vocabulary with realistic
+lengths, to grow the corpus 10x, 100x, ... while keeping the same ground truth.
+
+    python bench_retrieval.py
+    python bench_retrieval.py --variant postings --boost Questions=3 --boost Answers=0.5
+    python bench_retrieval.py --variant batch --scale 1 10 100 1000 --output bench.json
+    python bench_retrieval.py --variant passages --passage-tokens 120 --passages-per-parent 2
+    python bench_retrieval.py --variant embedding --dims 128 --n-probe 1 2 4 8 16 --scale 1 10 100
+
+Variants that must rank exactly like a plain Index (dense, postings, batch, sharded) are also checked against one
+on unfiltered queries, keyword-filtered queries and a filter matching no document; the run exits with
+status 1 if any of them differ. Their runs also check that deleting every document and compacting, in the
+foreground and in the background, leaves an empty index that searches return nothing from and that takes
+new documents again.
+
+The embedding and hybrid variants also report a recall-vs-latency curve with one point per --n-probe:
+recall@k against exact search (every IVF list probed), hit rate, MRR and latency.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import context
+import ingest
+import minsearch
+
+GROUND_TRUTH_PATH = os.getenv(
+    "GROUND_TRUTH_PATH", os.path.join(os.path.dirname(ingest.DATA_PATH), "ground_truth_data.csv")
+)
+
+VARIANTS = ["dense", "postings", "batch", "sharded", "passages", "embedding", "hybrid"]
+EMBEDDING_VARIANTS = ("embedding", "hybrid")
+EXACT_VARIANTS = ("dense", "postings", "batch", "sharded")
+
+
+def load_ground_truth(path):
+    import pandas as pd
+
+    return pd.read_csv(path).to_dict(orient="records")
+
+
+def synthesize(docs, scale, seed=42):
+    """Return `docs` plus (scale - 1) * len(docs) distractors with fresh ids and resampled words."""
+    if scale <= 1:
+        return list(docs)
+
+    rng = np.random.default_rng(seed)
+    next_id = max(doc["Question_ID"] for doc in docs) + 1
+    vocabularies = {field: np.array(" ".join(str(doc[field]) for doc in docs).split()) for field in ingest.TEXT_FIELDS}
+    lengths = {field: np.array([len(str(doc[field]).split()) for doc in docs]) for field in ingest.TEXT_FIELDS}
+
+    synthetic = list(docs)
+    for i in range((scale - 1) * len(docs)):
+        doc = {"Question_ID": next_id + i}
+        template = rng.integers(len(docs))
+        for field in ingest.TEXT_FIELDS:
+            words = rng.choice(vocabularies[field], size=lengths[field][template])
+            doc[field] = " ".join(words)
+        synthetic.append(doc)
+    return synthetic
+
+
+def build(variant, docs, args):
+    if variant == "sharded":
+        index = minsearch.ShardedIndex(ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS, num_shards=args.shards)
+    elif variant == "passages":
+        index = minsearch.PassageIndex(
+            ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS, parent_field="Question_ID", passage_field="Answers",
+            aggregation=args.aggregation, passages_per_parent=args.passages_per_parent,
+        )
+        docs = [passage for doc in docs for passage in ingest.split_passages(doc, args.passage_tokens)]
+    elif variant in EMBEDDING_VARIANTS:
+        index = minsearch.Index(ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS, embedding_params={
+            "dims": args.dims, "n_lists": args.n_lists, "hybrid_weight": args.hybrid_weight, "seed": args.seed,
+        })
+    else:
+        index = minsearch.Index(ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS)
+    return index.fit(docs)
+
+
+def run_queries(variant, index, questions, boost_dict, num_results, batch_size, n_probe=None):
+    """Return the result documents of every question and the latency of every call, in seconds."""
+    results, latencies = [], []
+
+    if variant == "batch":
+        for start in range(0, len(questions), batch_size):
+            chunk = questions[start:start + batch_size]
+            t0 = time.perf_counter()
+            batch = index.search_batch(chunk, boost_dict=boost_dict, num_results=num_results)
+            latencies.append(time.perf_counter() - t0)
+            results.extend(batch)
+    else:
+        engine = variant if variant in ("postings",) + EMBEDDING_VARIANTS else "dense"
+        options = {"n_probe": n_probe} if variant in EMBEDDING_VARIANTS else {}
+        for question in questions:
+            t0 = time.perf_counter()
+            docs = index.search(question, boost_dict=boost_dict, num_results=num_results, engine=engine, **options)
+            latencies.append(time.perf_counter() - t0)
+            results.append(docs)
+
+    return results, latencies
+
+
+def quality(expected_ids, result_ids):
+    hits, reciprocal_ranks = 0, 0.0
+    for expected, ids in zip(expected_ids, result_ids):
+        if expected in ids:
+            hits += 1
+            reciprocal_ranks += 1 / (ids.index(expected) + 1)
+    return {"hit_rate": hits / len(expected_ids), "mrr": reciprocal_ranks / len(expected_ids)}
+
+
+def filter_cases(docs, seed):
+    """Filters the exact variants are checked with: none, a set of ids, its negation and an id no document has."""
+    rng = np.random.default_rng(seed)
+    all_ids = [doc["Question_ID"] for doc in docs]
+    ids = sorted(int(i) for i in rng.choice(all_ids, size=min(20, len(docs)), replace=False))
+    return {
+        "unfiltered": {},
+        "filtered": {"Question_ID": ids},
+        "negated": {"Question_ID": {"not": ids}},
+        "no_match": {"Question_ID": -1},
+    }
+
+
+def check_exact(args, index, docs, questions, boost_dict):
+    """Share of the queries, per filter case, whose results equal those of a plain dense Index."""
+    reference = index
+    if args.variant != "dense":
+        reference = minsearch.Index(ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS).fit(docs)
+    questions = questions[:args.check_queries]
+
+    shares = {}
+    for name, filter_dict in filter_cases(docs, args.seed).items():
+        if args.variant == "batch":
+            results = index.search_batch(
+                questions, [filter_dict] * len(questions), boost_dict=boost_dict, num_results=args.num_results
+            )
+        else:
+            engine = "postings" if args.variant == "postings" else "dense"
+            results = [
+                index.search(question, filter_dict, boost_dict, args.num_results, engine=engine)
+                for question in questions
+            ]
+        matches = 0
+        for question, docs_found in zip(questions, results):
+            expected = reference.search(question, filter_dict, boost_dict, args.num_results)
+            matches += [doc["Question_ID"] for doc in docs_found] == [doc["Question_ID"] for doc in expected]
+        shares[name] = matches / len(questions)
+    return shares
+
+
+def check_updates(docs, engine):
+    """Delete every document, compact and add documents back; returns whether each step behaved."""
+    docs = docs[:20]
+    checks = {}
+    for background in (False, True):
+        index = minsearch.Index(ingest.TEXT_FIELDS, ingest.KEYWORD_FIELDS).fit(docs)
+        for doc_id in range(len(docs)):
+            index.delete_document(doc_id)
+        mapping = index.compact(background=True).result() if background else index.compact()
+        name = "background_compact_all_deleted" if background else "compact_all_deleted"
+        checks[name] = bool((mapping == -1).all()) and not index.docs and not index.search(
+            docs[0]["Questions"], engine=engine
+        )
+
+    index.add_documents(docs[:3])
+    found = index.search(docs[1]["Questions"], num_results=1, engine=engine)
+    checks["add_after_empty"] = [doc["Question_ID"] for doc in found] == [docs[1]["Question_ID"]]
+    return checks
+
+
+def recall(exact_ids, result_ids):
+    """Mean share of the exact search results that the approximate search also returned."""
+    shares = [len(set(exact) & set(ids)) / len(exact) for exact, ids in zip(exact_ids, result_ids) if exact]
+    return float(np.mean(shares)) if shares else 1.0
+
+
+def latency_ms(latencies):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "mean": float(latencies_ms.mean()),
+        "p50": float(np.percentile(latencies_ms, 50)),
+        "p95": float(np.percentile(latencies_ms, 95)),
+        "p99": float(np.percentile(latencies_ms, 99)),
+    }
+
+
+def recall_curve(args, index, questions, expected_ids, boost_dict):
+    """One point per --n-probe, measured against exact search over every IVF list."""
+    n_lists = index.ann.n_lists
+    exact, _ = run_queries(args.variant, index, questions, boost_dict, args.num_results, args.batch_size, n_lists)
+    exact_ids = [[doc["Question_ID"] for doc in docs] for docs in exact]
+
+    curve = []
+    for n_probe in sorted({min(n_probe, n_lists) for n_probe in args.n_probe} | {n_lists}):
+        results, latencies = run_queries(
+            args.variant, index, questions, boost_dict, args.num_results, args.batch_size, n_probe
+        )
+        result_ids = [[doc["Question_ID"] for doc in docs] for docs in results]
+        curve.append({
+            "n_probe": n_probe,
+            "recall": recall(exact_ids, result_ids),
+            **quality(expected_ids, result_ids),
+            "latency_ms": {name: value for name, value in latency_ms(latencies).items() if name in ("p50", "p95")},
+        })
+    return curve
+
+
+def context_size(expected_ids, results):
+    """Tokens of the prompt context the results would make, and the share of them from the expected document."""
+    totals, relevant = [], 0
+    for expected, docs in zip(expected_ids, results):
+        tokens = [context.count_tokens(context.entry_template.format(**doc)) for doc in docs]
+        totals.append(sum(tokens))
+        relevant += sum(count for count, doc in zip(tokens, docs) if doc["Question_ID"] == expected)
+    return {
+        "mean_tokens": float(np.mean(totals)),
+        "p95_tokens": float(np.percentile(totals, 95)),
+        "relevant_token_share": relevant / sum(totals) if sum(totals) else 0.0,
+    }
+
+
+def index_bytes(index):
+    if isinstance(index, minsearch.ShardedIndex):
+        return None
+    if isinstance(index, minsearch.PassageIndex):
+        index = index.index
+    total = sum(
+        matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+        for matrix in index.text_matrices.values()
+    )
+    if index.embeddings is not None:
+        total += index.embeddings.nbytes + index.projection.nbytes + index.ann.list_vectors.nbytes
+    return total
+
+
+def benchmark(args, scale):
+    docs = synthesize(ingest.load_documents(args.data), scale, seed=args.seed)
+    ground_truth = load_ground_truth(args.ground_truth)
+    questions = [row["question"] for row in ground_truth]
+    expected_ids = [row["id"] for row in ground_truth]
+    boost_dict = dict(args.boost)
+
+    t0 = time.perf_counter()
+    index = build(args.variant, docs, args)
+    fit_seconds = time.perf_counter() - t0
+
+    n_probe = args.n_probe[0] if args.n_probe else None
+    curve = exact = updates = None
+    try:
+        run_queries(
+            args.variant, index, questions[:args.warmup], boost_dict, args.num_results, args.batch_size, n_probe
+        )
+        t0 = time.perf_counter()
+        results, latencies = run_queries(
+            args.variant, index, questions, boost_dict, args.num_results, args.batch_size, n_probe
+        )
+        total_seconds = time.perf_counter() - t0
+        matrix_bytes = index_bytes(index)
+        if args.variant in EMBEDDING_VARIANTS:
+            curve = recall_curve(args, index, questions, expected_ids, boost_dict)
+        if args.variant in EXACT_VARIANTS:
+            exact = check_exact(args, index, docs, questions, boost_dict)
+        if args.variant in ("dense", "postings", "batch"):
+            updates = check_updates(docs, "postings" if args.variant == "postings" else "dense")
+    finally:
+        if isinstance(index, minsearch.ShardedIndex):
+            index.close()
+
+    result_ids = [[doc["Question_ID"] for doc in docs] for docs in results]
+    return {
+        "scale": scale,
+        "documents": len(docs),
+        "queries": len(questions),
+        "quality": quality(expected_ids, result_ids),
+        "context": context_size(expected_ids, results),
+        "latency_ms": {"per": "batch" if args.variant == "batch" else "query", **latency_ms(latencies)},
+        "queries_per_second": len(questions) / total_seconds,
+        "fit_seconds": fit_seconds,
+        "memory_mb": {
+            # ru_maxrss is reported in kilobytes on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "index_matrices": matrix_bytes / 2**20 if matrix_bytes is not None else None,
+        },
+        "n_lists": index.ann.n_lists if curve is not None else None,
+        "recall_curve": curve,
+        "matches_dense": exact,
+        "updates": updates,
+    }
+
+
+def parse_boost(value):
+    field, _, weight = value.partition("=")
+    if field not in ingest.TEXT_FIELDS or not weight:
+        raise argparse.ArgumentTypeError(f"expected FIELD=WEIGHT with FIELD in {ingest.TEXT_FIELDS}")
+    return field, float(weight)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=ingest.DATA_PATH)
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--variant", choices=VARIANTS, default="dense")
+    parser.add_argument("--boost", type=parse_boost, action="append", default=[], metavar="FIELD=WEIGHT")
+    parser.add_argument("--num-results", type=int, default=10)
+    parser.add_argument("--scale", type=int, nargs="+", default=[1], help="corpus multipliers, e.g. 1 10 100 1000")
+    parser.add_argument("--batch-size", type=int, default=64, help="queries per call for the batch variant")
+    parser.add_argument("--shards", type=int, default=None, help="shards for the sharded variant")
+    parser.add_argument("--passage-tokens", type=int, default=ingest.PASSAGE_TOKENS, help="passage size for the passages variant")
+    parser.add_argument("--passages-per-parent", type=int, default=ingest.PASSAGES_PER_DOCUMENT)
+    parser.add_argument("--aggregation", choices=minsearch.AGGREGATIONS, default="max")
+    parser.add_argument("--dims", type=int, default=minsearch.EMBEDDING_DEFAULTS["dims"], help="embedding size")
+    parser.add_argument("--n-lists", type=int, default=None, help="IVF lists, defaults to sqrt(documents)")
+    parser.add_argument("--n-probe", type=int, nargs="+", default=[], help="IVF lists scanned per query; the first one is reported as the headline")
+    parser.add_argument("--hybrid-weight", type=float, default=minsearch.EMBEDDING_DEFAULTS["hybrid_weight"])
+    parser.add_argument("--check-queries", type=int, default=50, help="queries compared with a plain Index per filter case")
+    parser.add_argument("--warmup", type=int, default=10, help="untimed queries before measuring")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    if args.child:
+        print(json.dumps(benchmark(args, args.scale[0])))
+        return
+
+    runs = []
+    for scale in args.scale:
+        cmd = [sys.executable, os.path.abspath(__file__), *sys.argv[1:], "--child", "--scale", str(scale)]
+        out = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+
+    report = {
+        "config": {
+            "variant": args.variant,
+            "boost": dict(args.boost),
+            "num_results": args.num_results,
+            "batch_size": args.batch_size if args.variant == "batch" else None,
+            "shards": args.shards if args.variant == "sharded" else None,
+            "passage_tokens": args.passage_tokens if args.variant == "passages" else None,
+            "passages_per_parent": args.passages_per_parent if args.variant == "passages" else None,
+            "aggregation": args.aggregation if args.variant == "passages" else None,
+            "dims": args.dims if args.variant in EMBEDDING_VARIANTS else None,
+            "n_probe": args.n_probe if args.variant in EMBEDDING_VARIANTS else None,
+            "hybrid_weight": args.hybrid_weight if args.variant == "hybrid" else None,
+        },
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if any(share < 1 for run in runs for share in (run["matches_dense"] or {}).values()):
+        raise SystemExit(1)
+    if not all(ok for run in runs for ok in (run["updates"] or {}).values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Startup benchmark: runs every measurement in a fresh interpreter and reports, as JSON, how long it
+takes to import the app modules, to answer the first search (which loads the index) and to produce
+the first answer.
+
+    python bench_startup.py --runs 5 --model gemma2-9b-it
+    python bench_startup.py --no-answer --cold-index
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ["import_db", "import_rag", "first_search", "first_answer", "time_to_first_answer"]
+
+
+def measure(question, model, answer):
+    """Time each startup phase in this (fresh) process; returns seconds per phase."""
+    start = time.perf_counter()
+    timings = {}
+
+    t0 = time.perf_counter()
+    import db  # noqa: F401
+    timings["import_db"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    import rag
+    timings["import_rag"] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    rag.search(question)
+    timings["first_search"] = time.perf_counter() - t0
+
+    if answer:
+        t0 = time.perf_counter()
+        rag.rag(question, model=model)
+        timings["first_answer"] = time.perf_counter() - t0
+        timings["time_to_first_answer"] = time.perf_counter() - start
+    return timings
+
+
+def run_once(args, index_dir):
+    env = dict(os.environ, ANSWER_CACHE_BACKEND="none")
+    if index_dir is not None:
+        # Both granularities, so the cold run never finds a snapshot whichever one is configured
+        env["INDEX_PATH"] = os.path.join(index_dir, "index")
+        env["PASSAGE_INDEX_PATH"] = os.path.join(index_dir, "passage_index")
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", "--question", args.question, "--model", args.model]
+    if args.no_answer:
+        cmd.append("--no-answer")
+
+    t0 = time.perf_counter()
+    out = subprocess.run(cmd, env=env, capture_output=True, text=True, check=True).stdout
+    timings = json.loads(out.strip().splitlines()[-1])
+    timings["process_wall"] = time.perf_counter() - t0
+    return timings
+
+
+def summarize(runs):
+    summary = {}
+    for phase in PHASES + ["process_wall"]:
+        values = [run[phase] for run in runs if phase in run]
+        if values:
+            summary[phase] = {
+                "median": statistics.median(values),
+                "min": min(values),
+                "max": max(values),
+            }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--question", default="What is depression?")
+    parser.add_argument("--model", default="gemma2-9b-it")
+    parser.add_argument("--no-answer", action="store_true", help="skip the LLM call")
+    parser.add_argument("--cold-index", action="store_true", help="build the index instead of loading the snapshot")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure(args.question, args.model, not args.no_answer)))
+        return
+
+    runs = []
+    for _ in range(args.runs):
+        if args.cold_index:
+            with tempfile.TemporaryDirectory() as tmp:
+                runs.append(run_once(args, tmp))
+        else:
+            runs.append(run_once(args, None))
+
+    report = {
+        "config": {
+            "runs": args.runs,
+            "question": args.question,
+            "model": None if args.no_answer else args.model,
+            "cold_index": args.cold_index,
+        },
+        "seconds": summarize(runs),
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query(query):
+    """Fold case, punctuation and whitespace so trivially different phrasings share a cache key."""
+    query = _PUNCTUATION.sub(" ", query.lower())
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with hit/miss counters and version-based invalidation."""
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def set_version(self, version):
+        """Drop every entry if `version` differs from the one the entries were computed against."""
+        with self._lock:
+            if version != self._version:
+                self._data.clear()
+                self._version = version
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value, version=None):
+        """Store `value`; if `version` is given, skip values computed against an outdated version."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class SQLiteBackend:
+    """Local on-disk answer cache storage."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key, ttl):
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT value FROM answer_cache WHERE key = ? AND created_at > ?", (key, now - ttl)
+                ).fetchone()
+                if row is not None:
+                    conn.execute("UPDATE answer_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+    def put(self, key, value):
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO answer_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value), now, now),
+                )
+        finally:
+            conn.close()
+
+    def evict(self, max_entries, ttl):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM answer_cache WHERE created_at <= ?", (time.time() - ttl,))
+                conn.execute("""
+                    DELETE FROM answer_cache WHERE key NOT IN (
+                        SELECT key FROM answer_cache ORDER BY accessed_at DESC LIMIT ?
+                    )
+                """, (max_entries,))
+        finally:
+            conn.close()
+
+
+class PostgresBackend:
+    """Answer cache storage shared by every app instance through the conversations database."""
+
+    def __init__(self):
+        import db
+        self.db = db
+        conn = db.get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS answer_cache (
+                        key TEXT PRIMARY KEY,
+                        value JSONB NOT NULL,
+                        created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+                        accessed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                    )
+                """)
+            conn.commit()
+        finally:
+            self.db.release_db_connection(conn)
+
+    def get(self, key, ttl):
+        conn = self.db.get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE answer_cache SET accessed_at = now()
+                    WHERE key = %s AND created_at > now() - make_interval(secs => %s)
+                    RETURNING value
+                """, (key, ttl))
+                row = cur.fetchone()
+            conn.commit()
+            return row[0] if row else None
+        finally:
+            self.db.release_db_connection(conn)
+
+    def put(self, key, value):
+        conn = self.db.get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO answer_cache (key, value) VALUES (%s, %s)
+                    ON CONFLICT (key) DO UPDATE
+                    SET value = EXCLUDED.value, created_at = now(), accessed_at = now()
+                """, (key, json.dumps(value)))
+            conn.commit()
+        finally:
+            self.db.release_db_connection(conn)
+
+    def evict(self, max_entries, ttl):
+        conn = self.db.get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "DELETE FROM answer_cache WHERE created_at <= now() - make_interval(secs => %s)", (ttl,)
+                )
+                cur.execute("""
+                    DELETE FROM answer_cache WHERE key IN (
+                        SELECT key FROM answer_cache ORDER BY accessed_at DESC OFFSET %s
+                    )
+                """, (max_entries,))
+            conn.commit()
+        finally:
+            self.db.release_db_connection(conn)
+
+
+class _Flight:
+    """A computation in progress; ended with a value, an error or neither if its leader gave up."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add_done_callback(self, callback):
+        """Call `callback()` once the flight has ended, right away if it already has."""
+        with self._lock:
+            if not self.done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def end(self):
+        with self._lock:
+            self.done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    async def wait(self):
+        """Wait for the flight to end without blocking the event loop or a worker thread."""
+        loop = asyncio.get_running_loop()
+        ended = loop.create_future()
+        self.add_done_callback(
+            lambda: loop.call_soon_threadsafe(lambda: ended.done() or ended.set_result(None))
+        )
+        await ended
+
+
+class AnswerCache:
+    """
+    Persistent cache of full RAG answers with TTL, size-bounded eviction and coalescing of
+    concurrent identical requests, so only one LLM call per key is ever in flight.
+    """
+
+    # Expired and least recently used entries are purged once every this many writes
+    EVICT_EVERY = 100
+
+    def __init__(self, backend, ttl=86400, max_entries=10000):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._inflight = {}
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(question, model, doc_ids):
+        docs_hash = hashlib.sha256("\x1f".join(str(doc_id) for doc_id in doc_ids).encode()).hexdigest()
+        raw = "\x1e".join([normalize_query(question), model, docs_hash])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, key):
+        try:
+            return self.backend.get(key, self.ttl)
+        except Exception as e:
+            logger.error(f"Answer cache lookup failed: {e}")
+            return None
+
+    def put(self, key, value):
+        try:
+            self.backend.put(key, value)
+            with self._lock:
+                self._writes += 1
+                evict = self._writes % self.EVICT_EVERY == 0
+            if evict:
+                self.backend.evict(self.max_entries, self.ttl)
+        except Exception as e:
+            logger.error(f"Answer cache write failed: {e}")
+
+    def join(self, key):
+        """
+        Return `(flight, leader)` for computing `key`. The first caller is the leader and must end the
+        flight with `settle`; later callers until then get the same flight to wait for.
+        """
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+        return flight, leader
+
+    def settle(self, key, flight, value=None, error=None, store=True):
+        """
+        End a flight started by `join` with its value (stored if `store`) or error, releasing the callers
+        waiting for it. With neither, the flight is abandoned and they compute the value themselves.
+        """
+        try:
+            if value is not None and error is None and store:
+                self.put(key, value)
+        finally:
+            flight.value, flight.error = value, error
+            with self._lock:
+                if self._inflight.get(key) is flight:
+                    del self._inflight[key]
+            flight.end()
+
+    def get_or_compute(self, key, compute, should_cache=None):
+        """
+        Return `(value, cached)`. On a miss only one caller per key runs `compute`; concurrent callers
+        wait for its result, which counts as cached for them since they made no call of their own.
+        Values for which `should_cache(value)` is false are shared with those callers but not stored.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value, True
+
+        flight, leader = self.join(key)
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            if flight.value is None:
+                return self.get_or_compute(key, compute, should_cache)
+            return flight.value, True
+
+        value = error = None
+        try:
+            value = compute()
+            return value, False
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            store = value is not None and (should_cache is None or should_cache(value))
+            self.settle(key, flight, value, error, store=store)
+
+
+def create_answer_cache(backend, path=None, ttl=86400, max_entries=10000):
+    """Build an AnswerCache for the "disk" or "postgres" backend, or return None for "none"."""
+    if backend == "none":
+        return None
+    if backend == "disk":
+        return AnswerCache(SQLiteBackend(path), ttl=ttl, max_entries=max_entries)
+    if backend == "postgres":
+        return AnswerCache(PostgresBackend(), ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unknown answer cache backend: {backend}")
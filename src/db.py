@@ -1,6 +1,10 @@
 import os
+import time
+import threading
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2 import extensions
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 import logging
@@ -9,148 +13,386 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
-
 TZ_INFO = os.getenv("TZ", "Europe/Berlin")
 tz = ZoneInfo(TZ_INFO)
 
 
+# Connection pool limits: DB_POOL_MIN connections are opened up front and kept open when idle,
+# DB_POOL_MAX bounds concurrent connections per process, callers wait up to DB_POOL_TIMEOUT seconds
+# for a free one, and connections idle longer than DB_POOL_CHECK_AFTER seconds are pinged before use
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "4"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_CHECK_AFTER = float(os.getenv("DB_POOL_CHECK_AFTER", "30"))
+
+
+class ConnectionPool:
+    """Process-wide, thread-safe pool of Postgres connections with a size limit and health checks."""
+
+    def __init__(self, minconn, maxconn, timeout, check_after, **connect_kwargs):
+        self.timeout = timeout
+        self.check_after = check_after
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        # ThreadedConnectionPool fails instead of waiting when exhausted, so gate it with a semaphore
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"No database connection available after {self.timeout} seconds")
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                logger.warning("Discarding broken database connection")
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        try:
+            close = conn.closed or conn.get_transaction_status() == extensions.TRANSACTION_STATUS_UNKNOWN
+            if not close and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=close)
+        finally:
+            self._slots.release()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - self._last_used.get(id(conn), 0) < self.check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            try:
+                _pool = ConnectionPool(
+                    DB_POOL_MIN,
+                    DB_POOL_MAX,
+                    timeout=DB_POOL_TIMEOUT,
+                    check_after=DB_POOL_CHECK_AFTER,
+                    host=os.getenv("POSTGRES_HOST", "localhost"),
+                    database=os.getenv("POSTGRES_DB", "mental_health"),
+                    user=os.getenv("POSTGRES_USER", "newton"),
+                    password=os.getenv("POSTGRES_PASSWORD", "Admin"),
+                )
+                logger.info("Successfully connected to the database")
+            except Exception as e:
+                logger.error(f"Error connecting to the database: {e}")
+                raise
+        return _pool
+
+
 def get_db_connection():
+    """Check a connection out of the pool; hand it back with release_db_connection()."""
+    return get_pool().getconn()
+
+
+def release_db_connection(conn):
+    get_pool().putconn(conn)
+
+
+# Serializes migrations across processes that start at the same time
+MIGRATION_LOCK_ID = 4242
+
+
+def schema_version(cur):
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+    return cur.fetchone()[0]
+
+
+def migrate(target=None):
+    """Apply pending migrations up to `target` (default: all), each once; returns the schema version."""
+    from migrations import MIGRATIONS
+
+    conn = get_db_connection()
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            database=os.getenv("POSTGRES_DB", "mental_health"),
-            user=os.getenv("POSTGRES_USER", "newton"),
-            password=os.getenv("POSTGRES_PASSWORD", "Admin"),
-        )
-        logger.info("Successfully connected to the database")
-        return conn
-    except Exception as e:
-        logger.error(f"Error connecting to the database: {e}")
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                )
+            """)
+            conn.commit()
+
+            for migration in MIGRATIONS:
+                if target is not None and migration.version > target:
+                    break
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                if migration.version <= schema_version(cur):
+                    conn.rollback()
+                    continue
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                for statement in migration.statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (migration.version, migration.description),
+                )
+                conn.commit()
+
+            version = schema_version(cur)
+        conn.commit()
+        return version
+    except Exception:
+        conn.rollback()
         raise
+    finally:
+        release_db_connection(conn)
 
 
-def init_db():
+def backfill_rollups():
+    """Rebuild the dashboard rollup tables from the raw conversations and feedback rows."""
+    from migrations import ROLLUP_BACKFILL
+
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            # Check if tables exist
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'conversations')")
-            conversations_exists = cur.fetchone()[0]
-            cur.execute("SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = 'feedback')")
-            feedback_exists = cur.fetchone()[0]
-            
-            if not conversations_exists:
-                logger.info("Creating conversations table")
-                cur.execute("""
-                    CREATE TABLE conversations (
-                        id TEXT PRIMARY KEY,
-                        question TEXT NOT NULL,
-                        answer TEXT NOT NULL,
-                        model_used TEXT NOT NULL,
-                        response_time FLOAT NOT NULL,
-                        relevance TEXT NOT NULL,
-                        relevance_explanation TEXT NOT NULL,
-                        prompt_tokens INTEGER NOT NULL,
-                        completion_tokens INTEGER NOT NULL,
-                        total_tokens INTEGER NOT NULL,
-                        eval_prompt_tokens INTEGER NOT NULL,
-                        eval_completion_tokens INTEGER NOT NULL,
-                        eval_total_tokens INTEGER NOT NULL,
-                        timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                    )
-                """)
-            
-            if not feedback_exists:
-                logger.info("Creating feedback table")
-                cur.execute("""
-                    CREATE TABLE feedback (
-                        id SERIAL PRIMARY KEY,
-                        conversation_id TEXT REFERENCES conversations(id),
-                        feedback INTEGER NOT NULL,
-                        timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                    )
-                """)
-            
-            conn.commit()
-            logger.info("Database tables initialized successfully")
-    except Exception as e:
-        logger.error(f"Error initializing database: {e}")
+            # Hold off writers so no row is counted both by a trigger and by the rebuild
+            cur.execute("LOCK TABLE conversations, feedback IN SHARE MODE")
+            for statement in ROLLUP_BACKFILL:
+                cur.execute(statement)
+        conn.commit()
+        logger.info("Rollup tables rebuilt")
+    except Exception:
         conn.rollback()
+        raise
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
-def save_conversation(conversation_id, question, answer_data, timestamp=None):
+def init_db():
+    try:
+        version = migrate()
+        logger.info(f"Database schema is at version {version}")
+        return True
+    except Exception as e:
+        logger.error(f"Error initializing database: {e}")
+        return False
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema():
+    """Run init_db() until it has succeeded once in this process; later calls return immediately."""
+    global _schema_ready
+    if not _schema_ready:
+        with _schema_lock:
+            if not _schema_ready:
+                _schema_ready = init_db()
+
+
+CONVERSATION_COLUMNS = (
+    "id", "question", "answer", "model_used", "response_time", "relevance",
+    "relevance_explanation", "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "timestamp", "cached",
+    "time_to_first_token", "tokens_per_second",
+)
+
+
+def conversation_row(conversation_id, question, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data["relevance"].upper(),  # Ensure it's uppercase
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        timestamp,
+        answer_data.get("cached", False),
+        answer_data.get("time_to_first_token"),
+        answer_data.get("tokens_per_second"),
+    )
 
+
+def feedback_row(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+    return (conversation_id, feedback, timestamp)
+
+
+def save_conversation(conversation_id, question, answer_data, timestamp=None):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             logger.debug(f"Saving conversation: {conversation_id}")
             logger.debug(f"Question: {question}")
             logger.debug(f"Answer data: {answer_data}")
+            cur.execute(
+                f"""
+                INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+                VALUES ({", ".join(["%s"] * len(CONVERSATION_COLUMNS))})
+                RETURNING id
+                """,
+                conversation_row(conversation_id, question, answer_data, timestamp),
+            )
+            # RETURNING confirms the write in the same round trip
+            saved = cur.fetchone() is not None
+        conn.commit()
+        logger.info(f"Successfully saved conversation: {conversation_id}")
+        return saved
+    except Exception as e:
+        logger.error(f"Error saving conversation: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_db_connection(conn)
+
+
+def save_rows(conversation_rows, feedback_rows, page_size=500):
+    """
+    Write conversation_row() and feedback_row() tuples with multi-row INSERTs in one transaction and
+    return how many of each were inserted. Conversations go first so feedback on them in the same
+    batch finds its parent. Rows that are already stored, and feedback on unknown conversations, are
+    skipped, so replaying a batch is harmless.
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            saved_conversations = saved_feedback = 0
+            if conversation_rows:
+                saved_conversations = len(execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)}) VALUES %s
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING id
+                    """,
+                    conversation_rows,
+                    page_size=page_size,
+                    fetch=True,
+                ))
+            if feedback_rows:
+                # Feedback has no natural key, so (conversation_id, timestamp) identifies a replayed row
+                saved_feedback = len(execute_values(
+                    cur,
+                    """
+                    INSERT INTO feedback (conversation_id, feedback, timestamp)
+                    SELECT v.conversation_id, v.feedback, v.timestamp
+                    FROM (VALUES %s) AS v (conversation_id, feedback, timestamp)
+                    WHERE EXISTS (SELECT 1 FROM conversations c WHERE c.id = v.conversation_id)
+                    AND NOT EXISTS (
+                        SELECT 1 FROM feedback f
+                        WHERE f.conversation_id = v.conversation_id AND f.timestamp = v.timestamp
+                    )
+                    RETURNING id
+                    """,
+                    feedback_rows,
+                    template="(%s, %s::integer, %s::timestamptz)",
+                    page_size=page_size,
+                    fetch=True,
+                ))
+        conn.commit()
+        logger.info(f"Saved {saved_conversations} conversations and {saved_feedback} feedback rows")
+        return saved_conversations, saved_feedback
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+
+def update_conversation_relevance(conversation_id, answer_data):
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
             cur.execute(
                 """
-                INSERT INTO conversations 
-                (id, question, answer, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                UPDATE conversations
+                SET relevance = %s, relevance_explanation = %s,
+                    eval_prompt_tokens = %s, eval_completion_tokens = %s, eval_total_tokens = %s
+                WHERE id = %s
+                RETURNING id
                 """,
                 (
-                    conversation_id,
-                    question,
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"].upper(),  # Ensure it's uppercase
+                    answer_data["relevance"].upper(),
                     answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
                     answer_data["eval_prompt_tokens"],
                     answer_data["eval_completion_tokens"],
                     answer_data["eval_total_tokens"],
-                    timestamp
+                    conversation_id,
                 ),
             )
+            updated = cur.fetchone() is not None
         conn.commit()
-        logger.info(f"Successfully saved conversation: {conversation_id}")
+        if updated:
+            logger.info(f"Updated relevance for conversation: {conversation_id}")
+        else:
+            logger.warning(f"No conversation to update relevance for: {conversation_id}")
+        return updated
     except Exception as e:
-        logger.error(f"Error saving conversation: {e}")
+        logger.error(f"Error updating conversation relevance: {e}")
         conn.rollback()
+        return False
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def save_feedback(conversation_id, feedback, timestamp=None):
-    if timestamp is None:
-        timestamp = datetime.now(tz)
+    conversation_id, feedback, timestamp = feedback_row(conversation_id, feedback, timestamp)
 
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            # Check if the conversation exists
-            cur.execute("SELECT id FROM conversations WHERE id = %s", (conversation_id,))
-            if cur.fetchone() is None:
-                logger.warning(f"Attempted to save feedback for non-existent conversation: {conversation_id}")
-                return  # Or handle this case as appropriate for your application
-
             logger.info(f"Attempting to save feedback: conversation_id={conversation_id}, feedback={feedback}, timestamp={timestamp}")
+            # Insert only if the conversation exists, confirming the write in the same statement
             cur.execute(
-                "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES (%s, %s, %s)",
-                (conversation_id, feedback, timestamp),
+                """
+                INSERT INTO feedback (conversation_id, feedback, timestamp)
+                SELECT %s, %s, %s
+                WHERE EXISTS (SELECT 1 FROM conversations WHERE id = %s)
+                RETURNING id
+                """,
+                (conversation_id, feedback, timestamp, conversation_id),
             )
+            saved = cur.fetchone() is not None
         conn.commit()
+        if not saved:
+            logger.warning(f"Attempted to save feedback for non-existent conversation: {conversation_id}")
+            return False
         logger.info(f"Feedback saved successfully for conversation {conversation_id}")
+        return True
     except Exception as e:
         logger.error(f"Error saving feedback: {e}")
         conn.rollback()
         raise
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def get_recent_conversations(limit=5, relevance=None):
     conn = get_db_connection()
@@ -179,22 +421,58 @@ def get_recent_conversations(limit=5, relevance=None):
         logger.error(f"Error in get_recent_conversations: {e}")
         return []
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 def get_feedback_stats():
+    """Thumbs up/down totals, read from the trigger-maintained feedback_counters table."""
     conn = get_db_connection()
     try:
         with conn.cursor(cursor_factory=DictCursor) as cur:
             cur.execute("""
                 SELECT 
-                    SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
-                    SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
-                FROM feedback
+                    COALESCE(SUM(thumbs_up), 0)::BIGINT as thumbs_up,
+                    COALESCE(SUM(thumbs_down), 0)::BIGINT as thumbs_down
+                FROM feedback_counters
             """)
             return cur.fetchone()
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+
+def reconcile_feedback_counters():
+    """Recompute feedback_counters from the feedback table; returns how many counter rows had drifted."""
+    from migrations import FEEDBACK_COUNTS_QUERY, FEEDBACK_COUNTERS_REBUILD
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # Hold off writers so the counters cannot change between the comparison and the rebuild
+            cur.execute("LOCK TABLE conversations, feedback IN SHARE MODE")
+            cur.execute(f"""
+                SELECT model_used, relevance,
+                    fc.thumbs_up, fc.thumbs_down, actual.thumbs_up, actual.thumbs_down
+                FROM feedback_counters fc
+                FULL JOIN ({FEEDBACK_COUNTS_QUERY}) AS actual USING (model_used, relevance)
+                WHERE (COALESCE(fc.thumbs_up, 0), COALESCE(fc.thumbs_down, 0))
+                    <> (COALESCE(actual.thumbs_up, 0), COALESCE(actual.thumbs_down, 0))
+            """)
+            drifted = cur.fetchall()
+            for model_used, relevance, up, down, actual_up, actual_down in drifted:
+                logger.warning(
+                    f"Feedback counters for {model_used}/{relevance} were {up}/{down}, "
+                    f"recomputed as {actual_up}/{actual_down}"
+                )
+            for statement in FEEDBACK_COUNTERS_REBUILD:
+                cur.execute(statement)
+        conn.commit()
+        logger.info(f"Feedback counters reconciled, {len(drifted)} rows corrected")
+        return len(drifted)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
 
 
 def check_timezone():
@@ -215,7 +493,7 @@ def check_timezone():
             py_time = datetime.now(tz)
             print(f"Python current time: {py_time}")
 
-            # Use py_time instead of tz for insertion
+            # Round-trip a test row inside a transaction that is rolled back, so nothing is left behind
             cur.execute("""
                 INSERT INTO conversations 
                 (id, question, answer, model_used, response_time, relevance, 
@@ -224,8 +502,8 @@ def check_timezone():
                 VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
                 RETURNING timestamp;
             """, 
-            ('test', 'test question', 'test answer', 'test model', 0.0, 0.0, 
-             'test explanation', 0, 0, 0, 0, 0, 0, 0.0, py_time))
+            ('test', 'test question', 'test answer', 'test model', 0.0, 'test',
+             'test explanation', 0, 0, 0, 0, 0, 0, py_time))
 
             inserted_time = cur.fetchone()[0]
             print(f"Inserted time (UTC): {inserted_time}")
@@ -235,15 +513,11 @@ def check_timezone():
             selected_time = cur.fetchone()[0]
             print(f"Selected time (UTC): {selected_time}")
             print(f"Selected time ({TZ_INFO}): {selected_time.astimezone(tz)}")
-
-            # Clean up the test entry
-            cur.execute("DELETE FROM conversations WHERE id = 'test';")
-            conn.commit()
     except Exception as e:
         print(f"An error occurred: {e}")
-        conn.rollback()
     finally:
-        conn.close()
+        conn.rollback()
+        release_db_connection(conn)
 
 def verify_conversation_saved(conversation_id):
     conn = get_db_connection()
@@ -258,7 +532,7 @@ def verify_conversation_saved(conversation_id):
     except Exception as e:
         logger.error(f"Error verifying conversation: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
 def verify_feedback_saved(conversation_id):
     conn = get_db_connection()
     try:
@@ -272,8 +546,24 @@ def verify_feedback_saved(conversation_id):
     except Exception as e:
         logger.error(f"Error verifying feedback: {e}")
     finally:
-        conn.close()
+        release_db_connection(conn)
+
+
+if __name__ == "__main__":
+    import argparse
 
+    parser = argparse.ArgumentParser(description="Database maintenance and diagnostics")
+    parser.add_argument("command", choices=["init", "migrate", "backfill-rollups", "reconcile-feedback-counters", "check-timezone"])
+    parser.add_argument("--target", type=int, help="migrate: stop at this schema version")
+    args = parser.parse_args()
 
-if RUN_TIMEZONE_CHECK:
-    check_timezone()
\ No newline at end of file
+    if args.command == "init":
+        init_db()
+    elif args.command == "migrate":
+        print(f"Schema version: {migrate(args.target)}")
+    elif args.command == "backfill-rollups":
+        backfill_rollups()
+    elif args.command == "reconcile-feedback-counters":
+        reconcile_feedback_counters()
+    elif args.command == "check-timezone":
+        check_timezone()
@@ -0,0 +1,242 @@
+"""
+RAG evaluation runner: answers every ground-truth question with the given model, has the LLM judge
+rate each answer's relevance and writes the same CSV as notebooks/rag_evaluation.ipynb
+(answer,id,question,relevance,explanation) plus per-row latency and token counts.
+
+Rows are generated and judged concurrently, bounded by --concurrency. Every finished row is appended
+to a JSONL checkpoint next to the output, so an interrupted run (crash, Ctrl-C, rate limits) resumes
+where it stopped when started again with the same arguments. Judgments are cached by
+(judge model, question, answer), so re-judging unchanged answers costs nothing.
+
+    python evaluate.py --model llama-3.1-70b-versatile --output ../dataset/rag_eval_llama.csv
+    python evaluate.py --model mixtral-8x7b-32768 --concurrency 16 --output ../dataset/rag-eval-mistral.csv
+    python evaluate.py --answers ../dataset/rag_eval_llama.csv --judge-model gemma2-9b-it --output rejudged.csv
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import cache
+import ingest
+import rag
+
+GROUND_TRUTH_PATH = os.getenv(
+    "GROUND_TRUTH_PATH", os.path.join(os.path.dirname(ingest.DATA_PATH), "ground_truth_data.csv")
+)
+JUDGE_CACHE_PATH = os.getenv(
+    "JUDGE_CACHE_PATH", os.path.join(os.path.dirname(ingest.DATA_PATH), "judge_cache.sqlite")
+)
+JUDGE_CACHE_TTL = int(os.getenv("JUDGE_CACHE_TTL", str(90 * 86400)))
+
+CSV_COLUMNS = [
+    "answer", "id", "question", "relevance", "explanation",
+    "response_time", "judge_time", "prompt_tokens", "completion_tokens", "total_tokens", "prompt_tokens_saved",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "judge_cached",
+]
+NO_TOKENS = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+
+def row_key(record):
+    # Several questions share a document id, so the question is part of the key
+    return f"{record['id']}\x1f{record['question']}"
+
+
+def judgment_key(judge_model, question, answer):
+    raw = "\x1e".join([judge_model, question, answer])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def load_checkpoint(path):
+    """Return the rows already finished, by row key; a torn last line from a crash is ignored."""
+    rows = {}
+    if not os.path.exists(path):
+        return rows
+    with open(path) as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            rows[row_key(row)] = row
+    return rows
+
+
+class Checkpoint:
+    """Append-only JSONL file with one line per finished row, synced to disk as each row completes."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "a+")
+        # Terminate a line torn by a crash so the next row starts on a line of its own
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != "\n":
+                self._file.write("\n")
+
+    def write(self, row):
+        self._file.write(json.dumps(row) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class Evaluator:
+    def __init__(self, model, judge_model, judge_cache, checkpoint, concurrency):
+        self.model = model
+        self.judge_model = judge_model
+        self.judge_cache = judge_cache
+        self.checkpoint = checkpoint
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.done = 0
+        self.judge_cache_hits = 0
+        self.errors = {}
+
+    async def generate(self, question):
+        search_results = await asyncio.to_thread(rag.search, question)
+        prompt_stats = {}
+        prompt = rag.build_prompt(question, search_results, model=self.model, stats=prompt_stats)
+        answer, tokens, response_time = await rag.allm(prompt, model=self.model)
+        return answer, dict(tokens, prompt_tokens_saved=prompt_stats["tokens_saved"]), response_time
+
+    async def judge(self, question, answer):
+        """Return (relevance, explanation, eval_tokens, seconds, cached)."""
+        key = judgment_key(self.judge_model, question, answer)
+        if self.judge_cache is not None:
+            cached = await asyncio.to_thread(self.judge_cache.get, key)
+            if cached is not None:
+                return cached["relevance"], cached["explanation"], NO_TOKENS, 0.0, True
+
+        start = time.time()
+        relevance, explanation, eval_tokens = await rag.aevaluate_relevance(question, answer, model=self.judge_model)
+        judge_time = time.time() - start
+        if self.judge_cache is not None and explanation != "Failed to parse evaluation":
+            await asyncio.to_thread(
+                self.judge_cache.put, key, {"relevance": relevance, "explanation": explanation}
+            )
+        return relevance, explanation, eval_tokens, judge_time, False
+
+    async def evaluate(self, record, answer=None):
+        async with self.semaphore:
+            try:
+                if answer is None:
+                    answer, tokens, response_time = await self.generate(record["question"])
+                else:
+                    tokens, response_time = dict(NO_TOKENS, prompt_tokens_saved=0), 0.0
+                relevance, explanation, eval_tokens, judge_time, judge_cached = await self.judge(
+                    record["question"], answer
+                )
+            except Exception as e:
+                # Left out of the checkpoint, so the next run retries it
+                name = type(e).__name__
+                self.errors[name] = self.errors.get(name, 0) + 1
+                return None
+
+        row = {
+            "answer": answer,
+            "id": record["id"],
+            "question": record["question"],
+            "relevance": relevance,
+            "explanation": explanation,
+            "response_time": response_time,
+            "judge_time": judge_time,
+            **tokens,
+            **{f"eval_{name}": count for name, count in eval_tokens.items()},
+            "judge_cached": judge_cached,
+        }
+        self.checkpoint.write(row)
+        self.done += 1
+        self.judge_cache_hits += judge_cached
+        return row
+
+
+async def run(evaluator, records, answers):
+    tasks = [evaluator.evaluate(record, answers.get(row_key(record))) for record in records]
+    return [row for row in await asyncio.gather(*tasks) if row is not None]
+
+
+def write_csv(path, records, rows):
+    import pandas as pd
+
+    # Ground-truth order, whatever order the rows finished in
+    ordered = [rows[row_key(record)] for record in records if row_key(record) in rows]
+    pd.DataFrame(ordered, columns=CSV_COLUMNS).to_csv(path, index=False)
+    return ordered
+
+
+def summarize(rows):
+    counts = {}
+    for row in rows:
+        counts[row["relevance"]] = counts.get(row["relevance"], 0) + 1
+    return {
+        "relevance": counts,
+        "relevance_share": {name: count / len(rows) for name, count in counts.items()} if rows else {},
+        "tokens": sum(row["total_tokens"] + row["eval_total_tokens"] for row in rows),
+    }
+
+
+def main():
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="mixtral-8x7b-32768", help="model that answers the questions")
+    parser.add_argument("--judge-model", help="model that rates the answers, defaults to --model")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--output", required=True, help="CSV to write, e.g. ../dataset/rag_eval_llama.csv")
+    parser.add_argument("--checkpoint", help="JSONL checkpoint, defaults to <output>.checkpoint.jsonl")
+    parser.add_argument("--answers", help="re-judge the answers of an earlier evaluation CSV instead of generating")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--limit", type=int, help="only evaluate the first N questions")
+    parser.add_argument("--no-judge-cache", action="store_true")
+    args = parser.parse_args()
+    judge_model = args.judge_model or args.model
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint.jsonl"
+
+    records = pd.read_csv(args.ground_truth).to_dict(orient="records")[:args.limit]
+    answers = {}
+    if args.answers:
+        answers = {row_key(row): row["answer"] for row in pd.read_csv(args.answers).to_dict(orient="records")}
+        records = [record for record in records if row_key(record) in answers]
+
+    finished = load_checkpoint(checkpoint_path)
+    pending = [record for record in records if row_key(record) not in finished]
+    judge_cache = None
+    if not args.no_judge_cache:
+        judge_cache = cache.AnswerCache(cache.SQLiteBackend(JUDGE_CACHE_PATH), ttl=JUDGE_CACHE_TTL, max_entries=10**6)
+
+    checkpoint = Checkpoint(checkpoint_path)
+    evaluator = Evaluator(args.model, judge_model, judge_cache, checkpoint, args.concurrency)
+    start = time.time()
+    try:
+        asyncio.run(run(evaluator, pending, answers))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        checkpoint.close()
+    elapsed = time.time() - start
+
+    rows = write_csv(args.output, records, load_checkpoint(checkpoint_path))
+    print(json.dumps({
+        "output": args.output,
+        "checkpoint": checkpoint_path,
+        "model": None if args.answers else args.model,
+        "judge_model": judge_model,
+        "questions": len(records),
+        "resumed": len(records) - len(pending),
+        "evaluated": evaluator.done,
+        "remaining": len(records) - len(rows),
+        "judge_cache_hits": evaluator.judge_cache_hits,
+        "errors": evaluator.errors,
+        "elapsed_seconds": elapsed,
+        **summarize(rows),
+    }, indent=2))
+    if len(rows) < len(records):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,179 @@
 import os
-import pandas as pd
-import pickle
-import minsearch
+import re
+import hashlib
+import logging
+
+import context
+
+logger = logging.getLogger(__name__)
 
 DATA_PATH = os.getenv("DATA_PATH", "../dataset/data.csv")
+INDEX_PATH = os.getenv("INDEX_PATH", os.path.join(os.path.dirname(DATA_PATH), "index"))
+
+TEXT_FIELDS = ['Questions', 'Answers']
+KEYWORD_FIELDS = ["Question_ID"]
+
+# "document" indexes whole FAQ entries; "passage" indexes passages of their answers, ranks the entries
+# by their best passage and returns only the best passages of each entry
+SEARCH_GRANULARITY = os.getenv("SEARCH_GRANULARITY", "passage")
+PASSAGE_INDEX_PATH = os.getenv("PASSAGE_INDEX_PATH", os.path.join(os.path.dirname(DATA_PATH), "passage_index"))
+PASSAGE_TOKENS = int(os.getenv("PASSAGE_TOKENS", "120"))
+PASSAGES_PER_DOCUMENT = int(os.getenv("PASSAGES_PER_DOCUMENT", "2"))
+
+# "dense" and "postings" rank by TF-IDF; "embedding" and "hybrid" also need LSA embeddings in the index,
+# which are only built for them. On data.csv hybrid ties the lexical ranking and does not beat it with
+# distractors added (see bench_retrieval.py), so lexical stays the default
+SEARCH_ENGINE = os.getenv("SEARCH_ENGINE", "dense")
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "128"))
+EMBEDDING_N_LISTS = int(os.getenv("EMBEDDING_N_LISTS", "0")) or None
+EMBEDDING_N_PROBE = int(os.getenv("EMBEDDING_N_PROBE", "4"))
+HYBRID_WEIGHT = float(os.getenv("HYBRID_WEIGHT", "0.3"))
+
+_PARAGRAPH_BREAK = re.compile(r"\s*\n\s*")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def load_documents(data_path=DATA_PATH):
+    import pandas as pd
 
-def load_index(data_path=DATA_PATH):
     df = pd.read_csv(data_path)
-    documents = df.to_dict(orient="records")
-    print(documents[9])
+    return df.to_dict(orient="records")
+
+
+def _sentence_windows(text, max_tokens):
+    """Cut `text` into windows of whole sentences of up to `max_tokens`, overlapping by one sentence."""
+    sentences = _SENTENCE_END.split(text)
+    counts = [context.count_tokens(sentence) for sentence in sentences]
+    windows, start = [], 0
+    while start < len(sentences):
+        end, tokens = start, 0
+        while end < len(sentences) and (end == start or tokens + counts[end] <= max_tokens):
+            tokens += counts[end]
+            end += 1
+        windows.append(" ".join(sentences[start:end]))
+        if end == len(sentences):
+            break
+        start = end - 1 if end - start > 1 else end
+    return windows
+
+
+def split_passages(doc, max_tokens=PASSAGE_TOKENS):
+    """
+    Split a document's answer into passages of up to about `max_tokens`. Consecutive paragraphs are packed
+    together and longer paragraphs are cut into sentence windows. Each passage is a copy of the document
+    with the passage as its answer and its position under "passage".
+    """
+    pieces = []
+    for paragraph in _PARAGRAPH_BREAK.split(str(doc["Answers"]).strip()):
+        if context.count_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+        else:
+            pieces.extend(_sentence_windows(paragraph, max_tokens))
+
+    passages, current, current_tokens = [], [], 0
+    for piece in pieces:
+        tokens = context.count_tokens(piece)
+        if current and current_tokens + tokens > max_tokens:
+            passages.append(" \n ".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        passages.append(" \n ".join(current))
+
+    return [dict(doc, Answers=text, passage=i) for i, text in enumerate(passages)]
+
+
+def embedding_params(engine=None):
+    """Embedding settings of the index for a search engine, None if the engine does not use embeddings."""
+    if (engine or SEARCH_ENGINE) not in ("embedding", "hybrid"):
+        return None
+    return {
+        "dims": EMBEDDING_DIMS,
+        "n_lists": EMBEDDING_N_LISTS,
+        "n_probe": EMBEDDING_N_PROBE,
+        "hybrid_weight": HYBRID_WEIGHT,
+    }
+
+
+def build_index(data_path=DATA_PATH, granularity=None, engine=None):
+    import minsearch
+
+    # Prompt fragments and their token counts are computed once here instead of on every request
+    documents = load_documents(data_path)
+
+    if (granularity or SEARCH_GRANULARITY) == "passage":
+        passages = [passage for doc in documents for passage in split_passages(doc)]
+        index = minsearch.PassageIndex(
+            text_fields=TEXT_FIELDS,
+            keyword_fields=KEYWORD_FIELDS,
+            parent_field="Question_ID",
+            passage_field="Answers",
+            passages_per_parent=PASSAGES_PER_DOCUMENT,
+            embedding_params=embedding_params(engine),
+            prepare=context.prepare_document,
+        )
+        return index.fit([context.prepare_document(passage) for passage in passages])
 
     index = minsearch.Index(
-        text_fields=['Questions', 'Answers'],
-        keyword_fields=["Question_ID"],
+        text_fields=TEXT_FIELDS,
+        keyword_fields=KEYWORD_FIELDS,
+        embedding_params=embedding_params(engine),
     )
 
-    index.fit(documents)
+    index.fit([context.prepare_document(doc) for doc in documents])
+    return index
+
+
+def load_index(data_path=DATA_PATH, index_path=None, granularity=None, engine=None):
+    # pandas and scikit-learn are imported on first use to keep importing this module cheap
+    import minsearch
+
+    granularity = granularity or SEARCH_GRANULARITY
+    passages = granularity == "passage"
+    if index_path is None:
+        index_path = PASSAGE_INDEX_PATH if passages else INDEX_PATH
+    checksum = file_checksum(data_path)
+    embeddings = embedding_params(engine)
+
+    try:
+        manifest = minsearch.read_manifest(index_path)
+        metadata = manifest["metadata"]
+        if (metadata.get("source_checksum") == checksum
+                and metadata.get("document_version") == context.DOCUMENT_VERSION
+                and metadata.get("granularity", "document") == granularity
+                and (not passages or metadata.get("passage_tokens") == PASSAGE_TOKENS)
+                and metadata.get("embeddings") == embeddings):
+            logger.info(f"Loading index snapshot from {index_path}")
+            if passages:
+                return minsearch.PassageIndex.load(
+                    index_path, passages_per_parent=PASSAGES_PER_DOCUMENT, prepare=context.prepare_document
+                )
+            return minsearch.Index.load(index_path)
+        logger.info(f"Index snapshot at {index_path} is stale, rebuilding")
+    except FileNotFoundError:
+        logger.info(f"No index snapshot at {index_path}, building one")
+    except (ValueError, KeyError) as e:
+        logger.warning(f"Ignoring unusable index snapshot at {index_path}: {e}")
+
+    index = build_index(data_path, granularity, engine)
+    try:
+        index.save(index_path, metadata={
+            "source_checksum": checksum,
+            "data_path": data_path,
+            "document_version": context.DOCUMENT_VERSION,
+            "granularity": granularity,
+            "passage_tokens": PASSAGE_TOKENS if passages else None,
+            "embeddings": embeddings,
+        })
+    except OSError as e:
+        logger.warning(f"Could not save index snapshot to {index_path}: {e}")
     return index
@@ -0,0 +1,214 @@
+import json
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+RELEVANCE_VALUES = ["NON_RELEVANT", "PARTLY_RELEVANT", "RELEVANT"]
+
+batch_eval_template = """
+You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
+Your task is to analyze the relevance of each generated answer to its question.
+Based on the relevance of the generated answer, you will classify it
+as "NON_RELEVANT", "PARTLY_RELEVANT", or "RELEVANT".
+
+Here are the items for evaluation:
+
+{items}
+
+Please analyze the content and context of every generated answer in relation to its question
+and provide your evaluation as a parsable JSON array without using code blocks, with exactly one
+object per item and the same ids:
+
+[{{"id": <item id>, "Relevance": "NON_RELEVANT" | "PARTLY_RELEVANT" | "RELEVANT", "Explanation": "[Provide a brief explanation for your evaluation]"}}]
+""".strip()
+
+item_template = """
+Item {id}:
+Question: {question}
+Answer: {answer}
+""".strip()
+
+
+def build_batch_prompt(items):
+    rendered = [item_template.format(id=i, question=item.question, answer=item.answer) for i, item in enumerate(items, 1)]
+    return batch_eval_template.format(items="\n\n".join(rendered))
+
+
+def parse_batch_evaluation(evaluation, num_items):
+    """Map item id -> (relevance, explanation) for every well-formed entry of the judge's JSON array."""
+    text = evaluation.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.find("["):]
+
+    try:
+        entries = json.loads(text)
+    except json.JSONDecodeError:
+        logger.error(f"Failed to parse batch evaluation JSON: {evaluation}")
+        return {}
+    if not isinstance(entries, list):
+        logger.error(f"Batch evaluation is not a JSON array: {evaluation}")
+        return {}
+
+    results = {}
+    for entry in entries:
+        try:
+            item_id = int(entry["id"])
+            relevance = str(entry["Relevance"]).upper()
+            explanation = str(entry["Explanation"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not 1 <= item_id <= num_items:
+            continue
+        if relevance not in RELEVANCE_VALUES:
+            logger.warning(f"Unexpected relevance value: {relevance}. Defaulting to PARTLY_RELEVANT.")
+            relevance = "PARTLY_RELEVANT"
+        results[item_id] = (relevance, explanation)
+    return results
+
+
+class JudgeItem:
+    def __init__(self, question, answer, model, conversation_id=None, callback=None):
+        self.question = question
+        self.answer = answer
+        self.model = model
+        self.conversation_id = conversation_id
+        self.callback = callback
+        self.judgement = None
+        self.attempts = 0
+        self.first_update_at = None
+
+
+class RelevanceJudge:
+    """
+    Background worker that packs pending (question, answer) pairs into batched judge prompts and writes
+    the verdicts back to the matching conversations rows, so judging never blocks a user request.
+    `llm(prompt, model)` returns (text, token_stats, response_time) like rag.llm, and
+    `update(conversation_id, judgement)` returns whether the conversation row was found.
+
+    Items whose verdict is missing from the judge's output are retried in a later batch, and verdicts for
+    conversations that are not saved yet are re-applied until their row shows up, for up to `update_window`
+    seconds, which has to cover how long a buffered writer may hold the row back.
+    """
+
+    def __init__(self, llm, update, batch_size=8, max_wait=2.0, max_attempts=3, update_window=60.0):
+        self.llm = llm
+        self.update = update
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.max_attempts = max_attempts
+        self.update_window = update_window
+        self._queue = queue.Queue()
+        self._pending_updates = []
+        self._thread = None
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def submit(self, question, answer, model, conversation_id=None, callback=None):
+        """Queue an answer for judging; `callback(judgement)` is called with the verdict fields."""
+        self.start()
+        self._queue.put(JudgeItem(question, answer, model, conversation_id, callback))
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="relevance-judge", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _next_batch(self):
+        try:
+            batch = [self._queue.get(timeout=self.max_wait)]
+        except queue.Empty:
+            return []
+
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            batch = self._next_batch()
+
+            by_model = {}
+            for item in batch:
+                by_model.setdefault(item.model, []).append(item)
+            for model, items in by_model.items():
+                self._judge(model, items)
+
+            self._apply_pending_updates()
+
+    def _judge(self, model, items):
+        try:
+            evaluation, tokens, _ = self.llm(build_batch_prompt(items), model)
+        except Exception as e:
+            logger.error(f"Batch relevance evaluation failed: {e}")
+            evaluation, tokens = "", {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+        results = parse_batch_evaluation(evaluation, len(items)) if evaluation else {}
+        # The batch's token spend is shared evenly among its items, the first one also taking the remainder
+        share = {name: count // len(items) for name, count in tokens.items()}
+        remainder = {name: count % len(items) for name, count in tokens.items()}
+
+        for item_id, item in enumerate(items, 1):
+            item_share = {name: share[name] + (remainder[name] if item_id == 1 else 0) for name in share}
+            item.attempts += 1
+            if item_id in results:
+                relevance, explanation = results[item_id]
+            elif item.attempts < self.max_attempts:
+                self._queue.put(item)
+                continue
+            else:
+                relevance, explanation = "PARTLY_RELEVANT", "Failed to parse evaluation"
+
+            item.judgement = {
+                "relevance": relevance,
+                "relevance_explanation": explanation,
+                "eval_prompt_tokens": item_share["prompt_tokens"],
+                "eval_completion_tokens": item_share["completion_tokens"],
+                "eval_total_tokens": item_share["total_tokens"],
+            }
+            self._deliver(item)
+
+    def _deliver(self, item):
+        if item.callback is not None:
+            try:
+                item.callback(item.judgement)
+            except Exception as e:
+                logger.error(f"Relevance judgement callback failed: {e}")
+            item.callback = None
+
+        if item.conversation_id is None:
+            return
+        try:
+            updated = self.update(item.conversation_id, item.judgement)
+        except Exception as e:
+            logger.error(f"Relevance update failed for conversation {item.conversation_id}: {e}")
+            updated = False
+        if not updated:
+            if item.first_update_at is None:
+                item.first_update_at = time.time()
+            if time.time() - item.first_update_at < self.update_window:
+                self._pending_updates.append(item)
+            else:
+                logger.error(f"Giving up on relevance update for conversation: {item.conversation_id}")
+
+    def _apply_pending_updates(self):
+        pending, self._pending_updates = self._pending_updates, []
+        for item in pending:
+            self._deliver(item)
@@ -0,0 +1,485 @@
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Completion tokens assumed when reserving token quota for a request that does not set max_tokens;
+# the reservation is corrected once the response reports its real usage
+EXPECTED_COMPLETION_TOKENS = 256
+
+COUNTERS = [
+    "requests", "attempts", "successes", "failures", "retries", "timeouts", "rate_limited",
+    "throttled", "throttle_seconds", "hedges", "hedge_wins", "circuit_rejections", "circuit_trips",
+    "deadline_exceeded",
+]
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised without calling the API while a model's circuit breaker is open."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a call cannot finish, including waits and retries, within its deadline."""
+
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `per_minute`, holding at most a minute's worth; 0 disables it."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount):
+        """Take `amount` now, going into debt if needed; returns the seconds to wait before using it."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= min(amount, self.capacity)
+            return max(-self._tokens / self.rate, 0.0)
+
+    def try_reserve(self, amount):
+        """Take `amount` only if it is available right away."""
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            self._refill()
+            if self._tokens < amount:
+                return False
+            self._tokens -= amount
+            return True
+
+    def refund(self, amount):
+        """Give back (or, if negative, take more of) a reservation once the real cost is known."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and rejects calls for `cooldown` seconds, then lets
+    a single trial call through: its success closes the breaker, its failure opens it again. A trial that
+    ends with neither (abandoned, cancelled, out of time) is released, and one left unresolved for
+    `cooldown` seconds is handed to the next call, so the breaker cannot stay half open forever.
+    """
+
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = None
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True while closed, a trial ticket for release() if this call is the half-open trial, else False."""
+        if self.threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == "closed":
+                return True
+            now = time.monotonic()
+            if self.state == "open" and now - self._opened_at >= self.cooldown:
+                self.state = "half_open"
+            elif self.state == "open" or (self._trial is not None and now - self._trial_started < self.cooldown):
+                return False
+            self._trial = object()
+            self._trial_started = now
+            return self._trial
+
+    def release(self, trial):
+        """Give up `trial` if it is still unresolved, so the next call becomes the trial."""
+        with self._lock:
+            if self.state == "half_open" and trial is self._trial:
+                self._trial = None
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self._failures = 0
+
+    def record_failure(self):
+        """Returns whether this failure opened the breaker."""
+        if self.threshold <= 0:
+            return False
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class _ModelState:
+    def __init__(self, requests_per_minute, tokens_per_minute, breaker_threshold, breaker_cooldown):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+        self.latencies = deque(maxlen=200)
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+
+class LLMClient:
+    """
+    Wraps every chat completion call with per-model request and token rate limits, a deadline covering
+    waits and retries, jittered exponential backoff on retryable errors (timeouts, connection errors,
+    429 and 5xx), optional hedging and a per-model circuit breaker, and counts what happened.
+
+    `get_client()` and `get_async_client()` return the Groq clients, which should not retry on their own.
+    `model_limits` maps a model to {"requests_per_minute": ..., "tokens_per_minute": ...} overrides.
+    With `hedge_percentile` set, a duplicate request is sent when the first one has been running longer
+    than that percentile of the model's recent latencies, and whichever answers first wins.
+    """
+
+    def __init__(self, get_client, get_async_client, requests_per_minute=0, tokens_per_minute=0,
+                 model_limits=None, deadline=60.0, attempt_timeout=30.0, max_retries=3, backoff_base=0.5,
+                 backoff_max=8.0, hedge_percentile=None, hedge_min_samples=20, breaker_threshold=5,
+                 breaker_cooldown=30.0):
+        self.get_client = get_client
+        self.get_async_client = get_async_client
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.model_limits = model_limits or {}
+        self.deadline = deadline
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._models = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _state(self, model):
+        with self._lock:
+            state = self._models.get(model)
+            if state is None:
+                limits = self.model_limits.get(model, {})
+                state = self._models[model] = _ModelState(
+                    limits.get("requests_per_minute", self.requests_per_minute),
+                    limits.get("tokens_per_minute", self.tokens_per_minute),
+                    self.breaker_threshold,
+                    self.breaker_cooldown,
+                )
+            return state
+
+    def _count(self, state, name, value=1):
+        with self._lock:
+            state.counters[name] += value
+
+    def stats(self):
+        """Counters, breaker state and recent latency percentiles, per model."""
+        with self._lock:
+            models = dict(self._models)
+        stats = {}
+        for model, state in models.items():
+            with self._lock:
+                latencies = list(state.latencies)
+                counters = dict(state.counters)
+            stats[model] = dict(
+                counters,
+                circuit=state.breaker.state,
+                latency_p50=float(np.percentile(latencies, 50)) if latencies else None,
+                latency_p95=float(np.percentile(latencies, 95)) if latencies else None,
+            )
+        return stats
+
+    @staticmethod
+    def estimate_tokens(messages, max_tokens=None):
+        # Roughly 4 characters per token
+        prompt = sum(len(str(message.get("content", ""))) for message in messages) // 4
+        return prompt + (max_tokens or EXPECTED_COMPLETION_TOKENS)
+
+    @staticmethod
+    def is_retryable(error):
+        import groq
+
+        if isinstance(error, (groq.APIConnectionError, TimeoutError)):
+            return True
+        status = getattr(error, "status_code", None)
+        return status in (408, 409, 429) or (status is not None and status >= 500)
+
+    def _backoff(self, attempt, error):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            if retry_after is not None:
+                return min(float(retry_after), self.backoff_max)
+        except ValueError:
+            pass
+        # Full jitter keeps clients that failed together from retrying together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _hedge_after(self, state):
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            if len(state.latencies) < self.hedge_min_samples:
+                return None
+            return float(np.percentile(state.latencies, self.hedge_percentile))
+
+    def _admit(self, state, estimated, deadline):
+        """
+        Check the breaker and take rate limit quota; returns the seconds to wait before calling and the
+        breaker's ticket, to be released once the attempt is over.
+        """
+        trial = state.breaker.allow()
+        if not trial:
+            self._count(state, "circuit_rejections")
+            raise CircuitOpenError("LLM circuit breaker is open")
+        delay = max(state.requests.reserve(1), state.tokens.reserve(estimated))
+        if delay > 0:
+            self._count(state, "throttled")
+            self._count(state, "throttle_seconds", delay)
+        if time.monotonic() + delay >= deadline:
+            state.requests.refund(1)
+            state.tokens.refund(estimated)
+            state.breaker.release(trial)
+            self._count(state, "deadline_exceeded")
+            raise DeadlineExceeded(f"Rate limit wait of {delay:.1f}s exceeds the deadline")
+        return delay, trial
+
+    def _timeout(self, state, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._count(state, "deadline_exceeded")
+            raise DeadlineExceeded("LLM call deadline exceeded")
+        return min(self.attempt_timeout, remaining)
+
+    def _on_failure(self, state, error, estimated, attempt, deadline):
+        """Account for a failed attempt; returns the backoff before the next one, or re-raises."""
+        state.tokens.refund(estimated)
+        if not self.is_retryable(error):
+            # The API answered, so it is healthy; the request itself was bad
+            state.breaker.record_success()
+            raise error
+
+        self._count(state, "failures")
+        if isinstance(error, TimeoutError) or type(error).__name__ == "APITimeoutError":
+            self._count(state, "timeouts")
+        if getattr(error, "status_code", None) == 429:
+            self._count(state, "rate_limited")
+        if state.breaker.record_failure():
+            self._count(state, "circuit_trips")
+            logger.error(f"LLM circuit breaker opened after: {error}")
+
+        pause = self._backoff(attempt, error)
+        if attempt >= self.max_retries or time.monotonic() + pause >= deadline:
+            raise error
+        self._count(state, "retries")
+        logger.warning(f"LLM call failed, retrying in {pause:.2f}s: {error}")
+        return pause
+
+    def _on_success(self, state, response, estimated, started):
+        state.breaker.record_success()
+        with self._lock:
+            state.counters["successes"] += 1
+            state.latencies.append(time.monotonic() - started)
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            state.tokens.refund(estimated - usage.total_tokens)
+
+    def create(self, model, messages, **kwargs):
+        """chat.completions.create with rate limits, deadline, retries, hedging and the breaker."""
+        state = self._state(model)
+        deadline = time.monotonic() + self.deadline
+        estimated = self.estimate_tokens(messages, kwargs.get("max_tokens"))
+        self._count(state, "requests")
+
+        for attempt in range(self.max_retries + 1):
+            delay, trial = self._admit(state, estimated, deadline)
+            try:
+                if delay > 0:
+                    time.sleep(delay)
+                started = time.monotonic()
+                try:
+                    self._count(state, "attempts")
+                    response = self._call(state, model, messages, self._timeout(state, deadline), estimated, kwargs)
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    time.sleep(self._on_failure(state, e, estimated, attempt, deadline))
+                    continue
+                self._on_success(state, response, estimated, started)
+                return response
+            finally:
+                # No-op once the attempt has recorded a success or failure
+                state.breaker.release(trial)
+
+    def _call(self, state, model, messages, timeout, estimated, kwargs):
+        request = lambda: self.get_client().chat.completions.create(
+            model=model, messages=messages, timeout=timeout, **kwargs
+        )
+        hedge_after = self._hedge_after(state)
+        if hedge_after is None or hedge_after >= timeout:
+            return request()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+        primary = self._executor.submit(request)
+        done, _ = wait([primary], timeout=hedge_after)
+        # A hedge is only sent when the rate limits have room for it right away
+        if done or not state.requests.try_reserve(1):
+            return primary.result()
+        if not state.tokens.try_reserve(estimated):
+            state.requests.refund(1)
+            return primary.result()
+
+        self._count(state, "hedges")
+        hedge = self._executor.submit(request)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            # Both requests carry the attempt timeout, so this cannot wait forever
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self._count(state, "hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    async def acreate(self, model, messages, **kwargs):
+        """Async counterpart of create()."""
+        state = self._state(model)
+        deadline = time.monotonic() + self.deadline
+        estimated = self.estimate_tokens(messages, kwargs.get("max_tokens"))
+        self._count(state, "requests")
+
+        for attempt in range(self.max_retries + 1):
+            delay, trial = self._admit(state, estimated, deadline)
+            try:
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                started = time.monotonic()
+                try:
+                    self._count(state, "attempts")
+                    response = await self._acall(
+                        state, model, messages, self._timeout(state, deadline), estimated, kwargs
+                    )
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    await asyncio.sleep(self._on_failure(state, e, estimated, attempt, deadline))
+                    continue
+                self._on_success(state, response, estimated, started)
+                return response
+            finally:
+                # Also reached when the caller cancels the task
+                state.breaker.release(trial)
+
+    async def _acall(self, state, model, messages, timeout, estimated, kwargs):
+        request = lambda: self.get_async_client().chat.completions.create(
+            model=model, messages=messages, timeout=timeout, **kwargs
+        )
+        hedge_after = self._hedge_after(state)
+        if hedge_after is None or hedge_after >= timeout:
+            return await request()
+
+        primary = asyncio.ensure_future(request())
+        done, _ = await asyncio.wait([primary], timeout=hedge_after)
+        if done or not state.requests.try_reserve(1):
+            return await primary
+        if not state.tokens.try_reserve(estimated):
+            state.requests.refund(1)
+            return await primary
+
+        self._count(state, "hedges")
+        hedge = asyncio.ensure_future(request())
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count(state, "hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stream(self, model, messages, **kwargs):
+        """
+        Streaming chat.completions.create. Opening the stream is rate limited, retried and bounded by the
+        deadline like create(); once chunks flow a failure is raised to the caller, as the text already
+        yielded cannot be taken back. Streams are never hedged.
+        """
+        state = self._state(model)
+        deadline = time.monotonic() + self.deadline
+        estimated = self.estimate_tokens(messages, kwargs.get("max_tokens"))
+        self._count(state, "requests")
+
+        for attempt in range(self.max_retries + 1):
+            delay, trial = self._admit(state, estimated, deadline)
+            iterating = False
+            try:
+                if delay > 0:
+                    time.sleep(delay)
+                try:
+                    self._count(state, "attempts")
+                    response = self.get_client().chat.completions.create(
+                        model=model, messages=messages, stream=True, timeout=self._timeout(state, deadline), **kwargs
+                    )
+                except DeadlineExceeded:
+                    raise
+                except Exception as e:
+                    time.sleep(self._on_failure(state, e, estimated, attempt, deadline))
+                    continue
+                iterating = True
+                return self._iterate(state, response, estimated, trial)
+            finally:
+                # The trial stays with the stream until it ends; a stream never iterated is only
+                # released once the trial times out
+                if not iterating:
+                    state.breaker.release(trial)
+
+    def _iterate(self, state, response, estimated, trial):
+        usage = None
+        try:
+            for chunk in response:
+                x_groq = getattr(chunk, "x_groq", None)
+                usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None) or usage
+                yield chunk
+        except Exception:
+            self._count(state, "failures")
+            if state.breaker.record_failure():
+                self._count(state, "circuit_trips")
+            raise
+        else:
+            state.breaker.record_success()
+            self._count(state, "successes")
+            if usage is not None:
+                state.tokens.refund(estimated - usage.total_tokens)
+        finally:
+            # Closing the stream early (GeneratorExit) is neither a success nor a failure
+            state.breaker.release(trial)
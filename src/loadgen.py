@@ -0,0 +1,289 @@
+"""
+Load generator for the RAG pipeline: drives rag.rag (and optionally saving the conversation) with
+the ground-truth questions at a fixed concurrency and reports throughput, latency percentiles and a
+per-stage breakdown (search, prompt building, LLM, relevance judge, save) as JSON.
+
+Run it against the local stub server to find pipeline bottlenecks without network or Groq quota:
+
+    python loadgen.py --stub --concurrency 16 --requests 500
+    python loadgen.py --stub --ttft-dist exponential --error-rate 0.05 --duration 60 --save
+    python loadgen.py --stub --stream --tokens-per-second 80 --requests 100
+    python loadgen.py --base-url http://localhost:8008 --concurrency 8 --requests 200
+
+--check-breaker instead runs the LLM client's circuit breaker against the stub: it trips the breaker,
+then ends each half-open trial without an outcome (a stream closed after its first chunk, a rate limit
+wait past the deadline, a cancelled async call) and checks that the next call still gets through.
+It reports the result of each case as JSON and exits with status 1 if any of them failed.
+
+    python loadgen.py --check-breaker
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import rag
+import stub_llm
+from bench_retrieval import GROUND_TRUTH_PATH, load_ground_truth
+
+STAGES = ["search", "prompt", "llm", "first_token", "judge", "save", "other"]
+
+
+class LoadRun:
+    def __init__(self, questions, model, save, stream=False, max_requests=None, duration=None):
+        self.questions = questions
+        self.model = model
+        self.save = save
+        self.stream = stream
+        self.max_requests = max_requests
+        self.deadline = time.time() + duration if duration else None
+        self.latencies = []
+        self.stages = {stage: [] for stage in STAGES}
+        self.errors = {}
+        self.tokens = 0
+        self.cached = 0
+        self.prompt_tokens_saved = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def _next_request(self):
+        with self._lock:
+            number = next(self._counter)
+        if self.max_requests is not None and number >= self.max_requests:
+            return None
+        if self.deadline is not None and time.time() >= self.deadline:
+            return None
+        return number
+
+    def answer(self, question, conversation_id, timings):
+        if not self.stream:
+            return rag.rag(question, model=self.model, conversation_id=conversation_id, timings=timings)
+
+        # Streaming path, as used by the app: search and prompt happen when the stream is created,
+        # the LLM stage runs until the last chunk and finish() runs the relevance judge
+        start = time.time()
+        stream = rag.rag_stream(question, model=self.model, conversation_id=conversation_id)
+        rag.record_timing(timings, "search", start)
+        start = time.time()
+        for i, _ in enumerate(stream):
+            if i == 0:
+                rag.record_timing(timings, "first_token", start)
+        rag.record_timing(timings, "llm", start)
+        start = time.time()
+        answer_data = stream.finish()
+        rag.record_timing(timings, "judge", start)
+        return answer_data
+
+    def worker(self):
+        while (number := self._next_request()) is not None:
+            question = self.questions[number % len(self.questions)]
+            conversation_id = str(uuid.uuid4())
+            timings = {}
+            start = time.time()
+            try:
+                answer_data = self.answer(question, conversation_id if self.save else None, timings)
+                if self.save:
+                    import writer
+
+                    t0 = time.time()
+                    writer.save_conversation(conversation_id, question, answer_data)
+                    rag.record_timing(timings, "save", t0)
+            except Exception as e:
+                with self._lock:
+                    name = type(e).__name__
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                continue
+
+            total = time.time() - start
+            # first_token is part of the llm stage, not additional to it
+            measured = sum(seconds for stage, seconds in timings.items() if stage != "first_token")
+            timings["other"] = max(total - measured, 0.0)
+            with self._lock:
+                self.latencies.append(total)
+                for stage in STAGES:
+                    self.stages[stage].append(timings.get(stage, 0.0))
+                self.tokens += answer_data["total_tokens"] + answer_data["eval_total_tokens"]
+                self.cached += bool(answer_data.get("cached"))
+                self.prompt_tokens_saved += answer_data.get("prompt_tokens_saved", 0)
+
+
+def percentiles_ms(values):
+    values = np.array(values) * 1000
+    if len(values) == 0:
+        return None
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+def report(run, elapsed, args):
+    completed = len(run.latencies)
+    stages = {stage: values for stage, values in run.stages.items() if any(values)}
+    total_stage_time = sum(sum(values) for stage, values in stages.items() if stage != "first_token")
+    return {
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "duration": args.duration,
+            "model": args.model,
+            "save": args.save,
+            "stream": args.stream,
+            "answer_cache": args.answer_cache,
+            "judge_mode": args.judge_mode,
+            "llm_base_url": rag.GROQ_BASE_URL,
+        },
+        "completed": completed,
+        "errors": run.errors,
+        "elapsed_seconds": elapsed,
+        "requests_per_second": completed / elapsed if elapsed > 0 else 0.0,
+        "tokens_per_second": run.tokens / elapsed if elapsed > 0 else 0.0,
+        "cached_answers": run.cached,
+        "prompt_tokens_saved_per_request": run.prompt_tokens_saved / completed if completed else 0.0,
+        "llm_client": rag.get_llm_client().stats(),
+        "latency_ms": percentiles_ms(run.latencies),
+        "stages": {
+            stage: dict(
+                percentiles_ms(values) or {},
+                share=sum(values) / total_stage_time if total_stage_time > 0 else 0.0,
+            )
+            for stage, values in stages.items()
+        },
+    }
+
+
+def check_breaker(server, model, cooldown=2.0):
+    """Whether the breaker recovers after each kind of half-open trial that ends without an outcome."""
+    from llm_client import LLMClient
+
+    client = LLMClient(
+        rag.get_client, rag.get_async_client, tokens_per_minute=10**6, deadline=5.0, max_retries=0,
+        breaker_threshold=1, breaker_cooldown=cooldown,
+    )
+    messages = [{"role": "user", "content": "How can I manage stress at work?"}]
+
+    def trip():
+        server.config.error_rate = 1.0
+        try:
+            client.create(model, messages)
+        except Exception:
+            pass
+        server.config.error_rate = 0.0
+        time.sleep(cooldown)
+
+    def abandoned_stream():
+        stream = client.stream(model, messages)
+        next(stream)
+        stream.close()
+
+    def deadline_exceeded():
+        # Reserving more than the whole token budget means a rate limit wait longer than the deadline
+        try:
+            client.create(model, messages, max_tokens=2 * 10**6)
+        except Exception:
+            pass
+
+    def cancelled():
+        async def cancel():
+            task = asyncio.ensure_future(client.acreate(model, messages))
+            await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        asyncio.run(cancel())
+
+    results = {}
+    for name, end_trial in [
+        ("abandoned_stream", abandoned_stream), ("deadline_exceeded", deadline_exceeded), ("cancelled", cancelled),
+    ]:
+        trip()
+        end_trial()
+        try:
+            client.create(model, messages)
+            results[name] = True
+        except Exception as e:
+            print(f"{name}: {e!r}", flush=True)
+            results[name] = False
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=None, help="stop after this many requests")
+    parser.add_argument("--duration", type=float, default=None, help="stop after this many seconds")
+    parser.add_argument("--model", default="gemma2-9b-it")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--save", action="store_true", help="save every conversation (see DB_WRITE_MODE)")
+    parser.add_argument("--stream", action="store_true", help="use the streaming path (rag.rag_stream)")
+    parser.add_argument("--answer-cache", choices=["none", "disk", "postgres"], default="none")
+    parser.add_argument("--judge-mode", choices=["inline", "batch"], default=rag.RELEVANCE_JUDGE_MODE)
+    parser.add_argument("--base-url", help="Groq-compatible endpoint, e.g. a running stub_llm.py")
+    parser.add_argument("--stub", action="store_true", help="start an in-process stub LLM server")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--check-breaker", action="store_true", help="check circuit breaker recovery (implies --stub)")
+    stub_llm.add_arguments(parser.add_argument_group("stub server (with --stub)"))
+    args = parser.parse_args()
+    if args.requests is None and args.duration is None:
+        args.requests = 200
+
+    if args.stub or args.check_breaker:
+        server = stub_llm.serve(stub_llm.config_from_args(args), port=0)
+        rag.GROQ_BASE_URL = server.url
+        os.environ.setdefault("GROQ_API_KEY", "stub")
+    elif args.base_url:
+        rag.GROQ_BASE_URL = args.base_url
+    if args.check_breaker:
+        results = check_breaker(server, args.model)
+        write_report(json.dumps({"breaker_recovers": results}, indent=2), args.output)
+        if not all(results.values()):
+            raise SystemExit(1)
+        return
+
+    rag.ANSWER_CACHE_BACKEND = args.answer_cache
+    rag.RELEVANCE_JUDGE_MODE = args.judge_mode
+
+    # Load everything up front so cold start does not count against the first requests
+    rag.get_index()
+    rag.get_client()
+    rag.get_answer_cache()
+    if args.save:
+        import db
+        import writer
+
+        db.ensure_schema()
+        writer.recover_spool()
+
+    questions = [row["question"] for row in load_ground_truth(args.ground_truth)]
+    run = LoadRun(
+        questions, args.model, args.save, stream=args.stream, max_requests=args.requests, duration=args.duration,
+    )
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for _ in range(args.concurrency):
+            pool.submit(run.worker)
+    elapsed = time.time() - start
+
+    write_report(json.dumps(report(run, elapsed, args), indent=2), args.output)
+
+
+def write_report(text, output):
+    if output:
+        with open(output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
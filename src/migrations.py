@@ -0,0 +1,335 @@
+"""
+Ordered schema migrations applied by db.migrate(). Each migration runs once, in its own transaction,
+and its version is recorded in the schema_migrations table. Never edit a released migration; append
+a new one with the next version number instead.
+"""
+
+
+class Migration:
+    def __init__(self, version, description, statements):
+        self.version = version
+        self.description = description
+        self.statements = statements
+
+
+MIGRATIONS = [
+    # Written to be a no-op on databases created before migrations existed
+    Migration(1, "create conversations and feedback tables", [
+        """
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS feedback (
+            id SERIAL PRIMARY KEY,
+            conversation_id TEXT REFERENCES conversations(id),
+            feedback INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+        """,
+    ]),
+    Migration(2, "record cache hits and streaming metrics on conversations", [
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS cached BOOLEAN NOT NULL DEFAULT FALSE",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS time_to_first_token FLOAT",
+        "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS tokens_per_second FLOAT",
+    ]),
+    # Recent-conversation listings, the feedback join and the time-filtered dashboard panels
+    Migration(3, "index conversations and feedback for time-ordered and per-conversation lookups", [
+        "CREATE INDEX IF NOT EXISTS conversations_timestamp_idx ON conversations (timestamp)",
+        "CREATE INDEX IF NOT EXISTS conversations_relevance_timestamp_idx ON conversations (relevance, timestamp)",
+        "CREATE INDEX IF NOT EXISTS feedback_conversation_id_idx ON feedback (conversation_id)",
+        "CREATE INDEX IF NOT EXISTS feedback_timestamp_idx ON feedback (timestamp)",
+    ]),
+]
+
+
+# Upper bounds (seconds) of the response time histogram slots; the last slot is open-ended
+RESPONSE_TIME_BOUNDS = [0.5, 1, 2, 4, 8, 16, 32]
+RESPONSE_TIME_SLOTS = len(RESPONSE_TIME_BOUNDS) + 1
+ROLLUP_GRANULARITIES = ["minute", "hour", "day"]
+
+_granularities = ", ".join(f"('{granularity}')" for granularity in ROLLUP_GRANULARITIES)
+_histogram = ", ".join(
+    f"count(*) FILTER (WHERE response_time_slot(c.response_time) = {slot})"
+    for slot in range(1, RESPONSE_TIME_SLOTS + 1)
+)
+
+# Recompute every rollup row from the raw tables
+ROLLUP_BACKFILL = [
+    "TRUNCATE conversation_rollups, feedback_rollups",
+    f"""
+    INSERT INTO conversation_rollups (
+        granularity, bucket, model_used, relevance, cached,
+        conversations, response_time_sum, response_time_histogram,
+        prompt_tokens, completion_tokens, total_tokens, eval_total_tokens,
+        time_to_first_token_sum, time_to_first_token_count, tokens_per_second_sum, tokens_per_second_count
+    )
+    SELECT
+        g.granularity, date_trunc(g.granularity, c.timestamp, 'UTC'), c.model_used, c.relevance, c.cached,
+        count(*), sum(c.response_time), ARRAY[{_histogram}]::BIGINT[],
+        sum(c.prompt_tokens), sum(c.completion_tokens), sum(c.total_tokens), sum(c.eval_total_tokens),
+        COALESCE(sum(c.time_to_first_token), 0), count(c.time_to_first_token),
+        COALESCE(sum(c.tokens_per_second), 0), count(c.tokens_per_second)
+    FROM conversations c
+    CROSS JOIN (VALUES {_granularities}) AS g (granularity)
+    GROUP BY 1, 2, 3, 4, 5
+    """,
+    f"""
+    INSERT INTO feedback_rollups (granularity, bucket, model_used, relevance, positive, negative)
+    SELECT
+        g.granularity, date_trunc(g.granularity, f.timestamp, 'UTC'),
+        COALESCE(c.model_used, 'UNKNOWN'), COALESCE(c.relevance, 'UNKNOWN'),
+        count(*) FILTER (WHERE f.feedback > 0), count(*) FILTER (WHERE f.feedback < 0)
+    FROM feedback f
+    LEFT JOIN conversations c ON c.id = f.conversation_id
+    CROSS JOIN (VALUES {_granularities}) AS g (granularity)
+    GROUP BY 1, 2, 3, 4
+    """,
+]
+
+MIGRATIONS.append(
+    # Per-bucket aggregates for the Grafana dashboards, kept current by triggers on the raw tables so
+    # dashboard queries read a handful of rows per bucket instead of scanning conversations and feedback.
+    # Buckets are truncated in UTC. Feedback is counted under its conversation's model and relevance.
+    Migration(4, "add trigger-maintained minute, hour and day rollups of conversations and feedback", [
+        """
+        CREATE TABLE IF NOT EXISTS conversation_rollups (
+            granularity TEXT NOT NULL,
+            bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            cached BOOLEAN NOT NULL,
+            conversations BIGINT NOT NULL,
+            response_time_sum DOUBLE PRECISION NOT NULL,
+            response_time_histogram BIGINT[] NOT NULL,
+            prompt_tokens BIGINT NOT NULL,
+            completion_tokens BIGINT NOT NULL,
+            total_tokens BIGINT NOT NULL,
+            eval_total_tokens BIGINT NOT NULL,
+            time_to_first_token_sum DOUBLE PRECISION NOT NULL,
+            time_to_first_token_count BIGINT NOT NULL,
+            tokens_per_second_sum DOUBLE PRECISION NOT NULL,
+            tokens_per_second_count BIGINT NOT NULL,
+            PRIMARY KEY (granularity, bucket, model_used, relevance, cached)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS feedback_rollups (
+            granularity TEXT NOT NULL,
+            bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            positive BIGINT NOT NULL,
+            negative BIGINT NOT NULL,
+            PRIMARY KEY (granularity, bucket, model_used, relevance)
+        )
+        """,
+        f"""
+        CREATE OR REPLACE FUNCTION response_time_slot(seconds DOUBLE PRECISION) RETURNS INTEGER AS $$
+            SELECT width_bucket(seconds, ARRAY{RESPONSE_TIME_BOUNDS}::DOUBLE PRECISION[]) + 1
+        $$ LANGUAGE sql IMMUTABLE
+        """,
+        f"""
+        CREATE OR REPLACE FUNCTION rollup_conversation(c conversations, sign INTEGER) RETURNS VOID AS $$
+        DECLARE
+            unit TEXT;
+            slot INTEGER := response_time_slot(c.response_time);
+            histogram BIGINT[] := array_fill(0::BIGINT, ARRAY[{RESPONSE_TIME_SLOTS}]);
+        BEGIN
+            histogram[slot] := sign;
+            FOREACH unit IN ARRAY ARRAY{ROLLUP_GRANULARITIES} LOOP
+                INSERT INTO conversation_rollups AS r VALUES (
+                    unit, date_trunc(unit, c.timestamp, 'UTC'), c.model_used, c.relevance, c.cached,
+                    sign, sign * c.response_time, histogram,
+                    sign * c.prompt_tokens, sign * c.completion_tokens, sign * c.total_tokens,
+                    sign * c.eval_total_tokens,
+                    sign * COALESCE(c.time_to_first_token, 0),
+                    CASE WHEN c.time_to_first_token IS NULL THEN 0 ELSE sign END,
+                    sign * COALESCE(c.tokens_per_second, 0),
+                    CASE WHEN c.tokens_per_second IS NULL THEN 0 ELSE sign END
+                )
+                ON CONFLICT (granularity, bucket, model_used, relevance, cached) DO UPDATE SET
+                    conversations = r.conversations + EXCLUDED.conversations,
+                    response_time_sum = r.response_time_sum + EXCLUDED.response_time_sum,
+                    response_time_histogram[slot] = r.response_time_histogram[slot] + sign,
+                    prompt_tokens = r.prompt_tokens + EXCLUDED.prompt_tokens,
+                    completion_tokens = r.completion_tokens + EXCLUDED.completion_tokens,
+                    total_tokens = r.total_tokens + EXCLUDED.total_tokens,
+                    eval_total_tokens = r.eval_total_tokens + EXCLUDED.eval_total_tokens,
+                    time_to_first_token_sum = r.time_to_first_token_sum + EXCLUDED.time_to_first_token_sum,
+                    time_to_first_token_count = r.time_to_first_token_count + EXCLUDED.time_to_first_token_count,
+                    tokens_per_second_sum = r.tokens_per_second_sum + EXCLUDED.tokens_per_second_sum,
+                    tokens_per_second_count = r.tokens_per_second_count + EXCLUDED.tokens_per_second_count;
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        f"""
+        CREATE OR REPLACE FUNCTION rollup_feedback(
+            vote INTEGER, ts TIMESTAMP WITH TIME ZONE, model TEXT, verdict TEXT, sign INTEGER
+        ) RETURNS VOID AS $$
+        DECLARE
+            unit TEXT;
+        BEGIN
+            FOREACH unit IN ARRAY ARRAY{ROLLUP_GRANULARITIES} LOOP
+                INSERT INTO feedback_rollups AS r VALUES (
+                    unit, date_trunc(unit, ts, 'UTC'),
+                    COALESCE(model, 'UNKNOWN'), COALESCE(verdict, 'UNKNOWN'),
+                    CASE WHEN vote > 0 THEN sign ELSE 0 END,
+                    CASE WHEN vote < 0 THEN sign ELSE 0 END
+                )
+                ON CONFLICT ON CONSTRAINT feedback_rollups_pkey DO UPDATE SET
+                    positive = r.positive + EXCLUDED.positive,
+                    negative = r.negative + EXCLUDED.negative;
+            END LOOP;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION conversations_rollup_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM rollup_conversation(OLD, -1);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM rollup_conversation(NEW, 1);
+            END IF;
+            -- Feedback is keyed by its conversation's model and relevance, e.g. once a judge fills it in
+            IF TG_OP = 'UPDATE' AND (OLD.model_used, OLD.relevance) IS DISTINCT FROM (NEW.model_used, NEW.relevance) THEN
+                PERFORM rollup_feedback(f.feedback, f.timestamp, OLD.model_used, OLD.relevance, -1),
+                        rollup_feedback(f.feedback, f.timestamp, NEW.model_used, NEW.relevance, 1)
+                FROM feedback f
+                WHERE f.conversation_id = NEW.id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION feedback_rollup_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM rollup_feedback(OLD.feedback, OLD.timestamp, c.model_used, c.relevance, -1)
+                FROM (SELECT 1) AS one
+                LEFT JOIN conversations c ON c.id = OLD.conversation_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM rollup_feedback(NEW.feedback, NEW.timestamp, c.model_used, c.relevance, 1)
+                FROM (SELECT 1) AS one
+                LEFT JOIN conversations c ON c.id = NEW.conversation_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS conversations_rollup ON conversations",
+        """
+        CREATE TRIGGER conversations_rollup AFTER INSERT OR UPDATE OR DELETE ON conversations
+        FOR EACH ROW EXECUTE FUNCTION conversations_rollup_trigger()
+        """,
+        "DROP TRIGGER IF EXISTS feedback_rollup ON feedback",
+        """
+        CREATE TRIGGER feedback_rollup AFTER INSERT OR UPDATE OR DELETE ON feedback
+        FOR EACH ROW EXECUTE FUNCTION feedback_rollup_trigger()
+        """,
+    ] + ROLLUP_BACKFILL)
+)
+
+
+# All-time feedback totals per model and relevance, recomputed from the raw rows
+FEEDBACK_COUNTS_QUERY = """
+    SELECT
+        COALESCE(c.model_used, 'UNKNOWN') AS model_used, COALESCE(c.relevance, 'UNKNOWN') AS relevance,
+        count(*) FILTER (WHERE f.feedback > 0) AS thumbs_up, count(*) FILTER (WHERE f.feedback < 0) AS thumbs_down
+    FROM feedback f
+    LEFT JOIN conversations c ON c.id = f.conversation_id
+    GROUP BY 1, 2
+"""
+
+FEEDBACK_COUNTERS_REBUILD = [
+    "TRUNCATE feedback_counters",
+    f"INSERT INTO feedback_counters (model_used, relevance, thumbs_up, thumbs_down) {FEEDBACK_COUNTS_QUERY}",
+]
+
+MIGRATIONS.append(
+    # Feedback statistics are read on every app rerun, so keep running totals that triggers update in
+    # the same transaction as the feedback itself instead of aggregating the whole feedback table
+    Migration(5, "add trigger-maintained feedback counters per model and relevance", [
+        """
+        CREATE TABLE IF NOT EXISTS feedback_counters (
+            model_used TEXT NOT NULL,
+            relevance TEXT NOT NULL,
+            thumbs_up BIGINT NOT NULL,
+            thumbs_down BIGINT NOT NULL,
+            PRIMARY KEY (model_used, relevance)
+        )
+        """,
+        """
+        CREATE OR REPLACE FUNCTION count_feedback(vote INTEGER, model TEXT, verdict TEXT, sign INTEGER)
+        RETURNS VOID AS $$
+            INSERT INTO feedback_counters AS fc VALUES (
+                COALESCE(model, 'UNKNOWN'), COALESCE(verdict, 'UNKNOWN'),
+                CASE WHEN vote > 0 THEN sign ELSE 0 END,
+                CASE WHEN vote < 0 THEN sign ELSE 0 END
+            )
+            ON CONFLICT ON CONSTRAINT feedback_counters_pkey DO UPDATE SET
+                thumbs_up = fc.thumbs_up + EXCLUDED.thumbs_up,
+                thumbs_down = fc.thumbs_down + EXCLUDED.thumbs_down
+        $$ LANGUAGE sql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION feedback_counters_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM count_feedback(OLD.feedback, c.model_used, c.relevance, -1)
+                FROM (SELECT 1) AS one
+                LEFT JOIN conversations c ON c.id = OLD.conversation_id;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM count_feedback(NEW.feedback, c.model_used, c.relevance, 1)
+                FROM (SELECT 1) AS one
+                LEFT JOIN conversations c ON c.id = NEW.conversation_id;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE OR REPLACE FUNCTION conversation_feedback_counters_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            PERFORM count_feedback(f.feedback, OLD.model_used, OLD.relevance, -1),
+                    count_feedback(f.feedback, NEW.model_used, NEW.relevance, 1)
+            FROM feedback f
+            WHERE f.conversation_id = NEW.id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS feedback_counters ON feedback",
+        """
+        CREATE TRIGGER feedback_counters AFTER INSERT OR UPDATE OR DELETE ON feedback
+        FOR EACH ROW EXECUTE FUNCTION feedback_counters_trigger()
+        """,
+        "DROP TRIGGER IF EXISTS conversation_feedback_counters ON conversations",
+        """
+        CREATE TRIGGER conversation_feedback_counters AFTER UPDATE OF model_used, relevance ON conversations
+        FOR EACH ROW
+        WHEN (OLD.model_used IS DISTINCT FROM NEW.model_used OR OLD.relevance IS DISTINCT FROM NEW.relevance)
+        EXECUTE FUNCTION conversation_feedback_counters_trigger()
+        """,
+    ] + FEEDBACK_COUNTERS_REBUILD)
+)
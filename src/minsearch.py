@@ -1,25 +1,233 @@
-import pandas as pd
+import json
+import os
+import copy
+import pickle
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ProcessPoolExecutor
 
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 import numpy as np
 
 
+# Number of queries scored together by search_batch; bounds the dense score matrix size.
+BATCH_SIZE = 256
+
+# On-disk snapshot format version written by Index.save; bump it whenever the layout changes.
+SNAPSHOT_VERSION = 2
+
+# Scoring engines accepted by Index.search.
+ENGINES = ("dense", "postings", "embedding", "hybrid")
+
+# Default settings of the LSA embeddings and their IVF index, see Index.
+EMBEDDING_DEFAULTS = {"dims": 128, "n_lists": None, "n_probe": 4, "hybrid_weight": 0.3, "seed": 42}
+
+# Candidates taken from each of the lexical and embedding rankings per requested hybrid result.
+HYBRID_CANDIDATES = 4
+MANIFEST_FILE = "manifest.json"
+DOCS_FILE = "docs.pkl"
+DELETED_FILE = "deleted.npy"
+EMBEDDING_ARRAYS = ("projection", "embeddings", "centroids", "list_offsets", "list_ids", "list_vectors")
+
+
+def read_manifest(path):
+    """
+    Reads the manifest of an index snapshot without loading any arrays.
+
+    Args:
+        path (str): Directory the snapshot was saved to.
+
+    Returns:
+        dict: The snapshot manifest, including the user metadata passed to `Index.save`.
+
+    Raises:
+        FileNotFoundError: If there is no snapshot at `path`.
+        ValueError: If the snapshot was written with a different format version.
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Unsupported snapshot version {manifest.get('format_version')} (expected {SNAPSHOT_VERSION})"
+        )
+    return manifest
+
+
+def _sorted_isin(ids, sorted_values):
+    """Returns a mask of the `ids` present in the sorted array `sorted_values`."""
+    positions = np.searchsorted(sorted_values, ids)
+    found = positions < len(sorted_values)
+    found[found] = sorted_values[positions[found]] == ids[found]
+    return found
+
+
+def _merge_scores(ids_a, scores_a, ids_b, scores_b):
+    """Merges two sparse score vectors given as (ids, scores) pairs, summing the scores of shared ids."""
+    if len(ids_a) == 0:
+        return ids_b.astype(np.int64), scores_b.astype(float)
+    ids, inverse = np.unique(np.concatenate([ids_a, ids_b]), return_inverse=True)
+    scores = np.bincount(inverse, weights=np.concatenate([scores_a, scores_b]), minlength=len(ids))
+    return ids, scores
+
+
+def _top_k(scores, num_results):
+    """Returns the positions of the top `num_results` positive scores, ranked by decreasing score."""
+    num_results = min(num_results, len(scores))
+    if num_results <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    # Use argpartition to get top num_results indices
+    top_indices = np.argpartition(scores, -num_results)[-num_results:]
+    top_indices = top_indices[np.argsort(-scores[top_indices])]
+
+    # Filter out zero-score results
+    return top_indices[scores[top_indices] > 0]
+
+
+def _normalize_rows(matrix):
+    """Returns `matrix` as a C-contiguous float32 array with L2-normalized rows (zero rows stay zero)."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return np.ascontiguousarray(matrix / norms)
+
+
+class IVFIndex:
+    """
+    An inverted-file approximate nearest neighbour index over L2-normalized float32 vectors.
+
+    The vectors are clustered with k-means and every vector is stored in the list of its nearest centroid,
+    with the lists laid out contiguously. A query scores the centroids and then only the vectors of the
+    `n_probe` closest lists, so with about sqrt(n) lists its cost grows with sqrt(n) instead of n.
+
+    Attributes:
+        n_lists (int): Number of lists (k-means centroids).
+        n_probe (int): Number of lists scanned per query unless overridden.
+        centroids (np.ndarray): The (n_lists, dims) normalized centroids.
+        list_offsets (np.ndarray): Start of every list in `list_ids` and `list_vectors`, plus the end of the last.
+        list_ids (np.ndarray): The vector ids grouped by list.
+        list_vectors (np.ndarray): The vectors in the order of `list_ids`.
+    """
+
+    def __init__(self, n_lists=None, n_probe=4, seed=42):
+        """
+        Initializes the IVFIndex.
+
+        Args:
+            n_lists (int): Number of lists. Defaults to the square root of the number of vectors.
+            n_probe (int): Number of lists scanned per query. Defaults to 4.
+            seed (int): Seed of the k-means initialization. Defaults to 42.
+        """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.centroids = None
+        self.list_offsets = None
+        self.list_ids = None
+        self.list_vectors = None
+
+    def fit(self, vectors):
+        """
+        Clusters the vectors and fills the lists.
+
+        Args:
+            vectors (np.ndarray): The (n, dims) L2-normalized vectors; a vector's row is its id.
+        """
+        from sklearn.cluster import KMeans
+
+        n_lists = self.n_lists or max(1, int(round(np.sqrt(len(vectors)))))
+        n_lists = min(n_lists, len(vectors))
+        # k-means on a sample is enough to place the centroids
+        rng = np.random.default_rng(self.seed)
+        sample = vectors if len(vectors) <= 256 * n_lists else vectors[rng.choice(len(vectors), 256 * n_lists, replace=False)]
+        kmeans = KMeans(n_clusters=n_lists, n_init=1, max_iter=25, random_state=self.seed).fit(sample)
+
+        self.n_lists = n_lists
+        self.centroids = _normalize_rows(kmeans.cluster_centers_)
+        self._fill(vectors, np.arange(len(vectors), dtype=np.int64))
+        return self
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1) if len(vectors) else np.empty(0, dtype=np.int64)
+
+    def _fill(self, vectors, ids):
+        lists = self._assign(vectors)
+        order = np.argsort(lists, kind="stable")
+        self.list_ids = ids[order]
+        self.list_vectors = np.ascontiguousarray(vectors[order], dtype=np.float32)
+        self.list_offsets = np.searchsorted(lists[order], np.arange(self.n_lists + 1)).astype(np.int64)
+
+    def add(self, vectors, ids):
+        """
+        Adds vectors to the lists of their nearest centroids, without re-clustering.
+
+        Args:
+            vectors (np.ndarray): The (m, dims) L2-normalized vectors.
+            ids (np.ndarray): Their ids.
+        """
+        lists = np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets))
+        all_lists = np.concatenate([lists, self._assign(vectors)])
+        order = np.argsort(all_lists, kind="stable")
+        self.list_ids = np.concatenate([self.list_ids, np.asarray(ids, dtype=np.int64)])[order]
+        self.list_vectors = np.ascontiguousarray(np.vstack([self.list_vectors, vectors])[order], dtype=np.float32)
+        self.list_offsets = np.searchsorted(all_lists[order], np.arange(self.n_lists + 1)).astype(np.int64)
+
+    def search(self, query, num_results, n_probe=None, excluded=None):
+        """
+        Finds the vectors closest to a query by cosine similarity, among the `n_probe` closest lists.
+
+        Args:
+            query (np.ndarray): The (dims,) L2-normalized query vector.
+            num_results (int): The number of results to return.
+            n_probe (int): Number of lists to scan; `n_lists` gives exact results. Defaults to `self.n_probe`.
+            excluded (np.ndarray): Sorted ids that must not be returned.
+
+        Returns:
+            tuple: Arrays of the top ids and their scores, ranked by decreasing score.
+        """
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        probed = _top_k(self.centroids @ query + 2, n_probe)  # shifted so that every list is positive
+        ids = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probed])
+        scores = np.concatenate([
+            self.list_vectors[self.list_offsets[i]:self.list_offsets[i + 1]] @ query for i in probed
+        ])
+        if excluded is not None and len(excluded):
+            keep = ~_sorted_isin(ids, excluded)
+            ids, scores = ids[keep], scores[keep]
+        top = _top_k(scores, num_results)
+        return ids[top], scores[top]
+
+
 class Index:
     """
     A simple search index using TF-IDF and cosine similarity for text fields and exact matching for keyword fields.
 
+    Writers replace the index's arrays and containers instead of modifying them in place, so a search only
+    holds the lock while it takes a snapshot of their references and scores without blocking other searches
+    or writers.
+
     Attributes:
         text_fields (list): List of text field names to index.
         keyword_fields (list): List of keyword field names to index.
         vectorizers (dict): Dictionary of TfidfVectorizer instances for each text field.
-        keyword_df (pd.DataFrame): DataFrame containing keyword field data.
+        keyword_index (dict): For each keyword field, a mapping of value to the sorted ids of the documents holding it.
         text_matrices (dict): Dictionary of TF-IDF matrices for each text field.
-        docs (list): List of documents indexed.
+        docs (list): List of documents indexed. A document's position in this list is its id.
+        deleted (np.ndarray): Boolean tombstone mask over the document ids.
+        version (int): Counter incremented on every change to the indexed documents.
+        embedding_params (dict): Settings of the LSA embeddings, or None if the index has none.
+        projection (np.ndarray): The (terms of all text fields, dims) float32 truncated SVD projection from the
+            stacked TF-IDF fields to the embeddings.
+        embeddings (np.ndarray): The (num docs, dims) contiguous float32 matrix of L2-normalized embeddings.
+        ann (IVFIndex): Approximate nearest neighbour index over the embeddings.
     """
 
-    def __init__(self, text_fields, keyword_fields, vectorizer_params={}):
+    def __init__(self, text_fields, keyword_fields, vectorizer_params={}, embedding_params=None):
         """
         Initializes the Index with specified text and keyword fields.
 
@@ -27,70 +235,1011 @@ class Index:
             text_fields (list): List of text field names to index.
             keyword_fields (list): List of keyword field names to index.
             vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            embedding_params (dict): Optional settings to also derive LSA embeddings when fitting, enabling the
+                "embedding" and "hybrid" engines. Keys: "dims" (embedding size), "n_lists" and "n_probe" (IVF
+                lists and lists scanned per query), "hybrid_weight" (weight of the embedding score in hybrid
+                search, 0 to 1) and "seed". Missing keys take the values of EMBEDDING_DEFAULTS.
         """
         self.text_fields = text_fields
         self.keyword_fields = keyword_fields
+        self.vectorizer_params = dict(vectorizer_params)
+        self.embedding_params = dict(EMBEDDING_DEFAULTS, **embedding_params) if embedding_params is not None else None
+        self.projection = None
+        self.embeddings = None
+        self.ann = None
 
         self.vectorizers = {field: TfidfVectorizer(**vectorizer_params) for field in text_fields}
-        self.keyword_df = None
+        self.keyword_index = {}
         self.text_matrices = {}
         self.docs = []
+        self.deleted = np.zeros(0, dtype=bool)
+        self.version = 0
+        self._deleted_ids = np.empty(0, dtype=np.int64)
+        self._postings = {}
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Locks cannot be pickled and the postings are rebuilt on demand
+        del state["_lock"]
+        state["_postings"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def _snapshot(self):
+        """Returns a shallow copy sharing the current arrays, to be scored without holding the lock."""
+        with self._lock:
+            snapshot = object.__new__(type(self))
+            snapshot.__dict__.update(self.__dict__)
+            return snapshot
 
     def fit(self, docs):
         """
         Fits the index with the provided documents.
 
+        With no documents the index is reset to empty: searches return nothing and the vocabularies are
+        fitted on the first documents added.
+
         Args:
             docs (list of dict): List of documents to index. Each document is a dictionary.
         """
-        self.docs = docs
-        keyword_data = {field: [] for field in self.keyword_fields}
+        with self._lock:
+            self.docs = docs
+            self.deleted = np.zeros(len(docs), dtype=bool)
+            self._deleted_ids = np.empty(0, dtype=np.int64)
+            self._postings = {}
+
+            # Fresh vectorizers, so that snapshots taken before the refit keep their vocabularies
+            self.vectorizers = {field: TfidfVectorizer(**self.vectorizer_params) for field in self.text_fields}
+            self.text_matrices = {}
+            if not docs:
+                self.text_matrices = {field: sparse.csr_matrix((0, 0)) for field in self.text_fields}
+                self.projection = self.embeddings = self.ann = None
+                self._build_keyword_index()
+                self.version += 1
+                return self
+
+            for field in self.text_fields:
+                texts = [doc.get(field, '') for doc in docs]
+                self.text_matrices[field] = self.vectorizers[field].fit_transform(texts)
+
+            self._build_keyword_index()
+            if self.embedding_params is not None:
+                self._build_embeddings()
+            self.version += 1
+
+        return self
+
+    def _build_embeddings(self):
+        """
+        Derives the LSA embeddings with a truncated SVD of the stacked TF-IDF matrices of all text fields, and
+        builds the IVF index over them.
+        """
+        from sklearn.decomposition import TruncatedSVD
+
+        params = self.embedding_params
+        stacked = sparse.hstack([self.text_matrices[field] for field in self.text_fields], format="csr")
+        dims = max(1, min(params["dims"], stacked.shape[0] - 1, stacked.shape[1] - 1))
+        svd = TruncatedSVD(n_components=dims, random_state=params["seed"]).fit(stacked)
 
+        self.projection = np.ascontiguousarray(svd.components_.T, dtype=np.float32)
+        self.embeddings = _normalize_rows(stacked @ self.projection)
+        self.ann = IVFIndex(params["n_lists"], params["n_probe"], params["seed"]).fit(self.embeddings)
+
+    def _embed(self, field_matrices):
+        """Projects per-field TF-IDF rows into the embedding space, as normalized float32 rows."""
+        stacked = sparse.hstack(field_matrices, format="csr")
+        return _normalize_rows(stacked @ self.projection)
+
+    def _query_vectors(self, query):
+        """The L2-normalized TF-IDF vector of the query for every text field."""
+        return {field: normalize(self.vectorizers[field].transform([query])) for field in self.text_fields}
+
+    def _query_embedding(self, query_vecs, boost_dict):
+        """
+        Projects the query into the embedding space by gathering the projection rows of its terms, which is
+        much cheaper than a sparse matrix product for a single short query.
+        """
+        embedding = np.zeros(self.projection.shape[1], dtype=np.float32)
+        offset = 0
         for field in self.text_fields:
-            texts = [doc.get(field, '') for doc in docs]
-            self.text_matrices[field] = self.vectorizers[field].fit_transform(texts)
+            query_vec = query_vecs[field]
+            weights = (query_vec.data * boost_dict.get(field, 1)).astype(np.float32)
+            embedding += weights @ self.projection[offset + query_vec.indices]
+            offset += query_vec.shape[1]
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm > 0 else embedding
+
+    def add_documents(self, docs):
+        """
+        Appends documents to a fitted index without refitting it.
+
+        New documents are vectorized with the existing vocabularies and IDF weights, so terms that were not
+        seen at fit time are ignored until the next `compact`.
+
+        Args:
+            docs (list of dict): The documents to add.
 
-        for doc in docs:
+        Returns:
+            list of int: The ids assigned to the new documents.
+        """
+        docs = list(docs)
+        if not docs:
+            return []
+        with self._lock:
+            if not self.docs:
+                # Nothing to extend, e.g. after compacting away every document
+                self.fit(docs)
+                return list(range(len(docs)))
+            start = len(self.docs)
+            ids = np.arange(start, start + len(docs), dtype=np.int64)
+
+            new_rows = []
+            text_matrices = dict(self.text_matrices)
+            for field in self.text_fields:
+                texts = [doc.get(field, '') for doc in docs]
+                rows = self.vectorizers[field].transform(texts)
+                new_rows.append(rows)
+                text_matrices[field] = sparse.vstack([text_matrices[field], rows], format="csr")
+
+            if self.embeddings is not None:
+                # Embedded with the existing projection and filed under the existing centroids
+                embeddings = self._embed(new_rows)
+                ann = copy.copy(self.ann)
+                ann.add(embeddings, ids)
+                self.embeddings = np.ascontiguousarray(np.vstack([self.embeddings, embeddings]))
+                self.ann = ann
+
+            keyword_index = {field: dict(postings) for field, postings in self.keyword_index.items()}
             for field in self.keyword_fields:
-                keyword_data[field].append(doc.get(field, ''))
+                postings = keyword_index[field]
+                for doc_id, doc in zip(ids, docs):
+                    value = doc.get(field, '')
+                    postings[value] = np.append(postings.get(value, np.empty(0, dtype=np.int64)), doc_id)
 
-        self.keyword_df = pd.DataFrame(keyword_data)
+            self.text_matrices = text_matrices
+            self.keyword_index = keyword_index
+            self.docs = self.docs + docs
+            self.deleted = np.concatenate([self.deleted, np.zeros(len(docs), dtype=bool)])
+            self._postings = {}
+            self.version += 1
 
-        return self
+        return ids.tolist()
+
+    def delete_document(self, doc_id):
+        """
+        Removes a document from the search results by tombstoning it. Its rows are dropped by `compact`.
+
+        Args:
+            doc_id (int): The id of the document to delete.
+        """
+        with self._lock:
+            if not 0 <= doc_id < len(self.docs):
+                raise IndexError(f"Document id {doc_id} out of range")
+            self.deleted = self.deleted.copy()
+            self.deleted[doc_id] = True
+            self._deleted_ids = np.flatnonzero(self.deleted)
+            self.version += 1
 
-    def search(self, query, filter_dict={}, boost_dict={}, num_results=10):
+    def update_document(self, doc_id, doc):
+        """
+        Replaces a document by tombstoning the old version and appending the new one.
+
+        Args:
+            doc_id (int): The id of the document to replace.
+            doc (dict): The new version of the document.
+
+        Returns:
+            int: The id of the new version.
+        """
+        with self._lock:
+            self.delete_document(doc_id)
+            return self.add_documents([doc])[0]
+
+    def compact(self, background=False):
+        """
+        Drops tombstoned documents and refits the vectorizers, re-deriving vocabularies and IDF weights.
+
+        The new index is built without holding the lock, so searches and updates keep being served; changes
+        made while it is being built are replayed onto it before it replaces the current state.
+
+        Args:
+            background (bool): Run the compaction in a daemon thread and return immediately. Defaults to False.
+
+        Returns:
+            np.ndarray or concurrent.futures.Future: The mapping from old to new document ids (-1 for dropped
+                documents), or if `background` is True a future resolving to it once the compaction is done.
+        """
+        if background:
+            future = Future()
+
+            def run():
+                try:
+                    future.set_result(self.compact())
+                except BaseException as e:
+                    future.set_exception(e)
+
+            threading.Thread(target=run, daemon=True).start()
+            return future
+
+        with self._lock:
+            docs = self.docs
+            live = ~self.deleted
+
+        fresh = Index(self.text_fields, self.keyword_fields, self.vectorizer_params, self.embedding_params)
+        fresh.fit([doc for doc, keep in zip(docs, live) if keep])
+
+        with self._lock:
+            mapping = np.full(len(self.docs), -1, dtype=np.int64)
+            mapping[:len(docs)][live] = np.arange(live.sum())
+
+            # Replay the documents added and deleted while the new index was being fitted
+            added = self.docs[len(docs):]
+            if added:
+                mapping[len(docs):] = fresh.add_documents(added)
+            for doc_id in np.flatnonzero(self.deleted & (mapping >= 0)):
+                fresh.delete_document(mapping[doc_id])
+                mapping[doc_id] = -1
+
+            version = self.version
+            state = fresh.__getstate__()
+            state["version"] = version + 1
+            self.__dict__.update(state)
+
+        return mapping
+
+    def _build_keyword_index(self):
+        """
+        Builds the value to document ids postings of every keyword field from the document store.
+        """
+        keyword_data = {field: defaultdict(list) for field in self.keyword_fields}
+
+        for i, doc in enumerate(self.docs):
+            for field in self.keyword_fields:
+                keyword_data[field][doc.get(field, '')].append(i)
+
+        self.keyword_index = {
+            field: {value: np.array(ids, dtype=np.int64) for value, ids in postings.items()}
+            for field, postings in keyword_data.items()
+        }
+
+    def search(self, query, filter_dict={}, boost_dict={}, num_results=10, engine="dense", n_probe=None):
         """
         Searches the index with the given query, filters, and boost parameters.
 
         Args:
             query (str): The search query string.
-            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by.
+            filter_dict (dict): Dictionary of keyword fields to filter by. Keys are field names and values are the values to filter by:
+                a single value for equality, a list, tuple or set of values for membership, or {"not": value_or_values} for negation.
             boost_dict (dict): Dictionary of boost scores for text fields. Keys are field names and values are the boost scores.
             num_results (int): The number of top results to return. Defaults to 10.
+            engine (str): Scoring engine, "dense" to score every document, "postings" to walk the
+                inverted index of the query terms only, "embedding" for approximate nearest neighbours of the
+                query's LSA embedding or "hybrid" to fuse the "postings" and "embedding" scores. The last two
+                need an index created with `embedding_params`. Defaults to "dense".
+            n_probe (int): IVF lists scanned by the "embedding" and "hybrid" engines. Defaults to the
+                "n_probe" embedding setting.
 
         Returns:
             list of dict: List of documents matching the search criteria, ranked by relevance.
         """
+        index = self._snapshot()
+        top_indices, _ = index._search_ids(query, filter_dict, boost_dict, num_results, engine, n_probe)
+        return [index.docs[i] for i in top_indices]
+
+    def _search_ids(self, query, filter_dict, boost_dict, num_results, engine, n_probe=None):
+        """
+        Scores a query with the given engine.
+
+        Returns:
+            tuple: Arrays of the top document ids and their scores, ranked by decreasing score.
+        """
+        if not self.docs:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        if engine == "postings":
+            return self._search_postings(query, filter_dict, boost_dict, num_results)
+        if engine in ("embedding", "hybrid"):
+            if self.embeddings is None:
+                raise ValueError(f"The {engine!r} engine needs an index created with embedding_params")
+            if engine == "embedding":
+                return self._search_embedding(query, filter_dict, boost_dict, num_results, n_probe)
+            return self._search_hybrid(query, filter_dict, boost_dict, num_results, n_probe)
+        if engine != "dense":
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
+        allowed, excluded = self._filter_candidates(filter_dict)
+        if allowed is not None and len(allowed) == 0:
+            return allowed, np.empty(0)
         query_vecs = {field: self.vectorizers[field].transform([query]) for field in self.text_fields}
-        scores = np.zeros(len(self.docs))
+        scores = np.zeros(len(self.docs) if allowed is None else len(allowed))
 
-        # Compute cosine similarity for each text field and apply boost
+        # Compute cosine similarity for each text field and apply boost,
+        # restricted to the rows allowed by the keyword filters
         for field, query_vec in query_vecs.items():
-            sim = cosine_similarity(query_vec, self.text_matrices[field]).flatten()
+            matrix = self.text_matrices[field]
+            if allowed is not None:
+                matrix = matrix[allowed]
+            sim = cosine_similarity(query_vec, matrix).flatten()
             boost = boost_dict.get(field, 1)
             scores += sim * boost
 
-        # Apply keyword filters
+        if allowed is not None:
+            top = _top_k(scores, num_results)
+            return allowed[top], scores[top]
+
+        scores[excluded] = 0
+        top = _top_k(scores, num_results)
+        return top, scores[top]
+
+    def _keyword_ids(self, field, value):
+        """
+        Returns the sorted ids of the documents whose keyword `field` equals `value`, or any of the values
+        if `value` is a list, tuple or set.
+        """
+        postings = self.keyword_index[field]
+        if isinstance(value, (list, tuple, set, frozenset)):
+            matches = [postings[v] for v in value if v in postings]
+            return np.unique(np.concatenate(matches)) if matches else np.empty(0, dtype=np.int64)
+        return postings.get(value, np.empty(0, dtype=np.int64))
+
+    def _get_postings(self, field):
+        """
+        Returns the inverted index of a text field, building it on first use.
+
+        The postings are the column-major (CSC) form of the L2-normalized field matrix, so each term's
+        column lists the documents containing it in increasing id order with their cosine weights.
+
+        Args:
+            field (str): The text field name.
+
+        Returns:
+            tuple: The CSC postings matrix and the maximum weight of every term, used as score upper bounds.
+        """
+        if field not in self._postings:
+            postings = normalize(self.text_matrices[field]).tocsc()
+            postings.sort_indices()
+            max_weights = np.asarray(postings.max(axis=0).todense()).ravel()
+            self._postings[field] = (postings, max_weights)
+        return self._postings[field]
+
+    def _filter_candidates(self, filter_dict):
+        """
+        Resolves the keyword filters against the keyword postings.
+
+        Args:
+            filter_dict (dict): Dictionary of keyword fields to filter by.
+
+        Returns:
+            tuple: The sorted ids of the allowed documents, or None if no positive filter applies, and the
+                sorted ids of the documents excluded by negated filters or tombstones.
+        """
+        allowed = None
+        excluded = self._deleted_ids
+
         for field, value in filter_dict.items():
-            if field in self.keyword_fields:
-                mask = self.keyword_df[field] == value
-                scores = scores * mask.to_numpy()
+            if field not in self.keyword_fields:
+                continue
+            if isinstance(value, dict) and "not" in value:
+                excluded = np.union1d(excluded, self._keyword_ids(field, value["not"]))
+            else:
+                matches = self._keyword_ids(field, value)
+                allowed = matches if allowed is None else np.intersect1d(allowed, matches, assume_unique=True)
+
+        if allowed is not None and len(excluded):
+            allowed = np.setdiff1d(allowed, excluded, assume_unique=True)
+        return allowed, excluded
+
+    def _search_postings(self, query, filter_dict, boost_dict, num_results, query_vecs=None):
+        """
+        Scores a query by walking the postings lists of its terms with max-score early termination.
+
+        Terms are processed in decreasing order of their score upper bound (query weight x boost x the
+        largest document weight of the term). Once the current k-th best score is at least the sum of
+        the upper bounds of the remaining terms, no unseen document can enter the top results, so the
+        remaining postings are only used to update the existing candidates, which are pruned as their
+        own upper bounds fall below the threshold. Only documents sharing a term with the query are
+        ever touched.
+
+        Args:
+            query (str): The search query string.
+            filter_dict (dict): Dictionary of keyword fields to filter by.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+            num_results (int): The number of top results to return.
+            query_vecs (dict): The query vectors of `_query_vectors`, if already computed.
+
+        Returns:
+            tuple: Arrays of the top document ids and their scores, ranked by decreasing score.
+        """
+        allowed, excluded = self._filter_candidates(filter_dict)
+        if query_vecs is None:
+            query_vecs = self._query_vectors(query)
+
+        terms = []
+        for field in self.text_fields:
+            boost = boost_dict.get(field, 1)
+            if boost == 0:
+                continue
+            postings, max_weights = self._get_postings(field)
+            query_vec = query_vecs[field]
+            for term, weight in zip(query_vec.indices, query_vec.data):
+                start, end = postings.indptr[term], postings.indptr[term + 1]
+                if start < end:
+                    terms.append((weight * boost * max_weights[term], postings, start, end, weight * boost))
+
+        # Negative boosts break the upper bounds, so those queries are scored exhaustively
+        exhaustive = any(boost < 0 for boost in boost_dict.values())
+        terms.sort(key=lambda term: term[0], reverse=True)
+        remaining = np.cumsum([term[0] for term in terms][::-1])[::-1].tolist() + [0.0]
+
+        cand_ids = np.empty(0, dtype=np.int64)
+        cand_scores = np.empty(0)
+        threshold = -np.inf
 
-        # Use argpartition to get top num_results indices
-        top_indices = np.argpartition(scores, -num_results)[-num_results:]
-        top_indices = top_indices[np.argsort(-scores[top_indices])]
+        for i, (_, postings, start, end, weight) in enumerate(terms):
+            ids = postings.indices[start:end]
+            contributions = postings.data[start:end] * weight
+            if allowed is not None:
+                keep = _sorted_isin(ids, allowed)
+                ids, contributions = ids[keep], contributions[keep]
+            elif len(excluded):
+                keep = ~_sorted_isin(ids, excluded)
+                ids, contributions = ids[keep], contributions[keep]
 
-        # Filter out zero-score results
-        top_docs = [self.docs[i] for i in top_indices if scores[i] > 0]
+            if exhaustive or threshold < remaining[i]:
+                # Essential term: its documents may still enter the top results
+                cand_ids, cand_scores = _merge_scores(cand_ids, cand_scores, ids, contributions)
+            elif len(ids) <= len(cand_ids):
+                positions = np.searchsorted(cand_ids, ids)
+                found = positions < len(cand_ids)
+                found[found] = cand_ids[positions[found]] == ids[found]
+                cand_scores[positions[found]] += contributions[found]
+            else:
+                positions = np.searchsorted(ids, cand_ids)
+                found = positions < len(ids)
+                found[found] = ids[positions[found]] == cand_ids[found]
+                cand_scores[found] += contributions[positions[found]]
+
+            if not exhaustive and len(cand_ids) >= num_results:
+                threshold = np.partition(cand_scores, -num_results)[-num_results]
+                if threshold >= remaining[i + 1]:
+                    keep = cand_scores + remaining[i + 1] >= threshold
+                    cand_ids, cand_scores = cand_ids[keep], cand_scores[keep]
+
+        positive = cand_scores > 0
+        cand_ids, cand_scores = cand_ids[positive], cand_scores[positive]
+        order = np.argsort(-cand_scores, kind="stable")[:num_results]
+        return cand_ids[order], cand_scores[order]
+
+    def _search_embedding(self, query, filter_dict, boost_dict, num_results, n_probe, query_embedding=None):
+        """
+        Ranks documents by the cosine similarity of their embeddings to the query embedding, probing the IVF
+        index. Queries restricted by a positive keyword filter score their allowed documents exactly.
+
+        Returns:
+            tuple: Arrays of the top document ids and their scores, ranked by decreasing score.
+        """
+        if query_embedding is None:
+            query_embedding = self._query_embedding(self._query_vectors(query), boost_dict)
+        allowed, excluded = self._filter_candidates(filter_dict)
+        if allowed is not None:
+            scores = self.embeddings[allowed] @ query_embedding
+            top = _top_k(scores, num_results)
+            return allowed[top], scores[top]
+        return self.ann.search(query_embedding, num_results, n_probe=n_probe, excluded=excluded)
+
+    def _search_hybrid(self, query, filter_dict, boost_dict, num_results, n_probe):
+        """
+        Fuses lexical and embedding relevance. Candidates are the top results of the "postings" and "embedding"
+        engines; both scores are computed exactly for each candidate, scaled by their maximum over the
+        candidates and combined with the "hybrid_weight" embedding setting.
+
+        Returns:
+            tuple: Arrays of the top document ids and their scores, ranked by decreasing score.
+        """
+        num_candidates = num_results * HYBRID_CANDIDATES
+        query_vecs = self._query_vectors(query)
+        query_embedding = self._query_embedding(query_vecs, boost_dict)
+        lexical_ids, _ = self._search_postings(query, filter_dict, boost_dict, num_candidates, query_vecs)
+        embedding_ids, _ = self._search_embedding(
+            query, filter_dict, boost_dict, num_candidates, n_probe, query_embedding
+        )
+        candidates = np.union1d(lexical_ids, embedding_ids).astype(np.int64)
+        if len(candidates) == 0:
+            return candidates, np.empty(0)
+
+        lexical = np.zeros(len(candidates))
+        for field in self.text_fields:
+            rows = normalize(self.text_matrices[field][candidates])
+            lexical += (rows @ query_vecs[field].T).toarray().ravel() * boost_dict.get(field, 1)
+        semantic = np.maximum(self.embeddings[candidates] @ query_embedding, 0)
+
+        weight = self.embedding_params["hybrid_weight"]
+        scores = np.zeros(len(candidates))
+        if lexical.max() > 0:
+            scores += (1 - weight) * lexical / lexical.max()
+        if semantic.max() > 0:
+            scores += weight * semantic / semantic.max()
+        top = _top_k(scores, num_results)
+        return candidates[top], scores[top]
+
+    def search_batch(self, queries, filter_dicts=None, boost_dict=None, num_results=10):
+        """
+        Searches the index with several queries at once.
+
+        All queries are vectorized in one call and scored with a single sparse matrix product per text field,
+        and the top results are selected for every row at the same time. The results are identical to calling
+        `search` once per query with the same arguments.
+
+        Args:
+            queries (list of str): The search query strings.
+            filter_dicts (list of dict): Optional per-query filter dictionaries, aligned with `queries`.
+            boost_dict (dict): Dictionary of boost scores for text fields, shared by all queries.
+            num_results (int): The number of top results to return per query. Defaults to 10.
+
+        Returns:
+            list of list of dict: For each query, the list of matching documents ranked by relevance.
+        """
+        queries = list(queries)
+        if filter_dicts is None:
+            filter_dicts = [{}] * len(queries)
+        if boost_dict is None:
+            boost_dict = {}
+        if len(filter_dicts) != len(queries):
+            raise ValueError("filter_dicts must have one entry per query")
+
+        index = self._snapshot()
+        if not index.docs:
+            return [[] for _ in queries]
+        results = []
+        for start in range(0, len(queries), BATCH_SIZE):
+            chunk = queries[start:start + BATCH_SIZE]
+            chunk_filters = filter_dicts[start:start + BATCH_SIZE]
+            scores = np.zeros((len(chunk), len(index.docs)))
+
+            # One sparse matrix product per text field for the whole chunk
+            for field in index.text_fields:
+                query_vecs = index.vectorizers[field].transform(chunk)
+                sim = cosine_similarity(query_vecs, index.text_matrices[field])
+                boost = boost_dict.get(field, 1)
+                scores += sim * boost
+
+            # Tombstoned documents never match
+            scores[:, index._deleted_ids] = 0
+
+            # Vectorized top-k selection for every row
+            k = min(num_results, len(index.docs))
+            if k > 0:
+                top_indices = np.argpartition(scores, -k, axis=1)[:, -k:]
+                top_scores = np.take_along_axis(scores, top_indices, axis=1)
+                top_indices = np.take_along_axis(top_indices, np.argsort(-top_scores, axis=1), axis=1)
+            else:
+                top_indices = np.empty((len(chunk), 0), dtype=np.int64)
+
+            for row, filter_dict in enumerate(chunk_filters):
+                row_scores = scores[row]
+                allowed, excluded = index._filter_candidates(filter_dict)
+
+                # Filtered rows are ranked among their candidates only, exactly as search does
+                if allowed is not None:
+                    top = allowed[_top_k(row_scores[allowed], num_results)]
+                elif len(excluded) > len(index._deleted_ids):
+                    row_scores[excluded] = 0
+                    top = _top_k(row_scores, num_results)
+                else:
+                    top = top_indices[row][row_scores[top_indices[row]] > 0]
+
+                results.append([index.docs[i] for i in top])
+
+        return results
+
+    def save(self, path, metadata=None):
+        """
+        Saves the fitted index as a versioned snapshot directory.
+
+        The snapshot holds the vocabulary and IDF vector of every vectorizer, the CSR arrays of every
+        text matrix and, if present, the embedding arrays as .npy files, and the pickled document store. It is written to a temporary
+        directory first and then moved into place, so readers never see a half-written snapshot.
+
+        Args:
+            path (str): Directory to write the snapshot to. An existing snapshot there is replaced.
+            metadata (dict): Optional JSON-serializable data stored in the manifest, e.g. a source checksum.
+        """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        fields = {}
+        for i, field in enumerate(self.text_fields):
+            vectorizer = self.vectorizers[field]
+            matrix = self.text_matrices[field].tocsr()
+            prefix = f"field{i}"
+
+            with open(os.path.join(tmp_path, f"{prefix}.vocabulary.json"), "w") as f:
+                json.dump(vectorizer.get_feature_names_out().tolist(), f)
+            np.save(os.path.join(tmp_path, f"{prefix}.idf.npy"), vectorizer.idf_)
+            for name in ("data", "indices", "indptr"):
+                np.save(os.path.join(tmp_path, f"{prefix}.{name}.npy"), getattr(matrix, name))
+
+            fields[field] = {"prefix": prefix, "shape": list(matrix.shape)}
+
+        with open(os.path.join(tmp_path, DOCS_FILE), "wb") as f:
+            pickle.dump(self.docs, f, protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(os.path.join(tmp_path, DELETED_FILE), self.deleted)
+
+        embeddings = None
+        if self.embeddings is not None:
+            arrays = {
+                "projection": self.projection,
+                "embeddings": self.embeddings,
+                "centroids": self.ann.centroids,
+                "list_offsets": self.ann.list_offsets,
+                "list_ids": self.ann.list_ids,
+                "list_vectors": self.ann.list_vectors,
+            }
+            for name, array in arrays.items():
+                np.save(os.path.join(tmp_path, f"embedding.{name}.npy"), array)
+            embeddings = {"params": self.embedding_params, "n_lists": self.ann.n_lists}
+
+        manifest = {
+            "format_version": SNAPSHOT_VERSION,
+            "text_fields": self.text_fields,
+            "keyword_fields": self.keyword_fields,
+            "vectorizer_params": self.vectorizer_params,
+            "num_docs": len(self.docs),
+            "fields": fields,
+            "embeddings": embeddings,
+            "metadata": metadata or {},
+        }
+        with open(os.path.join(tmp_path, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        old_path = f"{path}.old-{os.getpid()}"
+        if os.path.exists(path):
+            os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads an index snapshot written by `save` without refitting anything.
+
+        Args:
+            path (str): Directory the snapshot was saved to.
+            mmap (bool): Memory-map the matrix arrays instead of reading them into memory. Defaults to True.
+
+        Returns:
+            Index: The restored index, ready to search.
+        """
+        manifest = read_manifest(path)
+        mmap_mode = "r" if mmap else None
+
+        embeddings = manifest.get("embeddings")
+        index = cls(
+            text_fields=manifest["text_fields"],
+            keyword_fields=manifest["keyword_fields"],
+            vectorizer_params=manifest["vectorizer_params"],
+            embedding_params=embeddings["params"] if embeddings else None,
+        )
+
+        for field, info in manifest["fields"].items():
+            prefix = os.path.join(path, info["prefix"])
+
+            with open(f"{prefix}.vocabulary.json") as f:
+                terms = json.load(f)
+            vectorizer = index.vectorizers[field]
+            vectorizer.vocabulary_ = {term: i for i, term in enumerate(terms)}
+            vectorizer.idf_ = np.load(f"{prefix}.idf.npy")
+
+            data, indices, indptr = (
+                np.load(f"{prefix}.{name}.npy", mmap_mode=mmap_mode) for name in ("data", "indices", "indptr")
+            )
+            index.text_matrices[field] = sparse.csr_matrix(
+                (data, indices, indptr), shape=tuple(info["shape"]), copy=False
+            )
+
+        with open(os.path.join(path, DOCS_FILE), "rb") as f:
+            index.docs = pickle.load(f)
+
+        index.deleted = np.load(os.path.join(path, DELETED_FILE))
+        index._deleted_ids = np.flatnonzero(index.deleted)
+        index._build_keyword_index()
+
+        if embeddings:
+            arrays = {
+                name: np.load(os.path.join(path, f"embedding.{name}.npy"), mmap_mode=mmap_mode)
+                for name in EMBEDDING_ARRAYS
+            }
+            index.projection = arrays["projection"]
+            index.embeddings = arrays["embeddings"]
+            index.ann = IVFIndex(embeddings["n_lists"], index.embedding_params["n_probe"], index.embedding_params["seed"])
+            for name in ("centroids", "list_offsets", "list_ids", "list_vectors"):
+                setattr(index.ann, name, arrays[name])
+
+        return index
+
+
+AGGREGATIONS = ("max", "sum")
+
+
+class PassageIndex:
+    """
+    A search index over passages of longer documents that ranks the parent documents.
+
+    Passages are scored like documents of an `Index`. Each parent is scored from its passages among the
+    top candidates, by its best passage ("max") or by the sum of their scores ("sum"), and is returned
+    with its best passages only.
+
+    Attributes:
+        index (Index): The underlying index over the passages.
+        parent_field (str): Keyword field holding the id of a passage's parent document.
+        passage_field (str): Text field holding the passage text.
+        position_field (str): Field holding a passage's position within its parent.
+        aggregation (str): How passage scores are combined into a parent score, "max" or "sum".
+        passages_per_parent (int): The number of best passages returned per parent.
+        candidates_per_result (int): The number of passages scored per requested result.
+        prepare (callable): Function applied to every merged parent document, or None.
+    """
+
+    def __init__(self, text_fields, keyword_fields, parent_field, passage_field, position_field="passage",
+                 vectorizer_params={}, aggregation="max", passages_per_parent=2, candidates_per_result=10,
+                 embedding_params=None, prepare=None):
+        """
+        Initializes the PassageIndex with specified text and keyword fields.
+
+        Args:
+            text_fields (list): List of text field names to index.
+            keyword_fields (list): List of keyword field names to index. The parent field is added if missing.
+            parent_field (str): Keyword field holding the id of a passage's parent document.
+            passage_field (str): Text field holding the passage text.
+            position_field (str): Field holding a passage's position within its parent. Defaults to "passage".
+            vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            aggregation (str): "max" or "sum". Defaults to "max".
+            passages_per_parent (int): The number of best passages returned per parent. Defaults to 2.
+            candidates_per_result (int): The number of passages scored per requested result. Defaults to 10.
+            embedding_params (dict): Optional LSA embedding settings, as for `Index`.
+            prepare (callable): Optional function applied to every merged parent document, e.g. to add fields
+                derived from the merged text like those the passages got at ingest. It runs once per combination
+                of passages; the result is reused until the index changes.
+        """
+        if aggregation not in AGGREGATIONS:
+            raise ValueError(f"Unknown aggregation {aggregation!r}, expected one of {AGGREGATIONS}")
+        if parent_field not in keyword_fields:
+            keyword_fields = list(keyword_fields) + [parent_field]
+
+        self.index = Index(text_fields, keyword_fields, vectorizer_params, embedding_params)
+        self.parent_field = parent_field
+        self.passage_field = passage_field
+        self.position_field = position_field
+        self.aggregation = aggregation
+        self.passages_per_parent = passages_per_parent
+        self.candidates_per_result = candidates_per_result
+        self.prepare = prepare
+        self._merged = {}
+        self._merged_version = None
+
+    @property
+    def version(self):
+        return self.index.version
+
+    @property
+    def docs(self):
+        return self.index.docs
+
+    def fit(self, passages):
+        """
+        Fits the index with the provided passages.
+
+        Args:
+            passages (list of dict): The passages to index, each holding its parent id and position.
+        """
+        self.index.fit(passages)
+        return self
+
+    def search(self, query, filter_dict={}, boost_dict={}, num_results=10, engine="dense", n_probe=None):
+        """
+        Searches the passages and returns the best parent documents.
+
+        Args:
+            query (str): The search query string.
+            filter_dict (dict): Dictionary of keyword fields to filter by, as for `Index.search`.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+            num_results (int): The number of parent documents to return. Defaults to 10.
+            engine (str): Scoring engine, as for `Index.search`. Defaults to "dense".
+            n_probe (int): IVF lists scanned by the "embedding" and "hybrid" engines.
+
+        Returns:
+            list of dict: One document per parent, ranked by parent score. A parent matched by a single passage
+                is returned as that passage; otherwise its best passages are joined in document order into the
+                passage field and their positions are listed under "passages".
+        """
+        index = self.index._snapshot()
+        ids, scores = index._search_ids(
+            query, filter_dict, boost_dict, num_results * self.candidates_per_result, engine, n_probe
+        )
+        if self._merged_version != index.version:
+            self._merged, self._merged_version = {}, index.version
+
+        # Candidates arrive ranked, so every parent's passages are too
+        groups = {}
+        for passage_id, score in zip(ids, scores):
+            passage = index.docs[passage_id]
+            groups.setdefault(passage[self.parent_field], []).append((score, passage_id, passage))
+
+        if self.aggregation == "max":
+            parent_scores = {parent: group[0][0] for parent, group in groups.items()}
+        else:
+            parent_scores = {parent: sum(score for score, _, _ in group) for parent, group in groups.items()}
+        ranked = sorted(groups, key=lambda parent: -parent_scores[parent])[:num_results]
+
+        return [self._merge(groups[parent][:self.passages_per_parent]) for parent in ranked]
+
+    def _merge(self, group):
+        if len(group) == 1:
+            return group[0][2]
+        key = tuple(sorted(int(passage_id) for _, passage_id, _ in group))
+        merged = self._merged.get(key)
+        if merged is None:
+            merged = self._merged[key] = self._merge_passages([passage for _, _, passage in group])
+        return merged
+
+    def _merge_passages(self, passages):
+        passages = sorted(passages, key=lambda passage: passage.get(self.position_field, 0))
+        fields = self.index.text_fields + self.index.keyword_fields
+        merged = {field: passages[0][field] for field in fields if field in passages[0]}
+        merged[self.passage_field] = " \n ".join(passage[self.passage_field] for passage in passages)
+        merged["passages"] = [passage.get(self.position_field) for passage in passages]
+        return self.prepare(merged) if self.prepare is not None else merged
+
+    def save(self, path, metadata=None):
+        """
+        Saves the fitted index as a snapshot directory, like `Index.save`.
+
+        Args:
+            path (str): Directory to write the snapshot to.
+            metadata (dict): Optional JSON-serializable data stored in the manifest.
+        """
+        settings = {
+            "parent_field": self.parent_field,
+            "passage_field": self.passage_field,
+            "position_field": self.position_field,
+            "aggregation": self.aggregation,
+            "passages_per_parent": self.passages_per_parent,
+            "candidates_per_result": self.candidates_per_result,
+        }
+        self.index.save(path, metadata=dict(metadata or {}, passage_index=settings))
+
+    @classmethod
+    def load(cls, path, mmap=True, **overrides):
+        """
+        Loads a snapshot written by `save`.
+
+        Args:
+            path (str): Directory the snapshot was saved to.
+            mmap (bool): Memory-map the matrix arrays. Defaults to True.
+            **overrides: Search settings replacing the saved ones, e.g. `passages_per_parent`.
+
+        Returns:
+            PassageIndex: The restored index, ready to search.
+        """
+        index = Index.load(path, mmap=mmap)
+        settings = dict(read_manifest(path)["metadata"]["passage_index"], **overrides)
+        passage_index = cls(index.text_fields, index.keyword_fields, **settings)
+        passage_index.index = index
+        return passage_index
+
+
+# Shard held by a ShardedIndex worker process, set by _init_shard.
+_shard = None
+_shard_offset = 0
+
+
+def _init_shard(shard, offset):
+    global _shard, _shard_offset
+    _shard = shard
+    _shard_offset = offset
+
+
+def _search_shard(query, filter_dict, boost_dict, num_results, engine):
+    ids, scores = _shard._search_ids(query, filter_dict, boost_dict, num_results, engine)
+    return ids + _shard_offset, scores
+
+
+class ShardedIndex:
+    """
+    A search index whose documents are partitioned across shards that are scored in parallel worker processes.
+
+    The vectorizers are fitted once on the whole corpus and shared by every shard, so all shards use the same
+    vocabulary and IDF statistics and the merged ranking matches the one of an unsharded `Index`.
+
+    Attributes:
+        text_fields (list): List of text field names to index.
+        keyword_fields (list): List of keyword field names to index.
+        num_shards (int): Number of shards, each served by its own worker process.
+        docs (list): List of documents indexed.
+    """
+
+    def __init__(self, text_fields, keyword_fields, vectorizer_params={}, num_shards=None):
+        """
+        Initializes the ShardedIndex with specified text and keyword fields.
+
+        Args:
+            text_fields (list): List of text field names to index.
+            keyword_fields (list): List of keyword field names to index.
+            vectorizer_params (dict): Optional parameters to pass to TfidfVectorizer.
+            num_shards (int): Number of shards. Defaults to the number of CPUs.
+        """
+        self.text_fields = text_fields
+        self.keyword_fields = keyword_fields
+        self.vectorizer_params = dict(vectorizer_params)
+        self.num_shards = num_shards or os.cpu_count() or 1
+        self.docs = []
+        self._pools = []
+
+    def fit(self, docs):
+        """
+        Fits the shared vectorizers on all documents, splits the matrices into contiguous shards and starts
+        one worker process per shard.
+
+        Args:
+            docs (list of dict): List of documents to index. Each document is a dictionary.
+        """
+        self.close()
+        full = Index(self.text_fields, self.keyword_fields, self.vectorizer_params).fit(docs)
+        self.docs = full.docs
+
+        bounds = np.linspace(0, len(docs), self.num_shards + 1).astype(int)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            shard = Index(self.text_fields, self.keyword_fields, self.vectorizer_params)
+            shard.vectorizers = full.vectorizers
+            shard.text_matrices = {field: matrix[start:stop] for field, matrix in full.text_matrices.items()}
+            shard.docs = full.docs[start:stop]
+            shard.deleted = np.zeros(stop - start, dtype=bool)
+            shard._build_keyword_index()
+
+            pool = ProcessPoolExecutor(max_workers=1, initializer=_init_shard, initargs=(shard, int(start)))
+            self._pools.append(pool)
+
+        return self
+
+    def search(self, query, filter_dict={}, boost_dict={}, num_results=10, engine="dense"):
+        """
+        Searches all shards in parallel and merges their top results.
+
+        Args:
+            query (str): The search query string.
+            filter_dict (dict): Dictionary of keyword fields to filter by, as in `Index.search`.
+            boost_dict (dict): Dictionary of boost scores for text fields.
+            num_results (int): The number of top results to return. Defaults to 10.
+            engine (str): Scoring engine used by every shard, as in `Index.search`. Defaults to "dense".
+
+        Returns:
+            list of dict: List of documents matching the search criteria, ranked by relevance.
+        """
+        futures = [
+            pool.submit(_search_shard, query, filter_dict, boost_dict, num_results, engine)
+            for pool in self._pools
+        ]
+        results = [future.result() for future in futures]
+
+        ids = np.concatenate([ids for ids, _ in results])
+        scores = np.concatenate([scores for _, scores in results])
+        top = np.argsort(-scores, kind="stable")[:num_results]
+        return [self.docs[i] for i in ids[top]]
+
+    def close(self):
+        """
+        Shuts down the shard worker processes.
+        """
+        for pool in self._pools:
+            pool.shutdown()
+        self._pools = []
+
+    def __enter__(self):
+        return self
 
-        return top_docs
\ No newline at end of file
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -1,9 +1,13 @@
 import json
+import asyncio
 from time import time
-from groq import Groq
 from dotenv import load_dotenv
 import os
+import threading
 import ingest
+import cache
+import context
+import judge
 import logging
 
 # Set up logging
@@ -12,26 +16,114 @@ logger = logging.getLogger(__name__)
 
 load_dotenv()
 
-groq_api_key = os.getenv("GROQ_API_KEY")
-client = Groq(api_key=groq_api_key)
+# Point the LLM clients at any Groq-compatible endpoint, e.g. the local stub_llm.py server
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL")
 
-# Load the search index
-try:
-    index = ingest.load_index()
-except Exception as e:
-    logger.error(f"Failed to load index: {e}")
-    raise
+# The LLM clients, the search index and the answer cache are built on first use, once per process,
+# so importing this module stays cheap and free of side effects
+_resources = {}
+_resources_lock = threading.RLock()
 
-if index is None:
-    raise ValueError("Search index could not be loaded")
+
+def _resource(name, create):
+    if name not in _resources:
+        with _resources_lock:
+            if name not in _resources:
+                _resources[name] = create()
+    return _resources[name]
+
+
+# Every LLM call goes through llm_client.LLMClient, which owns retries, so the Groq clients do not retry.
+# Rate limits apply per model and can be overridden per model with a JSON object, e.g.
+# LLM_MODEL_LIMITS='{"llama3-70b-8192": {"requests_per_minute": 30, "tokens_per_minute": 6000}}'
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "0"))
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "0"))
+LLM_MODEL_LIMITS = json.loads(os.getenv("LLM_MODEL_LIMITS", "{}"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "60"))
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+# Percentile of recent latencies after which a duplicate request is sent, e.g. 95; empty disables hedging
+LLM_HEDGE_PERCENTILE = os.getenv("LLM_HEDGE_PERCENTILE", "")
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+
+def _create_client():
+    from groq import Groq
+    return Groq(api_key=os.getenv("GROQ_API_KEY"), base_url=GROQ_BASE_URL, max_retries=0)
+
+
+def _create_async_client():
+    from groq import AsyncGroq
+    return AsyncGroq(api_key=os.getenv("GROQ_API_KEY"), base_url=GROQ_BASE_URL, max_retries=0)
+
+
+def _create_llm_client():
+    from llm_client import LLMClient
+    return LLMClient(
+        get_client,
+        get_async_client,
+        requests_per_minute=LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute=LLM_TOKENS_PER_MINUTE,
+        model_limits=LLM_MODEL_LIMITS,
+        deadline=LLM_DEADLINE,
+        attempt_timeout=LLM_ATTEMPT_TIMEOUT,
+        max_retries=LLM_MAX_RETRIES,
+        hedge_percentile=float(LLM_HEDGE_PERCENTILE) if LLM_HEDGE_PERCENTILE else None,
+        breaker_threshold=LLM_BREAKER_THRESHOLD,
+        breaker_cooldown=LLM_BREAKER_COOLDOWN,
+    )
+
+
+def get_client():
+    return _resource("client", _create_client)
+
+
+def get_async_client():
+    return _resource("async_client", _create_async_client)
+
+
+def get_llm_client():
+    """The resilient LLMClient every LLM call in this module goes through."""
+    return _resource("llm_client", _create_llm_client)
+
+
+def _load_index():
+    # Load the search index
+    try:
+        index = ingest.load_index()
+    except Exception as e:
+        logger.error(f"Failed to load index: {e}")
+        raise
+
+    if index is None:
+        raise ValueError("Search index could not be loaded")
+    return index
+
+
+def get_index():
+    return _resource("index", _load_index)
+
+
+# Retrieval cache keyed by normalized query, invalidated whenever the index changes
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+search_cache = cache.LRUCache(max_size=SEARCH_CACHE_SIZE)
 
 def search(query):
     try:
-        results = index.search(
-            query=query,
-            num_results=10
-        )
-        return results
+        index = get_index()
+        version = (index, index.version)
+        search_cache.set_version(version)
+        key = cache.normalize_query(query)
+        results = search_cache.get(key)
+        if results is None:
+            results = index.search(
+                query=query,
+                num_results=10,
+                engine=ingest.SEARCH_ENGINE,
+            )
+            search_cache.put(key, results, version=version)
+        return list(results)
     except Exception as e:
         logger.error(f"Error in search function: {e}")
         return []
@@ -54,23 +146,29 @@ Your response should be in plain text and should not include any code blocks or
 Answer:
 """.strip()
 
-entry_template = """ 
-questions={Questions}
-answers={Answers}
-""".strip()
+entry_template = context.entry_template
 
-def build_prompt(query, search_results):
-    context = ""
-    for doc in search_results:
-        context = context + entry_template.format(**doc) + "\n\n"
-    prompt = prompt_template.format(question=query, context=context).strip()
+# Token budget for the retrieved context, per model; other models get PROMPT_CONTEXT_BUDGET, 0 means no limit.
+# Override per model with a JSON object, e.g. PROMPT_CONTEXT_BUDGETS='{"llama3-70b-8192": 2000}'
+PROMPT_CONTEXT_BUDGET = int(os.getenv("PROMPT_CONTEXT_BUDGET", "1500"))
+PROMPT_CONTEXT_BUDGETS = {
+    "gemma2-9b-it": 1200,
+    "llama3-70b-8192": 1500,
+    "mixtral-8x7b-32768": 2500,
+    **json.loads(os.getenv("PROMPT_CONTEXT_BUDGETS", "{}")),
+}
+
+def build_prompt(query, search_results, model=None, stats=None):
+    budget = PROMPT_CONTEXT_BUDGETS.get(model, PROMPT_CONTEXT_BUDGET)
+    context_text, context_stats = context.assemble_context(search_results, budget)
+    if stats is not None:
+        stats.update(context_stats)
+    prompt = prompt_template.format(question=query, context=context_text).strip()
     return prompt
 
 def llm(prompt, model="mixtral-8x7b-32768"):
     start_time = time()
-    response = client.chat.completions.create(
-        model=model, messages=[{"role": "user", "content": prompt}]
-    )
+    response = get_llm_client().create(model, [{"role": "user", "content": prompt}])
 
     answer = response.choices[0].message.content
 
@@ -84,8 +182,24 @@ def llm(prompt, model="mixtral-8x7b-32768"):
 
     return answer, token_stats, response_time    
 
-def evaluate_relevance(question, answer, model='mixtral-8x7b-32768'):
-    eval_prompt = f"""
+async def allm(prompt, model="mixtral-8x7b-32768"):
+    start_time = time()
+    response = await get_llm_client().acreate(model, [{"role": "user", "content": prompt}])
+
+    answer = response.choices[0].message.content
+
+    token_stats = {
+        "prompt_tokens": response.usage.prompt_tokens,
+        "completion_tokens": response.usage.completion_tokens,
+        "total_tokens": response.usage.total_tokens,
+    }
+    end_time = time()
+    response_time = end_time - start_time
+
+    return answer, token_stats, response_time
+
+def build_eval_prompt(question, answer):
+    return f"""
 You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
 Your task is to analyze the relevance of the generated answer to the given question.
 Based on the relevance of the generated answer, you will classify it
@@ -102,36 +216,180 @@ and provide your evaluation in parsable JSON without using code blocks:
 "Explanation": "[Provide a brief explanation for your evaluation]"
 """.strip()
 
-    evaluation, tokens, _ = llm(eval_prompt, model)
-    
+def parse_evaluation(evaluation):
     try:
         json_eval = json.loads(evaluation)
         relevance = json_eval['Relevance'].upper()  # Ensure it's uppercase
         if relevance not in ["NON_RELEVANT", "PARTLY_RELEVANT", "RELEVANT"]:
             logger.warning(f"Unexpected relevance value: {relevance}. Defaulting to PARTLY_RELEVANT.")
             relevance = "PARTLY_RELEVANT"
-        return relevance, json_eval['Explanation'], tokens
+        return relevance, json_eval['Explanation']
     except json.JSONDecodeError:
         logger.error(f"Failed to parse evaluation JSON: {evaluation}")
-        return "PARTLY_RELEVANT", "Failed to parse evaluation", tokens
+        return "PARTLY_RELEVANT", "Failed to parse evaluation"
 
+def evaluate_relevance(question, answer, model='mixtral-8x7b-32768'):
+    evaluation, tokens, _ = llm(build_eval_prompt(question, answer), model)
+    relevance, explanation = parse_evaluation(evaluation)
+    return relevance, explanation, tokens
 
-def rag(query, model="mixtral-8x7b-32768"):
-    t0 = time()
+async def aevaluate_relevance(question, answer, model='mixtral-8x7b-32768'):
+    evaluation, tokens, _ = await allm(build_eval_prompt(question, answer), model)
+    relevance, explanation = parse_evaluation(evaluation)
+    return relevance, explanation, tokens
+
+
+# Full-answer cache: "disk" (local SQLite file), "postgres" or "none"
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "disk")
+ANSWER_CACHE_PATH = os.getenv(
+    "ANSWER_CACHE_PATH", os.path.join(os.path.dirname(ingest.DATA_PATH), "answer_cache.sqlite")
+)
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+
+def _create_answer_cache():
+    try:
+        return cache.create_answer_cache(
+            ANSWER_CACHE_BACKEND,
+            path=ANSWER_CACHE_PATH,
+            ttl=ANSWER_CACHE_TTL,
+            max_entries=ANSWER_CACHE_SIZE,
+        )
+    except Exception as e:
+        logger.error(f"Failed to set up answer cache, continuing without it: {e}")
+        return None
+
+
+def get_answer_cache():
+    """The configured AnswerCache, or None when caching is disabled or unavailable."""
+    return _resource("answer_cache", _create_answer_cache)
+
+
+# Relevance placeholder stored until a background judgement of the answer completes
+PENDING_RELEVANCE = "PENDING"
+
+# "inline" judges relevance inside rag(); "batch" queues answers for the background RelevanceJudge,
+# which judges several at once and fills in the saved conversations rows
+RELEVANCE_JUDGE_MODE = os.getenv("RELEVANCE_JUDGE_MODE", "inline")
+# How long a verdict is re-applied while its conversation row is missing; with DB_WRITE_MODE=buffered
+# the row only lands at the writer's next flush, which backs off to 30 flush intervals while the
+# database is unreachable
+RELEVANCE_JUDGE_UPDATE_WINDOW = float(os.getenv(
+    "RELEVANCE_JUDGE_UPDATE_WINDOW", str(max(60.0, 30 * float(os.getenv("WRITE_BUFFER_INTERVAL", "1.0"))))
+))
+def _update_conversation_relevance(conversation_id, judgement):
+    import db  # only needed once background judging is used
+    return db.update_conversation_relevance(conversation_id, judgement)
 
+relevance_judge = judge.RelevanceJudge(
+    llm,
+    _update_conversation_relevance,
+    batch_size=int(os.getenv("RELEVANCE_JUDGE_BATCH_SIZE", "8")),
+    max_wait=float(os.getenv("RELEVANCE_JUDGE_MAX_WAIT", "2.0")),
+    update_window=RELEVANCE_JUDGE_UPDATE_WINDOW,
+)
+
+
+def context_ids(search_results):
+    """
+    Identify the context an answer was generated from, for its cache key: passages of the same document
+    share its Question_ID, so their positions ("passage", or "passages" once merged) are part of the id.
+    """
+    ids = []
+    for doc in search_results:
+        positions = doc.get("passages", doc.get("passage"))
+        ids.append(doc.get("Question_ID") if positions is None else f"{doc.get('Question_ID')}:{positions}")
+    return ids
+
+
+def defer_judgement(conversation_id):
+    return RELEVANCE_JUDGE_MODE == "batch" and conversation_id is not None
+
+
+def submit_judgement(query, answer_data, conversation_id, key=None):
+    callback = None
+    answer_cache = get_answer_cache()
+    if key is not None and answer_cache is not None:
+        # Cache the answer once it has its verdict
+        callback = lambda judgement: answer_cache.put(key, dict(answer_data, **judgement, cached=False))
+    relevance_judge.submit(
+        query, answer_data['answer'], answer_data['model_used'],
+        conversation_id=conversation_id, callback=callback,
+    )
+
+
+def record_timing(timings, stage, start):
+    """Add the seconds elapsed since `start` to `timings[stage]`, if the caller asked for timings."""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time() - start
+
+
+def rag(query, model="mixtral-8x7b-32768", conversation_id=None, timings=None):
+    start = time()
     search_results = search(query)
-    prompt = build_prompt(query, search_results)
+    record_timing(timings, "search", start)
+    judge_inline = not defer_judgement(conversation_id)
+
+    key = None
+    answer_cache = get_answer_cache()
+    if answer_cache is None:
+        answer_data = generate_answer(
+            query, search_results, model=model, judge_inline=judge_inline, timings=timings
+        )
+    else:
+        key = answer_cache.make_key(query, model, context_ids(search_results))
+        answer_data, cached = answer_cache.get_or_compute(
+            key,
+            lambda: generate_answer(
+                query, search_results, model=model, judge_inline=judge_inline, timings=timings
+            ),
+            should_cache=lambda data: data['relevance'] != PENDING_RELEVANCE,
+        )
+        answer_data = dict(answer_data, cached=cached)
+
+    if answer_data['relevance'] == PENDING_RELEVANCE and conversation_id is not None:
+        submit_judgement(query, answer_data, conversation_id, key=key)
+    return answer_data
+
+
+def generate_answer(query, search_results, model="mixtral-8x7b-32768", judge_inline=True, timings=None):
+    t0 = time()
+
+    prompt_stats = {}
+    prompt = build_prompt(query, search_results, model=model, stats=prompt_stats)
+    record_timing(timings, "prompt", t0)
+    start = time()
     answer, tokens, response_time = llm(prompt, model=model)
+    record_timing(timings, "llm", start)
 
-    relevance, explanation, eval_tokens = evaluate_relevance(query, answer, model=model)
+    if judge_inline:
+        start = time()
+        relevance, explanation, eval_tokens = evaluate_relevance(query, answer, model=model)
+        record_timing(timings, "judge", start)
+    else:
+        relevance, explanation = PENDING_RELEVANCE, ""
+        eval_tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
     
     t1 = time()
     took = t1 - t0
 
-    answer_data = {
+    # Without streaming the first token arrives with the whole response
+    return build_answer_data(
+        answer, model, response_time, tokens, relevance, explanation, eval_tokens,
+        time_to_first_token=response_time,
+        tokens_per_second=tokens['completion_tokens'] / response_time if response_time > 0 else None,
+        prompt_tokens_saved=prompt_stats['tokens_saved'],
+    )
+
+
+def build_answer_data(answer, model, response_time, tokens, relevance, explanation, eval_tokens,
+                      time_to_first_token=None, tokens_per_second=None, prompt_tokens_saved=0):
+    return {
         'answer': answer,
         'model_used': model,
         'response_time': response_time,
+        'time_to_first_token': time_to_first_token,
+        'tokens_per_second': tokens_per_second,
         'relevance': relevance,
         'relevance_explanation': explanation,
         'prompt_tokens': tokens['prompt_tokens'],
@@ -140,6 +398,344 @@ def rag(query, model="mixtral-8x7b-32768"):
         'eval_prompt_tokens': eval_tokens['prompt_tokens'],
         'eval_completion_tokens': eval_tokens['completion_tokens'],
         'eval_total_tokens': eval_tokens['total_tokens'],
+        # Estimated context tokens left out of the prompt by the token budget and deduplication
+        'prompt_tokens_saved': prompt_tokens_saved,
+        'cached': False,
     }
 
-    return answer_data
\ No newline at end of file
+
+class LLMStream:
+    """
+    Iterates over the text chunks of a streamed completion as they arrive. Once exhausted it holds the
+    full answer, the token usage and the timing metrics, like the return value of llm().
+    """
+
+    def __init__(self, prompt, model="mixtral-8x7b-32768"):
+        self.prompt = prompt
+        self.model = model
+        self.answer = None
+        self.token_stats = None
+        self.response_time = None
+        self.time_to_first_token = None
+        self.tokens_per_second = None
+        self._chunks = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._chunks is None:
+            self._chunks = self._generate()
+        return next(self._chunks)
+
+    def _generate(self):
+        start_time = time()
+        first_token_time = None
+        parts = []
+        usage = None
+
+        stream = get_llm_client().stream(self.model, [{"role": "user", "content": self.prompt}])
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_time is None:
+                    first_token_time = time()
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+
+            # Groq reports usage on the last chunk under x_groq, OpenAI-compatible servers under usage
+            x_groq = getattr(chunk, "x_groq", None)
+            chunk_usage = getattr(x_groq, "usage", None) or getattr(chunk, "usage", None)
+            if chunk_usage is not None:
+                usage = chunk_usage
+
+        end_time = time()
+        self.answer = "".join(parts)
+        if usage is not None:
+            self.token_stats = {
+                "prompt_tokens": usage.prompt_tokens,
+                "completion_tokens": usage.completion_tokens,
+                "total_tokens": usage.total_tokens,
+            }
+        else:
+            logger.warning("Streamed response carried no token usage, counting chunks instead")
+            self.token_stats = {"prompt_tokens": 0, "completion_tokens": len(parts), "total_tokens": len(parts)}
+
+        self.response_time = end_time - start_time
+        if first_token_time is not None:
+            self.time_to_first_token = first_token_time - start_time
+            generation_time = end_time - first_token_time
+            if generation_time > 0:
+                self.tokens_per_second = self.token_stats["completion_tokens"] / generation_time
+
+
+def llm_stream(prompt, model="mixtral-8x7b-32768"):
+    return LLMStream(prompt, model=model)
+
+
+class RagStream:
+    """
+    Streaming counterpart of rag(): iterate over it to receive the answer text as it is generated,
+    then call finish() to judge relevance and get the complete answer_data.
+
+    Like rag(), concurrent identical questions share one generation: the first stream leads it and the
+    others wait for its answer, then replay it as a single chunk.
+    """
+
+    def __init__(self, query, model="mixtral-8x7b-32768", conversation_id=None):
+        self.query = query
+        self.model = model
+        self.conversation_id = conversation_id
+        self.search_results = search(query)
+        self._answer_data = None
+        self._key = None
+        self._flight = None
+        self._leader = False
+        self._llm_stream = None
+        self._prompt_stats = {"tokens_saved": 0}
+        self._answer_cache = get_answer_cache()
+
+        if self._answer_cache is not None:
+            self._key = self._answer_cache.make_key(query, model, context_ids(self.search_results))
+            cached_answer = self._answer_cache.get(self._key)
+            if cached_answer is not None:
+                self._answer_data = dict(cached_answer, cached=True)
+            else:
+                self._flight, self._leader = self._answer_cache.join(self._key)
+
+        if self._answer_data is not None:
+            self.stream = iter([self._answer_data['answer']])
+        elif self._flight is not None and not self._leader:
+            self.stream = self._follow()
+        else:
+            try:
+                self._start()
+            except Exception as e:
+                self._settle(error=e)
+                raise
+            self.stream = self._lead()
+
+    def __iter__(self):
+        return self.stream
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """Abandon the generation if it was never finished, so streams waiting for it generate their own."""
+        if getattr(self, "_leader", False):
+            self._settle()
+
+    def _start(self):
+        prompt = build_prompt(self.query, self.search_results, model=self.model, stats=self._prompt_stats)
+        self._llm_stream = llm_stream(prompt, model=self.model)
+
+    def _lead(self):
+        try:
+            yield from self._llm_stream
+        except Exception as e:
+            self._settle(error=e)
+            raise
+
+    def _follow(self):
+        flight, self._flight = self._flight, None
+        flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        if flight.value is not None:
+            self._answer_data = dict(flight.value, cached=True)
+            if self._answer_data['relevance'] == PENDING_RELEVANCE and self.conversation_id is not None:
+                submit_judgement(self.query, self._answer_data, self.conversation_id, key=self._key)
+            yield self._answer_data['answer']
+            return
+
+        # The leading stream was abandoned before it answered
+        self._start()
+        yield from self._llm_stream
+
+    def _settle(self, value=None, error=None, store=True):
+        """End the shared generation, or without one store the answer in the cache."""
+        if self._leader:
+            self._leader = False
+            self._answer_cache.settle(self._key, self._flight, value, error, store=store)
+        elif value is not None and store and self._key is not None:
+            self._answer_cache.put(self._key, value)
+
+    def finish(self):
+        # Drain whatever the caller did not consume
+        for _ in self.stream:
+            pass
+        if self._answer_data is not None:
+            return self._answer_data
+
+        try:
+            # Also covers a stream the caller closed early
+            for _ in self._llm_stream:
+                pass
+
+            if defer_judgement(self.conversation_id):
+                relevance, explanation = PENDING_RELEVANCE, ""
+                eval_tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            else:
+                relevance, explanation, eval_tokens = evaluate_relevance(
+                    self.query, self._llm_stream.answer, model=self.model
+                )
+        except Exception as e:
+            self._settle(error=e)
+            raise
+
+        self._answer_data = build_answer_data(
+            self._llm_stream.answer, self.model, self._llm_stream.response_time, self._llm_stream.token_stats,
+            relevance, explanation, eval_tokens,
+            time_to_first_token=self._llm_stream.time_to_first_token,
+            tokens_per_second=self._llm_stream.tokens_per_second,
+            prompt_tokens_saved=self._prompt_stats['tokens_saved'],
+        )
+        if relevance == PENDING_RELEVANCE:
+            submit_judgement(self.query, self._answer_data, self.conversation_id, key=self._key)
+        # Answers still waiting for their verdict are stored by the judge callback
+        self._settle(dict(self._answer_data), store=relevance != PENDING_RELEVANCE)
+        return self._answer_data
+
+
+def rag_stream(query, model="mixtral-8x7b-32768", conversation_id=None):
+    return RagStream(query, model=model, conversation_id=conversation_id)
+
+
+# Keep references to running judgements so they are not garbage collected mid-flight
+_judge_tasks = set()
+# Cache key -> the relevance judgement its flight's leader is running, for the followers to share
+_judgements = {}
+
+
+async def arag(query, model="mixtral-8x7b-32768", on_judged=None):
+    search_results = await asyncio.to_thread(search, query)
+
+    key = flight = None
+    answer_cache = await asyncio.to_thread(get_answer_cache)
+    if answer_cache is not None:
+        key = answer_cache.make_key(query, model, context_ids(search_results))
+        while flight is None:
+            cached_answer = await asyncio.to_thread(answer_cache.get, key)
+            if cached_answer is not None:
+                return dict(cached_answer, cached=True)
+
+            # Concurrent identical requests share one generation, as in rag()
+            flight, leader = answer_cache.join(key)
+            if not leader:
+                await flight.wait()
+                if flight.error is not None:
+                    raise flight.error
+                if flight.value is not None:
+                    answer_data = dict(flight.value, cached=True)
+                    if answer_data['relevance'] == PENDING_RELEVANCE:
+                        _start_judging(_follow_judgement(query, answer_data, model, _judgements.get(key), on_judged))
+                    return answer_data
+                flight = None
+
+    answer_data = error = None
+    try:
+        prompt_stats = {}
+        prompt = build_prompt(query, search_results, model=model, stats=prompt_stats)
+        answer, tokens, response_time = await allm(prompt, model=model)
+
+        no_tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        answer_data = build_answer_data(
+            answer, model, response_time, tokens, PENDING_RELEVANCE, "", no_tokens,
+            time_to_first_token=response_time,
+            tokens_per_second=tokens['completion_tokens'] / response_time if response_time > 0 else None,
+            prompt_tokens_saved=prompt_stats['tokens_saved'],
+        )
+
+        # Judge relevance off the critical path; the caller gets the answer right away
+        task = _start_judging(_judge_answer(query, answer_data, model, key, on_judged))
+        if flight is not None:
+            _judgements[key] = task
+            task.add_done_callback(lambda _: _judgements.pop(key, None))
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        if flight is not None:
+            # Shared with the waiting callers now, stored by _judge_answer once it has its verdict
+            answer_cache.settle(key, flight, dict(answer_data) if answer_data else None, error, store=False)
+
+    return answer_data
+
+
+def _start_judging(coro):
+    task = asyncio.create_task(coro)
+    _judge_tasks.add(task)
+    task.add_done_callback(_judge_tasks.discard)
+    return task
+
+
+async def _follow_judgement(query, answer_data, model, leader_task, on_judged):
+    """Give a follower's copy of the answer its leader's verdict, or judge it here if there is none to wait for."""
+    if leader_task is None or leader_task.get_loop() is not asyncio.get_running_loop():
+        await _judge_answer(query, answer_data, model, None, on_judged)
+        return
+
+    try:
+        judged = await asyncio.shield(leader_task)
+    except asyncio.CancelledError:
+        if not leader_task.cancelled():
+            raise
+        await _judge_answer(query, answer_data, model, None, on_judged)
+        return
+    answer_data.update({field: judged[field] for field in _JUDGEMENT_FIELDS})
+    if on_judged is not None:
+        try:
+            await asyncio.to_thread(on_judged, answer_data)
+        except Exception as e:
+            logger.error(f"Error handling relevance judgement: {e}")
+
+
+_JUDGEMENT_FIELDS = (
+    'relevance', 'relevance_explanation', 'eval_prompt_tokens', 'eval_completion_tokens', 'eval_total_tokens',
+)
+
+
+async def _judge_answer(query, answer_data, model, key, on_judged):
+    try:
+        relevance, explanation, eval_tokens = await aevaluate_relevance(query, answer_data['answer'], model=model)
+    except Exception as e:
+        logger.error(f"Error evaluating relevance: {e}")
+        relevance, explanation = "PARTLY_RELEVANT", "Failed to evaluate relevance"
+        eval_tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+    answer_data.update({
+        'relevance': relevance,
+        'relevance_explanation': explanation,
+        'eval_prompt_tokens': eval_tokens['prompt_tokens'],
+        'eval_completion_tokens': eval_tokens['completion_tokens'],
+        'eval_total_tokens': eval_tokens['total_tokens'],
+    })
+
+    try:
+        if key is not None:
+            await asyncio.to_thread(get_answer_cache().put, key, answer_data)
+        if on_judged is not None:
+            await asyncio.to_thread(on_judged, answer_data)
+    except Exception as e:
+        logger.error(f"Error handling relevance judgement: {e}")
+    return answer_data
+
+
+async def wait_for_judgements():
+    await asyncio.gather(*list(_judge_tasks))
+
+
+_LAZY_ATTRIBUTES = {
+    "client": get_client,
+    "async_client": get_async_client,
+    "index": get_index,
+    "answer_cache": get_answer_cache,
+    "llm_client": get_llm_client,
+}
+
+
+def __getattr__(name):
+    # rag.client, rag.index etc. still work for existing callers, but are only built when first used
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
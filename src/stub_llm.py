@@ -0,0 +1,254 @@
+"""
+Local stand-in for the Groq / OpenAI chat completions API, for load tests without network or quota.
+
+Latency is modelled as time to first token, drawn from a configurable distribution, plus completion
+tokens divided by a generation speed. Responses are filler text, except that relevance evaluation
+prompts get well-formed verdicts so the judging path is exercised too. A share of requests can be
+failed with a chosen HTTP status. Streaming requests are answered with server-sent events and report
+usage under x_groq on the last chunk, like Groq.
+
+    python stub_llm.py --port 8008 --ttft-dist lognormal --ttft-mean 0.4 --error-rate 0.02
+    GROQ_BASE_URL=http://localhost:8008 GROQ_API_KEY=stub streamlit run app.py
+"""
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Groq clients call /openai/v1/..., OpenAI clients /v1/...
+COMPLETION_PATHS = ("/openai/v1/chat/completions", "/v1/chat/completions")
+DISTRIBUTIONS = ("fixed", "uniform", "normal", "lognormal", "exponential")
+
+_WORDS = (
+    "mental health support therapy anxiety stress sleep mood care treatment symptoms feelings "
+    "professional help coping strategies wellbeing depression recovery routine breathing exercise"
+).split()
+_ITEM = re.compile(r"^Item (\d+):", re.MULTILINE)
+
+
+class StubConfig:
+    def __init__(self, ttft_dist="lognormal", ttft_mean=0.3, ttft_std=0.1, tokens_per_second=250.0,
+                 completion_tokens=150, completion_tokens_std=50, error_rate=0.0, error_status=429, seed=None):
+        if ttft_dist not in DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {ttft_dist}")
+        self.ttft_dist = ttft_dist
+        self.ttft_mean = ttft_mean
+        self.ttft_std = ttft_std
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.completion_tokens_std = completion_tokens_std
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample_ttft(self):
+        mean, std = self.ttft_mean, self.ttft_std
+        with self._lock:
+            if self.ttft_dist == "fixed":
+                value = mean
+            elif self.ttft_dist == "uniform":
+                value = self._rng.uniform(mean - std * math.sqrt(3), mean + std * math.sqrt(3))
+            elif self.ttft_dist == "normal":
+                value = self._rng.gauss(mean, std)
+            elif self.ttft_dist == "lognormal":
+                # Parameterized by the mean and standard deviation of the latency itself
+                sigma2 = math.log(1 + (std / mean) ** 2) if mean > 0 else 0.0
+                value = self._rng.lognormvariate(math.log(mean) - sigma2 / 2, math.sqrt(sigma2)) if mean > 0 else 0.0
+            else:
+                value = self._rng.expovariate(1 / mean) if mean > 0 else 0.0
+        return max(value, 0.0)
+
+    def sample_completion_tokens(self):
+        with self._lock:
+            return max(1, round(self._rng.gauss(self.completion_tokens, self.completion_tokens_std)))
+
+    def should_fail(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+
+def count_tokens(text):
+    # Roughly 4 tokens per 3 English words
+    return max(1, round(len(text.split()) * 4 / 3))
+
+
+def reply_for(prompt, config):
+    """Return (content, completion_tokens) for a prompt."""
+    if '"Relevance"' in prompt:
+        items = _ITEM.findall(prompt)
+        verdict = {"Relevance": "RELEVANT", "Explanation": "The answer addresses the question."}
+        if items:
+            content = json.dumps([dict(verdict, id=int(item)) for item in items])
+        else:
+            content = json.dumps(verdict)
+        return content, count_tokens(content)
+
+    tokens = config.sample_completion_tokens()
+    with config._lock:
+        words = [config._rng.choice(_WORDS) for _ in range(tokens)]
+    return " ".join(words).capitalize() + ".", tokens
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # Clients drop requests they no longer need, e.g. the slower one of a hedged pair
+            pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path.split("?")[0] not in COMPLETION_PATHS:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+
+        config = self.server.config
+        request = json.loads(body or b"{}")
+        if config.should_fail():
+            time.sleep(config.sample_ttft() / 2)
+            self._send_json(config.error_status, {"error": {"message": "Stub failure", "type": "stub_error"}})
+            return
+
+        prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+        content, completion_tokens = reply_for(prompt, config)
+        usage = {
+            "prompt_tokens": count_tokens(prompt),
+            "completion_tokens": completion_tokens,
+            "total_tokens": count_tokens(prompt) + completion_tokens,
+        }
+        ttft = config.sample_ttft()
+        generation = completion_tokens / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+        model = request.get("model", "stub")
+
+        if request.get("stream"):
+            self._stream(content, usage, model, ttft, generation)
+        else:
+            time.sleep(ttft + generation)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            })
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _stream(self, content, usage, model, ttft, generation):
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        pieces = re.findall(r"\S+\s*", content) or [content]
+        delay = generation / len(pieces)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send(choices, **extra):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+
+        time.sleep(ttft)
+        for i, piece in enumerate(pieces):
+            if i:
+                time.sleep(delay)
+            delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+            send([{"index": 0, "delta": delta, "finish_reason": None}])
+        send([{"index": 0, "delta": {}, "finish_reason": "stop"}], x_groq={"id": completion_id, "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def serve(config, host="127.0.0.1", port=8008):
+    """Start the stub in a background thread; returns the server, whose base URL is server.url."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.config = config
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="stub-llm", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--ttft-dist", choices=DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--ttft-mean", type=float, default=0.3, help="mean time to first token, seconds")
+    parser.add_argument("--ttft-std", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=250.0, help="generation speed, 0 for instant")
+    parser.add_argument("--completion-tokens", type=int, default=150)
+    parser.add_argument("--completion-tokens-std", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests to fail")
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def config_from_args(args):
+    return StubConfig(
+        ttft_dist=args.ttft_dist,
+        ttft_mean=args.ttft_mean,
+        ttft_std=args.ttft_std,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        completion_tokens_std=args.completion_tokens_std,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    server.config = config_from_args(args)
+    print(f"Stub LLM listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
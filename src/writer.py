@@ -0,0 +1,242 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# "sync" writes every conversation and feedback row on the request thread; "buffered" queues them
+# for the background BufferedWriter, which flushes once WRITE_BUFFER_SIZE rows are queued or
+# WRITE_BUFFER_INTERVAL seconds have passed
+DB_WRITE_MODE = os.getenv("DB_WRITE_MODE", "sync")
+WRITE_BUFFER_SIZE = int(os.getenv("WRITE_BUFFER_SIZE", "200"))
+WRITE_BUFFER_INTERVAL = float(os.getenv("WRITE_BUFFER_INTERVAL", "1.0"))
+WRITE_SPOOL_PATH = os.getenv("WRITE_SPOOL_PATH", "../dataset/write_spool.jsonl")
+WRITE_SPOOL_FSYNC = os.getenv("WRITE_SPOOL_FSYNC", "0") == "1"
+
+CONVERSATIONS = "conversations"
+FEEDBACK = "feedback"
+
+# Position of the timestamp in db.conversation_row() and db.feedback_row() tuples
+_TIMESTAMP_FIELD = {CONVERSATIONS: 13, FEEDBACK: 2}
+
+
+def _encode(table, row):
+    row = list(row)
+    field = _TIMESTAMP_FIELD[table]
+    row[field] = row[field].isoformat()
+    return json.dumps({"table": table, "row": row}) + "\n"
+
+
+def _decode(line):
+    record = json.loads(line)
+    table, row = record["table"], record["row"]
+    field = _TIMESTAMP_FIELD[table]
+    row[field] = datetime.fromisoformat(row[field])
+    return table, tuple(row)
+
+
+def _leftover_segments(spool_path):
+    return sorted(glob.glob(f"{glob.escape(spool_path)}.*"), key=os.path.getmtime)
+
+
+class BufferedWriter:
+    """
+    Write-behind logger for conversations and feedback. Rows are appended to a local spool file and
+    queued in memory, then written in bulk by a background thread, so requests never wait on a
+    Postgres commit. The spool is rotated into a sealed segment at every flush and a segment is only
+    deleted once its rows are committed; segments left behind by a crash are replayed on start.
+    Every process needs its own spool path.
+    """
+
+    def __init__(self, spool_path, max_rows=200, interval=1.0, fsync=False, save_rows=db.save_rows):
+        self.spool_path = spool_path
+        self.max_rows = max_rows
+        self.interval = interval
+        self.fsync = fsync
+        self.save_rows = save_rows
+        self._buffer = []
+        self._sealed = []
+        self._spool = None
+        self._segment = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        spool_dir = os.path.dirname(spool_path)
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+        self._recover()
+
+    def _recover(self):
+        """Queue the rows of every spool file left over from a previous process."""
+        leftovers = _leftover_segments(self.spool_path)
+        if os.path.exists(self.spool_path):
+            leftovers.append(self._seal_active())
+
+        for path in leftovers:
+            with open(path) as f:
+                for number, line in enumerate(f, 1):
+                    if not line.endswith("\n"):
+                        # A torn final line was never acknowledged to the caller
+                        logger.warning(f"Skipping incomplete record at {path}:{number}")
+                        continue
+                    self._buffer.append(_decode(line))
+            self._sealed.append(path)
+        if self._buffer:
+            logger.info(f"Replaying {len(self._buffer)} spooled rows from {len(leftovers)} files")
+
+    def _seal_active(self):
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+        self._segment += 1
+        sealed = f"{self.spool_path}.{os.getpid()}.{time.time_ns()}.{self._segment}"
+        os.replace(self.spool_path, sealed)
+        return sealed
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name="buffered-writer", daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread after a final flush."""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def save_conversation(self, conversation_id, question, answer_data, timestamp=None):
+        self._append(CONVERSATIONS, db.conversation_row(conversation_id, question, answer_data, timestamp))
+        return True
+
+    def save_feedback(self, conversation_id, feedback, timestamp=None):
+        self._append(FEEDBACK, db.feedback_row(conversation_id, feedback, timestamp))
+        return True
+
+    def _append(self, table, row):
+        self.start()
+        line = _encode(table, row)
+        with self._lock:
+            if self._spool is None:
+                self._spool = open(self.spool_path, "a")
+            self._spool.write(line)
+            self._spool.flush()
+            if self.fsync:
+                os.fsync(self._spool.fileno())
+            self._buffer.append((table, row))
+            full = len(self._buffer) >= self.max_rows
+        if full:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Write every queued row; on failure they stay queued and spooled for the next attempt."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._buffer and not self._sealed:
+                    return True
+                rows, self._buffer = self._buffer, []
+                if self._spool is not None:
+                    self._sealed.append(self._seal_active())
+                segments = list(self._sealed)
+
+            try:
+                if rows:
+                    self.save_rows(
+                        [row for table, row in rows if table == CONVERSATIONS],
+                        [row for table, row in rows if table == FEEDBACK],
+                    )
+            except Exception as e:
+                logger.error(f"Buffered write of {len(rows)} rows failed, will retry: {e}")
+                with self._lock:
+                    self._buffer = rows + self._buffer
+                return False
+
+            with self._lock:
+                self._sealed = [path for path in self._sealed if path not in segments]
+            for path in segments:
+                os.remove(path)
+            return True
+
+    def _run(self):
+        failures = 0
+        while not self._stopping.is_set():
+            # Back off while the database is unreachable instead of retrying every interval
+            self._wakeup.wait(self.interval * min(2 ** failures, 30))
+            self._wakeup.clear()
+            failures = 0 if self.flush() else failures + 1
+        self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the process-wide BufferedWriter, replaying any spooled rows on first use."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BufferedWriter(
+                WRITE_SPOOL_PATH,
+                max_rows=WRITE_BUFFER_SIZE,
+                interval=WRITE_BUFFER_INTERVAL,
+                fsync=WRITE_SPOOL_FSYNC,
+            )
+            _writer.start()
+            atexit.register(_writer.stop)
+        return _writer
+
+
+_recovered = False
+
+
+def recover_spool():
+    """
+    Write the rows an earlier process left spooled, whatever DB_WRITE_MODE is now; runs once per process,
+    after the schema exists. In buffered mode the writer replays them, otherwise they are flushed here.
+    """
+    global _recovered
+    with _writer_lock:
+        if _recovered:
+            return
+        _recovered = True
+    if DB_WRITE_MODE == "buffered":
+        get_writer()
+        return
+    if not os.path.exists(WRITE_SPOOL_PATH) and not _leftover_segments(WRITE_SPOOL_PATH):
+        return
+
+    logger.warning(f"Found rows spooled by a buffered writer at {WRITE_SPOOL_PATH}; writing them now")
+    leftover = BufferedWriter(WRITE_SPOOL_PATH, fsync=WRITE_SPOOL_FSYNC)
+    if not leftover.flush():
+        logger.error(f"Spooled rows at {WRITE_SPOOL_PATH} are kept for the next start")
+
+
+def save_conversation(conversation_id, question, answer_data, timestamp=None):
+    """Save a conversation according to DB_WRITE_MODE; in buffered mode True means it was spooled."""
+    if DB_WRITE_MODE == "buffered":
+        return get_writer().save_conversation(conversation_id, question, answer_data, timestamp)
+    return db.save_conversation(conversation_id, question, answer_data, timestamp)
+
+
+def save_feedback(conversation_id, feedback, timestamp=None):
+    """Save feedback according to DB_WRITE_MODE; in buffered mode True means it was spooled."""
+    if DB_WRITE_MODE == "buffered":
+        return get_writer().save_feedback(conversation_id, feedback, timestamp)
+    return db.save_feedback(conversation_id, feedback, timestamp)